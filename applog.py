@@ -0,0 +1,147 @@
+"""Structured JSON logging written from a background thread.
+
+Request threads only build a LogRecord and put it on a queue; a
+QueueListener thread formats each record as one JSON line and writes it.
+Records may carry a "route" (for per-route sampling) and a "fields" dict
+of structured data, both passed through the standard extra= argument:
+
+    log.info("request", extra={"route": "GET /users", "fields": {"ms": 3.1}})
+
+Callers that do extra work to build a record ask sampled(route) first.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+LOGGER_NAME = "apirepo"
+
+_listener = None
+_sampler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, then the fields"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        route = getattr(record, "route", None)
+        if route is not None:
+            entry["route"] = route
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+class RouteSampler(logging.Filter):
+    """Keep only a fraction of the records below WARNING, per route.
+
+    rates maps a route label (e.g. "GET /users/<userId>") to the fraction
+    kept; "*" is the default for routes not listed. Warnings and errors
+    are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self.default = self.rates.pop("*", 1.0)
+
+    def keep(self, route, level):
+        if level >= logging.WARNING:
+            return True
+        rate = self.rates.get(route, self.default)
+        return rate >= 1 or random.random() < rate
+
+    def filter(self, record):
+        # Already decided by the caller through sampled()
+        if getattr(record, "sampled", False):
+            return True
+        return self.keep(getattr(record, "route", None), record.levelno)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock prepare formats the message on the calling thread; only
+        # merge the args here and leave the JSON encoding to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_rates(spec):
+    """Parse "GET /=0.01,*=1" into {"GET /": 0.01, "*": 1.0}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        route, _, rate = part.rpartition("=")
+        rates[route.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level="INFO", sample_rates=None, stream=None):
+    """Route the apirepo logger through a queue to a background JSON writer.
+
+    Returns the logger. Calling it again replaces the writer thread, which
+    is how a forked worker gets one of its own. The listener is stopped,
+    and the queue flushed, at interpreter exit.
+    """
+    global _listener, _sampler
+    stop_logging()
+    log = logging.getLogger(LOGGER_NAME)
+    log.setLevel(level)
+    log.propagate = False
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    _sampler = RouteSampler(sample_rates or {})
+    handler.addFilter(_sampler)
+    log.addHandler(handler)
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, writer, respect_handler_level=False)
+    _listener.start()
+    return log
+
+
+def stop_logging():
+    """Write out every queued record and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+def sampled(route, level=logging.INFO):
+    """Whether a record for route passes sampling, decided up front so the
+    caller can skip building it. Log the record with extra={"sampled":
+    True} so it is not sampled a second time."""
+    return _sampler is None or _sampler.keep(route, level)
+
+
+def body_digest(body):
+    """Size and short sha256 of a raw request body, logged instead of the body"""
+    return {
+        "bodyBytes": len(body),
+        "bodySha256": hashlib.sha256(body).hexdigest()[:16] if body else None,
+    }
+
@@ -0,0 +1,476 @@
+"""Endpoint benchmark for dummpyApi2 against a synthetic dataset.
+
+Builds N users and G groups (members and items per group configurable)
+in a local storage backend, then drives every route with the requested
+concurrency, one route at a time so backend calls can be attributed to
+it. Reports p50/p95/p99 latency, throughput, and backend reads, writes
+and bytes per request.
+
+    python bench_api.py --users 2000 --groups 200 --members 8 --items 50
+    python bench_api.py --save baseline.json
+    python bench_api.py --compare baseline.json --fail-on-regression
+
+--serve dev|prod runs the same request mix over HTTP instead: the dataset
+is written to a SQLite file, the development server (python dummpyApi2.py)
+or serve.py is started on it, and requests go through real sockets. Backend
+calls happen in the server processes then, so those columns stay empty;
+GET /metrics on the server has them per worker. Under serve.py, event
+streams are opened on its --events-bind listener (--port + 1).
+
+    python bench_api.py --backend sqlite --sqlite-path /tmp/bench.sqlite3 --serve dev --save dev.json
+    python bench_api.py --backend sqlite --sqlite-path /tmp/bench.sqlite3 --serve prod --compare dev.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--sqlite-path", default=":memory:")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--members", type=int, default=6, help="members per group")
+    parser.add_argument("--items", type=int, default=40, help="items per group")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--routes", help="comma separated route names to run (default: all)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the read cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative p95 / backend-bytes growth that counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--serve", choices=("dev", "prod"),
+                        help="benchmark a server process over HTTP (needs --backend sqlite with a file)")
+    parser.add_argument("--port", type=int, default=7099)
+    parser.add_argument("--workers", type=int, default=1, help="serve.py workers for --serve prod")
+    parser.add_argument("--threads", type=int, default=32, help="serve.py threads per worker")
+    return parser.parse_args()
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow anything the handlers write to stdout while we measure"""
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if os.environ.get("BENCH_VERBOSE") else open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+        sys.stdout = stdout
+
+
+# -----------------------------
+# 🔥 SYNTHETIC DATA
+# -----------------------------
+class Dataset:
+    def __init__(self):
+        self.users = []          # (uid, email)
+        self.groups = []         # (groupId, [memberIds])
+        self.items = []          # (itemId, groupId)
+        self.email_counter = itertools.count()
+
+
+def make_item(rng, group_id, members, n):
+    payer = rng.choice(members)
+    spliter = rng.sample(members, rng.randint(1, len(members)))
+    values = [round(rng.uniform(10, 2000) / len(spliter), 2) for _ in spliter]
+    return {
+        "itemName": f"Expense {n}",
+        "itemDateUpdate": f"2024-{1 + n % 12:02d}-{1 + n % 28:02d}",
+        "itemTimeUpdate": f"{n % 24:02d}:{n % 60:02d}",
+        "itemTotalAmount": round(sum(values), 2),
+        "itemPayer": [payer],
+        "itemSpliter": spliter,
+        "itemSpliterValue": values,
+        "itemGroupId": group_id,
+    }
+
+
+def generate(api, args, rng):
+    """Write the synthetic dataset straight into the backend"""
+    from ledger import Ledger
+    from storage import new_push_id
+
+    ds = Dataset()
+    updates = {}
+    group_ids = {}
+    for i in range(args.users):
+        email = f"bench{i}@example.com"
+        uid = api.auth.create_user(email=email, password="benchpass", display_name=f"Bench User {i}").uid
+        ds.users.append((uid, email))
+        group_ids[uid] = []
+        email_key = email.replace(".", "_dot_").replace("@", "_at_")
+        updates[f"usersAsEmailKey/{email_key}"] = {"email": email_key, "userId": uid}
+    ds.email_counter = itertools.count(args.users)
+
+    uids = [uid for uid, _ in ds.users]
+    for g in range(args.groups):
+        group_id = new_push_id()
+        members = rng.sample(uids, min(args.members, len(uids)))
+        ledger = Ledger(members)
+        item_index = {}
+        for n in range(args.items):
+            item = make_item(rng, group_id, members, n)
+            item["itemId"] = new_push_id()
+            ledger.apply_item(item["itemPayer"][0], item["itemSpliter"], item["itemSpliterValue"])
+            updates[f"items/{item['itemId']}"] = item
+            item_index[item["itemId"]] = api.item_sort_key(item)
+            ds.items.append((item["itemId"], group_id))
+        updates[f"groups/{group_id}"] = {
+            "groupId": group_id,
+            "groupName": f"Group {g}",
+            "groupMembers": members,
+            "groupItemIndex": item_index,
+            "groupBalances": ledger.balances(),
+            "groupGraph": ledger.graph_view(),
+        }
+        for uid, amount in ledger.balances().items():
+            group_ids[uid].append(group_id)
+            updates[f"userBalances/{uid}/{group_id}"] = amount
+        ds.groups.append((group_id, members))
+
+    for i, (uid, email) in enumerate(ds.users):
+        updates[f"users/{uid}"] = {
+            "userId": uid,
+            "name": f"Bench User {i}",
+            "email": email,
+            "mobileNo": "",
+            "groupIds": {group_id: True for group_id in group_ids[uid]},
+        }
+    api.db.reference().update(updates)
+    return ds
+
+
+# -----------------------------
+# 🔥 ROUTES
+# -----------------------------
+def route_table(ds, rng):
+    """(name, make_request) for every route; make_request() -> (method, url, kwargs).
+
+    Ordered so destructive routes run last and have ids to consume.
+    kwargs may hold first_chunk=True for streams that never end on their
+    own: the request is timed to the first body chunk and then closed.
+    """
+    def group():
+        return rng.choice(ds.groups)
+
+    def user():
+        return rng.choice(ds.users)
+
+    def item():
+        return rng.choice(ds.items)
+
+    def new_item():
+        group_id, members = group()
+        return make_item(rng, group_id, members, rng.randrange(10000))
+
+    def take(pool):
+        # Destructive routes consume ids; once a pool runs dry they hit 404s
+        return pool.pop()[0] if pool else "missing"
+
+    def new_email():
+        return f"bench{next(ds.email_counter)}@example.com"
+
+    def sync_token(uid):
+        # The token a client holds after syncing the generated data (rev 0)
+        from dummpyApi2 import encode_sync_token
+        return encode_sync_token({group_id: 0 for group_id, members in ds.groups if uid in members})
+
+    return [
+        ("GET /", lambda: ("GET", "/", {})),
+        ("GET /cache/stats", lambda: ("GET", "/cache/stats", {})),
+        ("GET /metrics", lambda: ("GET", "/metrics", {})),
+        ("GET /metrics/traces", lambda: ("GET", "/metrics/traces", {})),
+        ("GET /users", lambda: ("GET", "/users", {})),
+        ("GET /users?limit", lambda: ("GET", "/users?limit=100", {})),
+        ("GET /users/<userId>", lambda: ("GET", f"/users/{user()[0]}", {})),
+        ("GET /users/<userId>/balances", lambda: ("GET", f"/users/{user()[0]}/balances", {})),
+        ("POST /users/groups", lambda: ("POST", "/users/groups", {"json": {"userId": user()[0]}})),
+        ("POST /users/login", lambda: ("POST", "/users/login", {"json": {"email": user()[1]}})),
+        ("POST /users/logout", lambda: ("POST", "/users/logout", {"json": {}})),
+        ("GET /items", lambda: ("GET", "/items", {})),
+        ("GET /items?limit", lambda: ("GET", "/items?limit=100", {})),
+        ("GET /items/<itemId>", lambda: ("GET", f"/items/{item()[0]}", {})),
+        ("GET /groups", lambda: ("GET", "/groups", {})),
+        ("GET /groups?limit", lambda: ("GET", "/groups?limit=100", {})),
+        ("POST /groups/getGroup", lambda: ("POST", "/groups/getGroup", {"json": {"groupId": group()[0]}})),
+        ("GET /groups/members/<groupId>", lambda: ("GET", f"/groups/members/{group()[0]}", {})),
+        ("POST /groups/membersDetail", lambda: ("POST", "/groups/membersDetail", {"json": group()[0]})),
+        ("GET /groups/<groupId>/settlements", lambda: ("GET", f"/groups/{group()[0]}/settlements", {})),
+        ("GET /groups/<groupId>/export", lambda: ("GET", f"/groups/{group()[0]}/export", {})),
+        ("GET /groups/<groupId>/export?format=csv", lambda: (
+            "GET", f"/groups/{group()[0]}/export?format=csv", {})),
+        ("POST /groups/expenseDetail", lambda: ("POST", "/groups/expenseDetail", {"data": json.dumps(group()[0])})),
+        ("POST /groups/expenseDetailbyCurrentUser", lambda: (
+            "POST", "/groups/expenseDetailbyCurrentUser",
+            {"json": (lambda g: {"groupId": g[0], "currentUserId": rng.choice(g[1])})(group())})),
+        ("POST /groups/items", lambda: ("POST", "/groups/items", {"json": group()[0]})),
+        ("POST /groups/items?limit", lambda: ("POST", "/groups/items?limit=10", {"json": group()[0]})),
+        ("POST /groups/items?from&to", lambda: (
+            "POST", "/groups/items?from=2024-03-01&to=2024-05-31", {"json": group()[0]})),
+        ("GET /groups/<groupId>/events", lambda: (
+            "GET", f"/groups/{group()[0]}/events", {"first_chunk": True})),
+        ("GET /sync", lambda: ("GET", f"/sync?userId={user()[0]}", {})),
+        ("GET /sync?since", lambda: (lambda uid: (
+            "GET", f"/sync?userId={uid}&since={sync_token(uid)}", {}))(user()[0])),
+        ("POST /users/create", lambda: ("POST", "/users/create", {"json": (lambda e: {
+            "name": e.split("@")[0], "email": e, "password": "benchpass"})(new_email())})),
+        ("POST /users/bulk", lambda: ("POST", "/users/bulk", {"json": {"users": [
+            {"name": e.split("@")[0], "email": e, "password": "benchpass"}
+            for e in (new_email() for _ in range(20))]}})),
+        ("POST /items/create", lambda: ("POST", "/items/create", {"json": new_item()})),
+        ("POST /items/batch", lambda: ("POST", "/items/batch", {"json": {"items": [new_item() for _ in range(10)]}})),
+        ("PUT /items/update-item", lambda: ("PUT", "/items/update-item", {"json": {
+            "itemId": item()[0], "itemName": f"Renamed {rng.randrange(1000)}"}})),
+        ("POST /groups/create", lambda: ("POST", "/groups/create", {"json": {
+            "groupName": "Bench group", "groupMembers": [uid for uid, _ in rng.sample(ds.users, 4)]}})),
+        ("PUT /groups/addMember", lambda: ("PUT", "/groups/addMember", {"json": {
+            "groupId": group()[0], "memberEmail": user()[1]}})),
+        ("PUT /groups/addMembers", lambda: ("PUT", "/groups/addMembers", {"json": {
+            "groupId": group()[0], "memberEmails": [email for _, email in rng.sample(ds.users, 5)]}})),
+        ("DELETE /items", lambda: ("DELETE", f"/items?itemId={take(ds.items)}", {})),
+        ("DELETE /groups", lambda: ("DELETE", "/groups", {"json": {"groupId": take(ds.groups)}})),
+    ]
+
+
+# -----------------------------
+# 🔥 RUNNER
+# -----------------------------
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def test_client_sender(api):
+    """new_sender for in-process requests through Flask's test client"""
+    def new_sender():
+        client = api.app.test_client()
+
+        def send(method, url, kwargs):
+            kwargs = dict(kwargs)
+            if kwargs.pop("first_chunk", False):
+                response = client.open(url, method=method, buffered=False, **kwargs)
+                next(iter(response.response), None)
+                response.close()
+                return response.status_code
+            response = client.open(url, method=method, **kwargs)
+            response.get_data()
+            return response.status_code
+        return send
+    return new_sender
+
+
+def http_sender(base_url, stream_url=None):
+    """new_sender for requests over HTTP, one keep-alive session per thread.
+
+    first_chunk requests go to stream_url when given (serve.py's event
+    stream listener).
+    """
+    import requests
+
+    def new_sender():
+        session = requests.Session()
+
+        def send(method, url, kwargs):
+            kwargs = dict(kwargs)
+            if kwargs.pop("first_chunk", False):
+                with session.request(method, (stream_url or base_url) + url, stream=True, **kwargs) as response:
+                    next(response.iter_content(chunk_size=None), None)
+                    return response.status_code
+            return session.request(method, base_url + url, **kwargs).status_code
+        return send
+    return new_sender
+
+
+def start_server(args):
+    """Start the dev server or serve.py on the bench SQLite file and wait for it"""
+    import requests
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, STORAGE_BACKEND="sqlite", SQLITE_PATH=os.path.abspath(args.sqlite_path),
+               PORT=str(args.port), LOG_LEVEL="WARNING")
+    if args.serve == "dev":
+        command = [sys.executable, "dummpyApi2.py"]
+    else:
+        command = [sys.executable, "serve.py", "--bind", f"127.0.0.1:{args.port}",
+                   "--events-bind", f"127.0.0.1:{args.port + 1}",
+                   "--workers", str(args.workers), "--threads", str(args.threads)]
+    # Own process group, so the dev server's reloader child is stopped too
+    server = subprocess.Popen(command, cwd=here, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"{args.serve} server exited with status {server.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{args.port}/", timeout=1).ok:
+                return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    stop_server(server)
+    sys.exit(f"{args.serve} server did not start on port {args.port}")
+
+
+def stop_server(server):
+    os.killpg(server.pid, signal.SIGTERM)
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+
+def run_route(new_sender, stats, make_request, requests, concurrency):
+    """Send requests from make_request; stats is None when the backend is out of process"""
+    local = threading.local()
+
+    def one(_):
+        send = getattr(local, "send", None)
+        if send is None:
+            send = local.send = new_sender()
+        method, url, kwargs = make_request()
+        start = time.perf_counter()
+        status = send(method, url, kwargs)
+        return time.perf_counter() - start, status
+
+    if stats is not None:
+        stats.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    backend = stats.snapshot() if stats is not None else None
+
+    latencies = sorted(s for s, _ in samples)
+    n = len(samples)
+    return {
+        "requests": n,
+        "errors": sum(1 for _, code in samples if code >= 400),
+        "p50Ms": percentile(latencies, 0.50) * 1e3,
+        "p95Ms": percentile(latencies, 0.95) * 1e3,
+        "p99Ms": percentile(latencies, 0.99) * 1e3,
+        "meanMs": sum(latencies) / n * 1e3,
+        "throughput": n / wall,
+        "backendReads": backend["reads"] / n if backend else None,
+        "backendWrites": backend["writes"] / n if backend else None,
+        "backendBytesIn": backend["bytesIn"] / n if backend else None,
+        "backendBytesOut": backend["bytesOut"] / n if backend else None,
+        "backendMs": backend["seconds"] / n * 1e3 if backend else None,
+    }
+
+
+def column(value, width, scale=1.0):
+    return f"{'-':>{width}}" if value is None else f"{value / scale:>{width}.1f}"
+
+
+def print_results(results):
+    header = (f"{'route':<42} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+              f"{'req/s':>8} {'reads':>6} {'writes':>6} {'KB in':>8} {'KB out':>8}")
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<42} {r['requests']:>5} {r['errors']:>4} {r['p50Ms']:>8.2f} {r['p95Ms']:>8.2f} "
+              f"{r['p99Ms']:>8.2f} {r['throughput']:>8.1f} {column(r['backendReads'], 6)} "
+              f"{column(r['backendWrites'], 6)} {column(r['backendBytesIn'], 8, 1024)} "
+              f"{column(r['backendBytesOut'], 8, 1024)}")
+
+
+def compare(results, baseline, threshold):
+    """Print per-route changes against a baseline; returns the regressed routes"""
+    regressed = []
+    print(f"\n{'route':<42} {'p95 ms':>18} {'req/s':>20} {'KB in/req':>20}")
+    for name, r in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        p95 = r["p95Ms"] / old["p95Ms"] - 1 if old["p95Ms"] else 0.0
+        kb = 0.0
+        if old["backendBytesIn"] and r["backendBytesIn"] is not None:
+            kb = r["backendBytesIn"] / old["backendBytesIn"] - 1
+        flag = ""
+        if p95 > threshold or kb > threshold:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:<42} {old['p95Ms']:>7.2f} -> {r['p95Ms']:>7.2f} "
+              f"{old['throughput']:>8.1f} -> {r['throughput']:>8.1f} "
+              f"{column(old['backendBytesIn'], 8, 1024)} -> {column(r['backendBytesIn'], 8, 1024)}{flag}")
+    return regressed
+
+
+def main():
+    args = parse_args()
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = args.sqlite_path
+    if args.no_cache:
+        os.environ["CACHE_TTL_SECONDS"] = "0"
+    # Access records would swamp the report; slow-request warnings still show
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import dummpyApi2 as api
+    from storage import BackendStats, InstrumentedDB
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    ds = generate(api, args, rng)
+    print(f"dataset: {args.users} users, {args.groups} groups x {args.members} members x "
+          f"{args.items} items in {time.perf_counter() - start:.1f}s ({args.backend})")
+
+    server = None
+    if args.serve:
+        if args.backend != "sqlite" or args.sqlite_path == ":memory:":
+            sys.exit("--serve needs --backend sqlite and a --sqlite-path file the server can open")
+        server = start_server(args)
+        stats = None
+        stream_url = f"http://127.0.0.1:{args.port + 1}" if args.serve == "prod" else None
+        new_sender = http_sender(f"http://127.0.0.1:{args.port}", stream_url)
+    else:
+        stats = BackendStats()
+        api.db = InstrumentedDB(api.db, stats.record)
+        new_sender = test_client_sender(api)
+
+    selected = set(args.routes.split(",")) if args.routes else None
+    results = {}
+    try:
+        for name, make_request in route_table(ds, rng):
+            if selected and name not in selected:
+                continue
+            with quiet():
+                results[name] = run_route(new_sender, stats, make_request, args.requests, args.concurrency)
+    finally:
+        if server is not None:
+            stop_server(server)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2, sort_keys=True)
+        print(f"\nsaved {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressed = compare(results, baseline, args.threshold)
+        if regressed and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Microbenchmark: Ledger.apply_item against the pairwise updateGraph walk.
+
+    python bench_ledger.py [--items 200] [--splitters 5] [--sizes 10,100,1000]
+"""
+import argparse
+import random
+import time
+
+from ledger import Ledger, updateGraph
+
+
+def make_items(members, count, splitters, rng):
+    items = []
+    for _ in range(count):
+        spliter = rng.sample(members, min(splitters, len(members)))
+        values = [round(rng.uniform(1, 500), 2) for _ in spliter]
+        items.append((rng.choice(members), spliter, values))
+    return items
+
+
+def bench_update_graph(members, items):
+    group = {
+        "groupMembers": members,
+        "groupGraph": {a: {b: 0 for b in members} for a in members},
+    }
+    start = time.perf_counter()
+    for payer, spliter, values in items:
+        for giveTo, amount in zip(spliter, values):
+            updateGraph(group, payer, giveTo, amount)
+    return time.perf_counter() - start, Ledger.from_graph(members, group["groupGraph"])
+
+
+def bench_ledger(members, items):
+    ledger = Ledger(members)
+    start = time.perf_counter()
+    for payer, spliter, values in items:
+        ledger.apply_item(payer, spliter, values)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    settlements = ledger.settlements()
+    return elapsed, time.perf_counter() - start, ledger, settlements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--splitters", type=int, default=5)
+    parser.add_argument("--sizes", default="10,100,1000")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'members':>8} {'updateGraph us/item':>20} {'Ledger us/item':>15} {'speedup':>8} "
+          f"{'settle ms':>10} {'transfers':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        rng = random.Random(args.seed)
+        members = [f"user{i:05d}" for i in range(size)]
+        items = make_items(members, args.items, args.splitters, rng)
+
+        graph_time, graph_ledger = bench_update_graph(members, items)
+        ledger_time, settle_time, ledger, settlements = bench_ledger(members, items)
+        # Both engines must agree on every member's net balance
+        assert graph_ledger.balances() == ledger.balances(), "engines disagree"
+
+        print(f"{size:>8} {graph_time / len(items) * 1e6:>20.1f} {ledger_time / len(items) * 1e6:>15.1f} "
+              f"{graph_time / ledger_time:>7.1f}x {settle_time * 1e3:>10.2f} {len(settlements):>10}")
+
+
+if __name__ == "__main__":
+    main()
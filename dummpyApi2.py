@@ -1,26 +1,98 @@
-import firebase_admin
-from firebase_admin import credentials, db, auth
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from ledger import Ledger, pack_graph, unpack_graph
+from storage import InstrumentedDB, new_push_id, open_backend
+from metrics import MetricsRegistry, bind_context, stream_in_request
+from applog import body_digest, parse_rates, sampled, setup_logging, stop_logging
+from events import EventHub, EventStreamServer, format_sse
+from bloom import BloomFilter
+from cachetools import LRUCache, TTLCache
 import traceback
+import base64
+import hashlib
+import csv
+import re
+import io
+import logging
+import threading
+import json
+import copy
 import os
 import time
+from datetime import datetime
+from queue import Empty
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 # -----------------------------
-# 🔥 FIREBASE INITIALIZATION
+# 🔥 LOGGING
 # -----------------------------
-try:
-    cred_path = os.path.join(os.path.dirname(__file__), "firebase.json")
-    cred = credentials.Certificate(cred_path)
-    firebase_admin.initialize_app(
-        cred,
-        {"databaseURL": "https://myproject-b3962-default-rtdb.firebaseio.com/"}
+# JSON lines on stdout, written by a background thread. LOG_SAMPLE keeps a
+# fraction of the INFO/DEBUG records per route, e.g. "GET /=0.01,*=0.1";
+# warnings and errors are always written. Request bodies are logged as
+# size and hash, and in full only when LOG_LEVEL=DEBUG.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+log = setup_logging(LOG_LEVEL, parse_rates(LOG_SAMPLE))
+
+# -----------------------------
+# 🔥 STORAGE INITIALIZATION
+# -----------------------------
+# STORAGE_BACKEND=firebase (default) uses the Realtime Database. "sqlite"
+# (file at SQLITE_PATH) and "memory" run the same handlers against a local
+# store, for load tests and single-node deployments.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase")
+FIREBASE_CREDENTIALS = os.environ.get(
+    "FIREBASE_CREDENTIALS", os.path.join(os.path.dirname(__file__), "firebase.json"))
+FIREBASE_DATABASE_URL = os.environ.get(
+    "FIREBASE_DATABASE_URL", "https://myproject-b3962-default-rtdb.firebaseio.com/")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "apirepo.sqlite3")
+
+# Backend calls are counted per route for /metrics unless METRICS_ENABLED=0.
+# METRICS_PAYLOAD_BYTES=1 also measures payload sizes; it is off by default
+# because it re-encodes every value read or written, the only part of the
+# accounting that costs more than a counter bump. A METRICS_TRACE_SAMPLE
+# fraction of requests record each backend call, and those slower than
+# METRICS_SLOW_MS are kept for GET /metrics/traces.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_PAYLOAD_BYTES = os.environ.get("METRICS_PAYLOAD_BYTES", "0") == "1"
+METRICS_TRACE_SAMPLE = float(os.environ.get("METRICS_TRACE_SAMPLE", 0.01))
+METRICS_SLOW_MS = float(os.environ.get("METRICS_SLOW_MS", 1000))
+
+def log_slow_request(trace):
+    log.warning("slow request", extra={"route": f"{trace['method']} {trace['route']}", "fields": trace})
+
+metrics = MetricsRegistry(
+    trace_sample=METRICS_TRACE_SAMPLE,
+    slow_seconds=METRICS_SLOW_MS / 1000,
+    on_slow=log_slow_request,
+    payload_bytes=METRICS_PAYLOAD_BYTES,
+)
+
+db = auth = None
+
+def init_storage(fresh=False):
+    global db, auth
+    db, auth = open_backend(
+        STORAGE_BACKEND,
+        credentials_path=FIREBASE_CREDENTIALS,
+        database_url=FIREBASE_DATABASE_URL,
+        sqlite_path=SQLITE_PATH,
+        fresh=fresh,
     )
-    print("🔥 Firebase connected to:", firebase_admin.get_app().project_id)
+    if METRICS_ENABLED:
+        db = InstrumentedDB(db, metrics.record_backend, sizes=METRICS_PAYLOAD_BYTES)
+
+try:
+    init_storage()
+    if STORAGE_BACKEND == "firebase":
+        import firebase_admin
+        log.info("storage ready", extra={"fields": {
+            "backend": STORAGE_BACKEND, "project": firebase_admin.get_app().project_id}})
+    else:
+        log.info("storage ready", extra={"fields": {"backend": STORAGE_BACKEND}})
 except Exception as e:
-    print("❌ Firebase Initialization Error:", e)
+    log.error("storage initialization failed", extra={"fields": {"error": str(e)}})
     exit(1)
 
 app = Flask(__name__)
-print("Firebase app:", firebase_admin.get_app().project_id)
 
 # -----------------------------
 # 🔥 HELPER FUNCTIONS
@@ -49,16 +121,516 @@ def wrap_data(key, value):
     """Wrap list or dict in a consistent data object"""
     return {key: value if value is not None else []}
 
+# -----------------------------
+# 🔥 READ CACHE
+# -----------------------------
+# In-process read-through cache keyed by RTDB path. Entries are evicted
+# LRU once CACHE_MAX_ENTRIES is reached and expire after CACHE_TTL_SECONDS
+# so changes made by other processes are picked up eventually. Every write
+# path in this file refreshes or invalidates exactly the paths it touched.
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 30))
+path_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_cache_generation = 0
+# Cached keys by path segment, {segment: {...}} with "" marking a key, so
+# invalidating a path walks its own subtree instead of every cached key.
+# Entries the TTLCache evicts on its own stay indexed until they are
+# invalidated or the index is rebuilt at twice the cache size.
+_cache_index = {}
+_cache_indexed = 0
+
+# -----------------------------
+# 🔥 SINGLE FLIGHT
+# -----------------------------
+# Concurrent callers asking for the same key share one in-flight call:
+# the first runs fn, the rest wait for its result. "saved" counts the
+# calls that did not have to run.
+_inflight = {}
+_inflight_lock = threading.Lock()
+single_flight_stats = {"calls": 0, "saved": 0}
+
+def single_flight(key, fn):
+    """Run fn once for all concurrent callers with the same key.
+
+    Every caller gets the same object back, so callers that modify the
+    result must copy it first.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+            single_flight_stats["calls"] += 1
+        else:
+            single_flight_stats["saved"] += 1
+    if not leader:
+        return future.result()
+    try:
+        value = fn()
+        future.set_result(value)
+        return value
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+def _index_cached(key):
+    """Record a key just stored in path_cache; call with cache_lock held"""
+    global _cache_index, _cache_indexed
+    if _cache_indexed >= 2 * CACHE_MAX_ENTRIES:
+        keys = list(path_cache.keys())
+        _cache_index, _cache_indexed = {}, 0
+    else:
+        keys = [key]
+    for k in keys:
+        node = _cache_index
+        for part in k.split("/"):
+            node = node.setdefault(part, {})
+        if "" not in node:
+            node[""] = True
+            _cache_indexed += 1
+
+def _pop_related_keys(path):
+    """Indexed keys that hold path, one of its ancestors or one of its
+    descendants, removed from the index; call with cache_lock held"""
+    global _cache_index, _cache_indexed
+    if not path.strip("/"):
+        keys = list(path_cache.keys())
+        _cache_index, _cache_indexed = {}, 0
+        return keys
+    parts = path.strip("/").split("/")
+    keys = []
+    node = _cache_index
+    for i, part in enumerate(parts):
+        parent, node = node, node.get(part)
+        if node is None:
+            return keys
+        if i == len(parts) - 1:
+            del parent[part]
+            break
+        if node.pop("", None):
+            keys.append("/".join(parts[:i + 1]))
+            _cache_indexed -= 1
+    stack = [("/".join(parts), node)]
+    while stack:
+        prefix, node = stack.pop()
+        for part, child in node.items():
+            if part == "":
+                keys.append(prefix)
+                _cache_indexed -= 1
+            else:
+                stack.append((prefix + "/" + part, child))
+    return keys
+
+def read_path(path):
+    """Read-through cached db.reference(path).get(); callers get their own copy"""
+    path = path.strip("/")
+    with cache_lock:
+        if path in path_cache:
+            cache_stats["hits"] += 1
+            return copy.deepcopy(path_cache[path])
+        cache_stats["misses"] += 1
+        generation = _cache_generation
+
+    def fetch():
+        value = db.reference(path).get()
+        with cache_lock:
+            # Skip the store if a write invalidated anything while we were reading
+            if generation == _cache_generation:
+                path_cache[path] = copy.deepcopy(value)
+                _index_cached(path)
+        return value
+
+    # Readers that arrive after a write start a new fetch instead of
+    # joining one that may have read the old value
+    return copy.deepcopy(single_flight(("path", path, generation), fetch))
+
+def cache_generation():
+    """Bumped by every local write; part of the single_flight key of any
+    response computed from several reads, so a request that starts after
+    a write never joins a build that started before it"""
+    with cache_lock:
+        return _cache_generation
+
+def invalidate_paths(*paths):
+    """Drop cached entries for paths that were just written"""
+    global _cache_generation
+    with cache_lock:
+        _cache_generation += 1
+        for path in paths:
+            for key in _pop_related_keys(path):
+                if key in path_cache:
+                    del path_cache[key]
+                    cache_stats["invalidations"] += 1
+
+def refresh_paths(values):
+    """Write-through: replace the cached values of {path: value} we just wrote"""
+    global _cache_generation
+    with cache_lock:
+        _cache_generation += 1
+        for path, value in values.items():
+            path = path.strip("/")
+            for key in _pop_related_keys(path):
+                if key in path_cache:
+                    del path_cache[key]
+                    cache_stats["invalidations"] += 1
+            path_cache[path] = copy.deepcopy(value)
+            _index_cached(path)
+
+def refresh_path(path, value):
+    """Write-through: replace the cached value of a path we just wrote"""
+    refresh_paths({path: value})
+
+# -----------------------------
+# 🔥 BATCHED READS
+# -----------------------------
+# Bounded pool shared by every handler that needs several independent
+# RTDB calls; the size caps how many we have in flight per process.
+# FANOUT_LIMIT caps how many of those one request may hold at a time, so a
+# large group cannot take the whole pool.
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 16))
+FANOUT_LIMIT = int(os.environ.get("FANOUT_LIMIT", 8))
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="rtdb-fetch")
+
+def fan_out(fn, args):
+    """[fn(arg) for arg in args], run concurrently on fetch_pool.
+
+    Results come back in the order of args; the first exception raised by
+    a call is re-raised once every started call has finished.
+    """
+    args = list(args)
+    # Calls made from a pool thread run inline: waiting on the same pool
+    # from inside it can deadlock once every worker is waiting
+    if len(args) <= 1 or threading.current_thread().name.startswith("rtdb-fetch"):
+        return [fn(a) for a in args]
+    fn = bind_context(fn)
+    futures = [None] * len(args)
+    running = set()
+    for i, arg in enumerate(args):
+        if len(running) >= FANOUT_LIMIT:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+        futures[i] = fetch_pool.submit(fn, arg)
+        running.add(futures[i])
+    wait(running)
+    return [f.result() for f in futures]
+
+def fetch_many(paths):
+    """Read several RTDB paths in parallel, results in the same order as paths"""
+    return fan_out(read_path, paths)
+
+def fetch_items(item_ids):
+    """Load items/<id> for just the given ids, skipping ones that no longer exist"""
+    item_ids = [i for i in item_ids if i]
+    items = []
+    for item_id, item in zip(item_ids, fetch_many(f"items/{i}" for i in item_ids)):
+        if item:
+            item.setdefault("itemId", item_id)
+            items.append(item)
+    return items
+
+
+# -----------------------------
+# 🔥 USER NAME INDEX
+# -----------------------------
+# uid -> display name, so endpoints that only need names read
+# users/<uid>/name for the handful of uids they show instead of the whole
+# users tree. Fed by create_user and filled lazily for older users.
+USER_NAME_INDEX_SIZE = int(os.environ.get("USER_NAME_INDEX_SIZE", 100000))
+user_name_index = LRUCache(maxsize=USER_NAME_INDEX_SIZE)
+user_name_lock = threading.Lock()
+
+def index_user_name(uid, name):
+    with user_name_lock:
+        user_name_index[uid] = name
+
+def lookup_user_names(uids):
+    """Batched uid -> name lookup; None for users that do not exist"""
+    uids = set(uids)
+    with user_name_lock:
+        names = {uid: user_name_index[uid] for uid in uids if uid in user_name_index}
+    missing = [uid for uid in uids if uid not in names]
+    for uid, name in zip(missing, fetch_many(f"users/{uid}/name" for uid in missing)):
+        names[uid] = name
+        if name is not None:
+            index_user_name(uid, name)
+    return names
+
+def get_user_names(uids):
+    """Batched uid -> name lookup, falling back to the uid for unknown users"""
+    return {uid: uid if name is None else name for uid, name in lookup_user_names(uids).items()}
+
+# -----------------------------
+# 🔥 EMAIL LOOKUP
+# -----------------------------
+# email -> uid through usersAsEmailKey/<email_key>, one key at a time.
+# Keys resolved before are kept in an LRU of EMAIL_CACHE_SIZE. A Bloom
+# filter of every existing key answers most unknown emails with no read
+# at all. It is built from a shallow (keys only) read of usersAsEmailKey
+# on first use, rebuilt in the background every EMAIL_FILTER_REFRESH_SECONDS,
+# and fed by create_user in between. With several workers, an email
+# registered through another worker may be reported unknown here until
+# the next rebuild; EMAIL_FILTER=0 turns the filter off.
+EMAIL_CACHE_SIZE = int(os.environ.get("EMAIL_CACHE_SIZE", 100000))
+EMAIL_FILTER = os.environ.get("EMAIL_FILTER", "1") == "1"
+EMAIL_FILTER_ERROR_RATE = float(os.environ.get("EMAIL_FILTER_ERROR_RATE", 0.01))
+EMAIL_FILTER_REFRESH_SECONDS = float(os.environ.get("EMAIL_FILTER_REFRESH_SECONDS", 300))
+email_cache = LRUCache(maxsize=EMAIL_CACHE_SIZE)
+email_lock = threading.Lock()
+email_stats = {"cacheHits": 0, "filterMisses": 0, "reads": 0, "filterBuilds": 0}
+_email_filter = {"bloom": None, "built": 0.0, "pending": None}
+
+def email_key(email):
+    """usersAsEmailKey key of an email address"""
+    return email.replace(".", "_dot_").replace("@", "_at_")
+
+def index_user_email(key, uid):
+    """Record a newly registered email in the cache and the filter"""
+    with email_lock:
+        email_cache[key] = uid
+        if _email_filter["bloom"] is not None:
+            _email_filter["bloom"].add(key)
+        if _email_filter["pending"] is not None:
+            _email_filter["pending"].append(key)
+
+def _build_email_filter():
+    with email_lock:
+        if _email_filter["pending"] is None:
+            _email_filter["pending"] = []
+    try:
+        keys = db.reference("usersAsEmailKey").get(shallow=True) or {}
+        bloom = BloomFilter(max(100000, 2 * len(keys)), EMAIL_FILTER_ERROR_RATE)
+        for key in keys:
+            bloom.add(key)
+        with email_lock:
+            # Emails registered while the keys were being read
+            for key in _email_filter["pending"]:
+                bloom.add(key)
+            _email_filter.update(bloom=bloom, built=time.monotonic())
+            email_stats["filterBuilds"] += 1
+    finally:
+        with email_lock:
+            _email_filter["pending"] = None
+
+def email_filter():
+    """The Bloom filter of known email keys, building or refreshing it as needed"""
+    bloom = _email_filter["bloom"]
+    if bloom is None:
+        try:
+            single_flight(("email-filter",), _build_email_filter)
+        except Exception as e:
+            log.warning("email filter build failed", extra={"fields": {"error": str(e)}})
+        return _email_filter["bloom"]
+    if time.monotonic() - _email_filter["built"] > EMAIL_FILTER_REFRESH_SECONDS:
+        with email_lock:
+            start = _email_filter["pending"] is None
+            if start:
+                _email_filter["pending"] = []
+        if start:
+            threading.Thread(target=_refresh_email_filter, name="email-filter", daemon=True).start()
+    return bloom
+
+def _refresh_email_filter():
+    try:
+        _build_email_filter()
+    except Exception as e:
+        log.warning("email filter refresh failed", extra={"fields": {"error": str(e)}})
+        with email_lock:
+            _email_filter["built"] = time.monotonic()
+
+def lookup_user_ids_by_email(emails):
+    """Batched email -> uid lookup; None for emails no user registered with"""
+    keys = {email: email_key(email) for email in emails}
+    found = {}
+    with email_lock:
+        for email, key in keys.items():
+            if key in email_cache:
+                found[email] = email_cache[key]
+                email_stats["cacheHits"] += 1
+    missing = [email for email in keys if email not in found]
+    if missing and EMAIL_FILTER:
+        bloom = email_filter()
+        unknown = [email for email in missing if bloom is not None and keys[email] not in bloom]
+        for email in unknown:
+            found[email] = None
+        missing = [email for email in missing if email not in found]
+        with email_lock:
+            email_stats["filterMisses"] += len(unknown)
+    with email_lock:
+        email_stats["reads"] += len(missing)
+    for email, entry in zip(missing, fan_out(lambda k: db.reference(f"usersAsEmailKey/{k}").get(),
+                                             [keys[email] for email in missing])):
+        found[email] = (entry or {}).get("userId")
+        if found[email] is not None:
+            with email_lock:
+                email_cache[keys[email]] = found[email]
+    return found
+
+# -----------------------------
+# 🔥 MEMBERSHIP
+# -----------------------------
+# users/<uid>/groupIds is a keyed map {groupId: true}, so joining or leaving
+# a group is one path in a root update with no read first. Users written
+# before that hold a list, or a mix of list entries and keys once a key has
+# been added to one, until `python manage.py migrate-group-ids` rewrites
+# them. Until it has run, delete_group reads the members to find the list
+# entries to clear; set LEGACY_GROUP_IDS=0 afterwards to skip that read.
+LEGACY_GROUP_IDS = os.environ.get("LEGACY_GROUP_IDS", "1") == "1"
+
+def group_id_list(group_ids):
+    """Group ids held in a stored groupIds value, whatever its shape"""
+    if isinstance(group_ids, dict):
+        ids = (v if isinstance(v, str) else k for k, v in group_ids.items() if v)
+    else:
+        ids = group_ids or []
+    return list(dict.fromkeys(g for g in ids if g))
+
+def legacy_group_id_paths(group_ids, group_id):
+    """Sub-paths of a stored groupIds value that hold group_id as a list entry"""
+    if isinstance(group_ids, dict):
+        return [k for k, v in group_ids.items() if v == group_id]
+    return [str(i) for i, g in enumerate(group_ids or []) if g == group_id]
+
+def user_view(user):
+    """A stored user as the API returns it: groupIds as a list of ids"""
+    return dict(user, groupIds=group_id_list(user.get("groupIds")))
+
+# -----------------------------
+# 🔥 PAGINATION / STREAMING
+# -----------------------------
+PAGE_SIZE_DEFAULT = int(os.environ.get("PAGE_SIZE_DEFAULT", 100))
+PAGE_SIZE_MAX = int(os.environ.get("PAGE_SIZE_MAX", 1000))
+
+def read_page(path, cursor=None, limit=PAGE_SIZE_DEFAULT):
+    """One key-ordered page of path's children as ([(key, value)], next_cursor).
+
+    next_cursor is the first key of the following page (None on the last
+    page), so passing it back as cursor continues where this page ended.
+    """
+    query = db.reference(path).order_by_key()
+    if cursor:
+        query = query.start_at(cursor)
+    rows = list((query.limit_to_first(limit + 1).get() or {}).items())
+    next_cursor = rows[limit][0] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def iter_children(path, page_size=PAGE_SIZE_DEFAULT, cursor=None):
+    """Every (key, value) child of path from cursor on, fetched one page at a time"""
+    while True:
+        rows, cursor = read_page(path, cursor, page_size)
+        yield from rows
+        if cursor is None:
+            return
+
+def list_collection(path, key_name, plural, message, view=None):
+    """GET handler body shared by /users, /items and /groups.
+
+    ?limit=&cursor= returns one page plus a "next" cursor. ?stream=json
+    sends the usual envelope as a chunked JSON array, ?stream=ndjson one
+    record per line; with a cursor they start where that page would, so a
+    paged client can stream the rest. Without any of these parameters the
+    whole node is returned as before. view, if given, reshapes each
+    record before it is sent.
+    """
+    def record(k, v):
+        v = {**v, key_name: k}
+        return view(v) if view else v
+
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    stream = request.args.get("stream")
+
+    if stream in ("json", "ndjson"):
+        page_size = max(1, min(limit or PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX))
+
+        def generate():
+            rows = iter_children(path, page_size, cursor)
+            if stream == "ndjson":
+                for k, v in rows:
+                    yield json.dumps(record(k, v)) + "\n"
+                return
+            yield f'{{"status": "success", "message": "{message}", "data": {{"{plural}": ['
+            for n, (k, v) in enumerate(rows):
+                yield ("," if n else "") + json.dumps(record(k, v))
+            yield "]}}"
+
+        mimetype = "application/x-ndjson" if stream == "ndjson" else "application/json"
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+    if limit is None and cursor is None:
+        rows = (db.reference(path).get() or {}).items()
+        return safe_json_response("success", message, wrap_data(plural, [record(k, v) for k, v in rows]))
+
+    limit = max(1, min(limit or PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX))
+    rows, next_cursor = read_page(path, cursor, limit)
+    data = wrap_data(plural, [record(k, v) for k, v in rows])
+    data["next"] = next_cursor
+    return safe_json_response("success", message, data)
+
 # -----------------------------
 # 🔥 LOG REQUEST
 # -----------------------------
+# One access record per request, written after the response is built.
+# The raw body is read once and cached, so handlers do not parse it twice.
 @app.before_request
 def log_request_info():
-    if request.method in ["POST", "PUT"]:
-        try:
-            print(f"🔥 Incoming {request.path} JSON: {request.get_json(force=True)}")
-        except Exception:
-            print("❌ Failed to parse JSON for logging")
+    g.log_start = time.perf_counter()
+
+@app.after_request
+def log_request_done(response):
+    rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+    route = f"{request.method} {rule}"
+    # Sample before hashing the body, so requests that are dropped cost nothing
+    if log.isEnabledFor(logging.INFO) and sampled(route):
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "ms": round((time.perf_counter() - g.pop("log_start", time.perf_counter())) * 1000, 2),
+        }
+        if request.method in ("POST", "PUT"):
+            body = request.get_data(cache=True)
+            fields.update(body_digest(body))
+            if log.isEnabledFor(logging.DEBUG):
+                fields["body"] = body.decode("utf-8", "replace")
+        log.info("request", extra={"route": route, "fields": fields, "sampled": True})
+    return response
+
+# -----------------------------
+# 🔥 METRICS
+# -----------------------------
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        g.metrics_token = metrics.start_request(route, request.method)
+
+@app.after_request
+def finish_request_metrics(response):
+    token = g.pop("metrics_token", None)
+    if token is None:
+        return response
+    if not response.is_streamed:
+        metrics.finish_request(token, response.status_code)
+        return response
+    # after_request runs before a streamed body is generated: charge the
+    # body's reads to the route and time the request until it is closed
+    ctx = metrics.detach_request(token)
+    status = response.status_code
+    response.response = stream_in_request(response.response, ctx)
+    response.call_on_close(lambda: metrics.finish_detached(ctx, status))
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/traces", methods=["GET"])
+def get_metrics_traces():
+    return safe_json_response("success", "Slow request traces", {"traces": list(metrics.traces)})
 
 # -----------------------------
 # 🔥 BASIC ROUTE
@@ -67,6 +639,18 @@ def log_request_info():
 def check():
     return safe_json_response("success", "API running OK")
 
+@app.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    with cache_lock:
+        stats = dict(cache_stats, entries=len(path_cache))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hitRate"] = stats["hits"] / lookups if lookups else 0.0
+    with _inflight_lock:
+        flights = dict(single_flight_stats, inFlight=len(_inflight))
+    with email_lock:
+        emails = dict(email_stats, cached=len(email_cache))
+    return safe_json_response("success", "Cache stats", {"cache": stats, "singleFlight": flights, "emailLookup": emails})
+
 # -----------------------------
 # 🔥 USERS
 # -----------------------------
@@ -91,20 +675,155 @@ def create_user():
         except Exception as e:
             return safe_json_response("error", f"Firebase Auth error: {str(e)}", code=500)
 
-        email_key = email.replace(".", "_dot_").replace("@", "_at_")
+        key = email_key(email)
         db.reference(f"users/{uid}").set({
             "userId": uid,
             "name": name,
             "email": email,
             "mobileNo": mobileNo,
-            "groupIds": groupIds
+            "groupIds": {group_id: True for group_id in group_id_list(groupIds)}
         })
-        db.reference(f"usersAsEmailKey/{email_key}").set({"email": email_key, "userId": uid})
+        db.reference(f"usersAsEmailKey/{key}").set({"email": key, "userId": uid})
+        invalidate_paths(f"users/{uid}", f"usersAsEmailKey/{key}")
+        index_user_name(uid, name)
+        index_user_email(key, uid)
 
         return safe_json_response("success", "User created", {"userId": uid}, 201)
     except Exception:
         return safe_json_response("error", "Failed to create user", traceback.format_exc(), 500)
 
+# Bulk onboarding goes through auth.import_users instead of one
+# create_user call per user. Each call takes one chunk of up to
+# BULK_USERS_CHUNK users (Auth allows at most 1000), and that chunk's
+# users/ and usersAsEmailKey/ records then go out in a single root update.
+# Chunks run concurrently on fetch_pool. Passwords are hashed first with
+# PBKDF2-SHA256, and Auth rehashes them on each user's first sign-in.
+# Hashing is CPU work (tens of ms per user), so it runs on its own
+# HASH_WORKERS pool: a large import queues there instead of holding the
+# fetch threads every other request's reads need.
+BULK_USERS_MAX = int(os.environ.get("BULK_USERS_MAX", 5000))
+BULK_USERS_CHUNK = max(1, min(int(os.environ.get("BULK_USERS_CHUNK", 500)), 1000))
+BULK_USERS_HASH_ROUNDS = int(os.environ.get("BULK_USERS_HASH_ROUNDS", 10000))
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+
+def new_user_id():
+    """A 28 character uid, the length Auth gives the accounts it creates"""
+    return new_push_id()[-12:] + os.urandom(8).hex()
+
+def hash_password(password):
+    """(hash, salt) for an imported password; hashlib releases the GIL while it runs"""
+    salt = os.urandom(16).hex().encode("utf-8")
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, BULK_USERS_HASH_ROUNDS), salt
+
+def import_user_chunk(chunk):
+    """Create one chunk of (index, user, (hash, salt)) entries; {index: (uid, error)}"""
+    records = []
+    for _, user, (password_hash, salt) in chunk:
+        records.append(auth.ImportUserRecord(
+            uid=new_user_id(),
+            email=user["email"],
+            display_name=user["name"],
+            password_hash=password_hash,
+            password_salt=salt,
+        ))
+    try:
+        result = auth.import_users(records, hash_alg=auth.UserImportHash.pbkdf2_sha256(rounds=BULK_USERS_HASH_ROUNDS))
+    except Exception as e:
+        log.warning("user import failed", extra={"fields": {"users": len(chunk), "error": str(e)}})
+        return {index: (None, f"Firebase Auth error: {str(e)}") for index, _, _ in chunk}
+    failed = {error.index: error.reason for error in result.errors}
+
+    results = {}
+    updates = {}
+    created = []
+    for position, ((index, user, _), record) in enumerate(zip(chunk, records)):
+        if position in failed:
+            results[index] = (None, f"Firebase Auth error: {failed[position]}")
+            continue
+        key = email_key(user["email"])
+        updates[f"users/{record.uid}"] = {
+            "userId": record.uid,
+            "name": user["name"],
+            "email": user["email"],
+            "mobileNo": user.get("mobileNo", ""),
+            "groupIds": {group_id: True for group_id in group_id_list(user.get("groupIds", []))},
+        }
+        updates[f"usersAsEmailKey/{key}"] = {"email": key, "userId": record.uid}
+        created.append((index, user, record.uid, key))
+    if not updates:
+        return results
+    try:
+        db.reference().update(updates)
+    except Exception as e:
+        # The Auth accounts exist; the user can be recreated once removed there
+        log.warning("user records write failed", extra={"fields": {"users": len(created), "error": str(e)}})
+        results.update({index: (uid, "Failed to save user") for index, _, uid, _ in created})
+        return results
+    invalidate_paths(*updates)
+    for index, user, uid, key in created:
+        index_user_name(uid, user["name"])
+        index_user_email(key, uid)
+        results[index] = (uid, None)
+    return results
+
+@app.route("/users/bulk", methods=["POST"])
+def create_users_bulk():
+    """Create many users with one Auth import and one write per chunk.
+
+    Body: {"users": [{"name", "email", "password", "mobileNo"?,
+    "groupIds"?}, ...]}. The response has one result per user, in request
+    order: {"email", "userId", "status": "created"} or {"email",
+    "status": "error", "error": ...}.
+    """
+    try:
+        data = get_json_data()
+        users = data.get("users")
+        if not isinstance(users, list) or not users or not all(isinstance(u, dict) for u in users):
+            return safe_json_response("error", "users must be a non-empty list of objects", code=400)
+        if len(users) > BULK_USERS_MAX:
+            return safe_json_response("error", f"At most {BULK_USERS_MAX} users per request", code=400)
+
+        errors = {}
+        seen = set()
+        for index, user in enumerate(users):
+            name, email, password = user.get("name"), user.get("email"), user.get("password")
+            if not all(isinstance(v, str) and v for v in (name, email, password)):
+                errors[index] = "Missing required fields"
+            elif len(password) < 6:
+                # Auth checks this on create_user but not on import
+                errors[index] = "Password must be at least 6 characters"
+            elif email_key(email) in seen:
+                errors[index] = "Duplicate email in request"
+            else:
+                seen.add(email_key(email))
+        pending = [index for index in range(len(users)) if index not in errors]
+        existing = lookup_user_ids_by_email([users[index]["email"] for index in pending])
+        for index in pending:
+            if existing[users[index]["email"]] is not None:
+                errors[index] = "Email already exists"
+        pending = [index for index in pending if index not in errors]
+        hashed = hash_pool.map(hash_password, [users[index]["password"] for index in pending])
+        pending = [(index, users[index], password) for index, password in zip(pending, hashed)]
+
+        chunks = [pending[i:i + BULK_USERS_CHUNK] for i in range(0, len(pending), BULK_USERS_CHUNK)]
+        created = {}
+        for chunk_results in fan_out(import_user_chunk, chunks):
+            created.update(chunk_results)
+
+        results = []
+        for index, user in enumerate(users):
+            uid, error = created.get(index, (None, errors.get(index)))
+            email = user.get("email")
+            if error is None:
+                results.append({"email": email, "userId": uid, "status": "created"})
+            else:
+                results.append({"email": email, "userId": uid, "status": "error", "error": error})
+        count = sum(1 for r in results if r["status"] == "created")
+        return safe_json_response("success", f"{count} of {len(users)} users created", {"results": results})
+    except Exception:
+        return safe_json_response("error", "Failed to create users", traceback.format_exc(), 500)
+
 @app.route("/users/login", methods=["POST"])
 def login_user():
     try:
@@ -134,9 +853,7 @@ def logout_user():
 @app.route("/users", methods=["GET"])
 def get_users():
     try:
-        users = db.reference("users").get() or {}
-        result = [{**v, "userId": k} for k, v in users.items()]
-        return safe_json_response("success", "Users fetched", wrap_data("users", result))
+        return list_collection("users", "userId", "users", "Users fetched", view=user_view)
     except Exception:
         return safe_json_response("error", "Failed to fetch users", traceback.format_exc(), 500)
 
@@ -146,14 +863,11 @@ def get_user_groups():
         data = get_json_data()
         
         userId = data.get("userId") or data.get("value")
-        print(f"get user group data : :  {data}")
-        
-        user = db.reference(f"users/{userId}").get()
-        print(user)
+        user = read_path(f"users/{userId}")
         if not user:
             return safe_json_response("error", "User not found", code=404)
-        group_ids = user.get("groupIds") or []
-        print(group_ids)
+        group_ids = group_id_list(user.get("groupIds"))
+        log.debug("user groups", extra={"fields": {"userId": userId, "groupIds": group_ids}})
         return safe_json_response("success", "User groups fetched", wrap_data("groups", group_ids))
     except Exception:
         return safe_json_response("error", "Failed to fetch user groups", traceback.format_exc(), 500)
@@ -162,61 +876,485 @@ def get_user_groups():
 @app.route("/users/<userId>", methods=["GET"])
 def get_user_by_id(userId):
     try:
-        print(userId)
-        user = db.reference(f"users/{userId}").get()
-        print(user)
+        user = read_path(f"users/{userId}")
         if not user:
             return safe_json_response("error", "User not found", code=404)
         user["userId"] = userId
-        return safe_json_response("success", "User fetched", {"user": user})
+        return safe_json_response("success", "User fetched", {"user": user_view(user)})
     except Exception:
         return safe_json_response("error", "Failed to fetch user", traceback.format_exc(), 500)
+
+@app.route("/users/<userId>/balances", methods=["GET"])
+def get_user_balances(userId):
+    """A user's net balance in each group and across all of them.
+
+    Read from userBalances/<uid> alone, which the item and member writes
+    keep up to date; positive amounts are owed to the user. The totals
+    are summed here rather than stored, so that groups written at the
+    same time never contend on one counter.
+    """
+    try:
+        balances = read_path(f"userBalances/{userId}") or {}
+        if not balances and lookup_user_names([userId])[userId] is None:
+            return safe_json_response("error", "User not found", code=404)
+        amounts = [amount or 0 for amount in balances.values()]
+        return safe_json_response("success", "Balances fetched", {
+            "userId": userId,
+            "groups": balances,
+            "total": round(sum(amounts), 2),
+            "owed": round(sum(a for a in amounts if a > 0), 2),
+            "owes": round(-sum(a for a in amounts if a < 0), 2),
+        })
+    except Exception:
+        return safe_json_response("error", "Failed to fetch balances", traceback.format_exc(), 500)
     
 # -----------------------------
 # 🔥 ITEMS
 # -----------------------------
-def updateGraph(group_data,payerId,giveToM,giveAmt):
-    if(giveToM == payerId):
+# groupGraph storage: "dict" keeps the nested map of floats, "packed"
+# stores groupGraphPacked (sparse integer paise, see ledger.pack_cells).
+# Groups already stored packed stay packed whatever this is set to.
+GROUP_GRAPH_FORMAT = os.environ.get("GROUP_GRAPH_FORMAT", "dict")
+
+def is_packed(group_data):
+    return GROUP_GRAPH_FORMAT == "packed" or "groupGraphPacked" in group_data
+
+def group_graph(group_data, dense=False):
+    """groupGraph of a stored group in dict shape, whichever format it is stored in"""
+    if "groupGraphPacked" in group_data:
+        return unpack_graph(group_data["groupGraphPacked"], group_data.get("groupMembers") or [], dense)
+    return group_data.get("groupGraph")
+
+def apply_ledger(group_id, group_data, ledger, updates):
+    """Queue the groupBalances entries and groupGraph cells a ledger changed.
+
+    groupBalances holds each member's net balance and is the source of
+    truth; groupGraph is kept as the settlement view for older clients,
+    and userBalances/<uid>/<gid> copies each balance for the per-user
+    summary. group_data is updated in place to match what will be written.
+    """
+    balances = group_data.setdefault("groupBalances", {})
+    for uid, amount in ledger.changed_balances().items():
+        balances[uid] = amount
+        updates[f"groups/{group_id}/groupBalances/{uid}"] = amount
+        updates[f"userBalances/{uid}/{group_id}"] = amount
+    if is_packed(group_data):
+        # The packed view is small enough to rewrite whole
+        packed = ledger.packed_graph()
+        group_data["groupGraphPacked"] = packed
+        updates[f"groups/{group_id}/groupGraphPacked"] = packed
+        if group_data.pop("groupGraph", None) is not None:
+            updates[f"groups/{group_id}/groupGraph"] = None
         return
-    giveAmt = float(giveAmt) + group_data['groupGraph'][payerId][giveToM]
-    group_data['groupGraph'][payerId][giveToM] = 0
-    if(giveAmt==0): return             
-    for gM in group_data['groupMembers']:
-        if(giveAmt>0):
-            if(gM!=giveToM):
-                extrapayamt = group_data['groupGraph'][giveToM][gM]
-                furamt = min(giveAmt,extrapayamt)
-                if(gM == payerId):
-                    group_data['groupGraph'][giveToM][gM]-=furamt
-                else:
-                    group_data['groupGraph'][giveToM][gM]-=furamt
-                    group_data['groupGraph'][payerId][gM]+=furamt
-                    
-                giveAmt-=furamt
-    
-    for gM in group_data['groupMembers']:
-        if(giveAmt!=0):
-            if(gM!=payerId):
-
-                dueamt = group_data['groupGraph'][gM][payerId]
-                furamt = min(dueamt,giveAmt)
-                if(giveToM ==  gM):
-                    group_data['groupGraph'][gM][payerId]-=furamt
-                else:
-                    group_data['groupGraph'][gM][payerId]-=furamt
-                    group_data['groupGraph'][gM][giveToM]+=furamt
-        
-                giveAmt-=furamt
-    if(giveAmt>0):    
-        group_data['groupGraph'][payerId][giveToM]+=giveAmt
-                    
+    graph = group_data.setdefault("groupGraph", {})
+    for (a, b), amount in ledger.graph_changes(graph).items():
+        graph.setdefault(a, {})[b] = amount
+        updates[f"groups/{group_id}/groupGraph/{a}/{b}"] = amount
+
+ITEM_REQUIRED_FIELDS = (
+    "itemName", "itemDateUpdate", "itemTimeUpdate", "itemTotalAmount",
+    "itemPayer", "itemSpliter", "itemSpliterValue", "itemGroupId",
+)
+
+def item_error(item):
+    """Why an item cannot be applied, or None if it is well formed"""
+    if not isinstance(item, dict):
+        return "item must be an object"
+    for key in ITEM_REQUIRED_FIELDS:
+        if key not in item:
+            return f"Missing field: {key}"
+    return ledger_item_error(item)
+
+def ledger_item_error(item):
+    """Why the ledger cannot apply or reverse an item, or None"""
+    if not isinstance(item.get("itemPayer"), list) or not item["itemPayer"]:
+        return "itemPayer is empty"
+    spliter, values = item.get("itemSpliter", []), item.get("itemSpliterValue", [])
+    if not isinstance(spliter, list) or not isinstance(values, list) or len(spliter) != len(values):
+        return "itemSpliter and itemSpliterValue differ in length"
+    try:
+        [float(v) for v in values]
+    except (TypeError, ValueError):
+        return "itemSpliterValue must be numbers"
+    return None
+
+# groups/<gid>/groupItemIndex maps itemId -> item_sort_key, so adding or
+# removing an item is one path write and a group's items can be read by
+# date range straight from the database. RTDB needs
+# ".indexOn": ".value" on groups/$groupId/groupItemIndex for that query;
+# without it we fall back to filtering the index here. Groups written
+# before the index keep their groupItems list until
+# `python manage.py migrate-item-index` folds it in; both are read.
+ITEM_DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%Y/%m/%d")
+
+def item_sort_key(item):
+    """Index key "<YYYY-MM-DD>T<time>|<itemId>": by date, then time, then id"""
+    date = str(item.get("itemDateUpdate") or "")
+    for fmt in ITEM_DATE_FORMATS:
+        try:
+            date = datetime.strptime(date, fmt).strftime("%Y-%m-%d")
+            break
+        except ValueError:
+            pass
+    at = str(item.get("itemTimeUpdate") or "")
+    if at[1:2] == ":":
+        at = "0" + at
+    return f"{date}T{at}|{item['itemId']}"
+
+def group_item_ids(group_data):
+    """Item ids of a group: legacy groupItems entries first, then the index by date"""
+    index = group_data.get("groupItemIndex") or {}
+    legacy = [i for i in group_data.get("groupItems") or [] if i and i not in index]
+    return legacy + sorted(index, key=index.get)
+
+def select_item_keys(rows, start=None, end=None, limit=None, cursor=None):
+    """One page of (itemId, sort key) rows, oldest first.
+
+    start and end are inclusive YYYY-MM-DD dates. limit keeps the newest
+    rows in range; cursor, the key of the oldest row of the previous page,
+    continues with older ones. Returns (rows, next cursor or None).
+    """
+    rows = sorted(rows, key=lambda row: row[1])
+    if start:
+        rows = [row for row in rows if row[1] >= start]
+    if end:
+        rows = [row for row in rows if row[1] <= end + "\uf8ff"]
+    if cursor:
+        rows = [row for row in rows if row[1] < cursor]
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[-limit:]
+    return rows, rows[0][1]
+
+def query_item_index(group_id, start=None, end=None, limit=None, cursor=None):
+    """(itemId, sort key) rows of a group's index, bounded by the database query"""
+    path = f"groups/{group_id}/groupItemIndex"
+    query = db.reference(path).order_by_value()
+    if start:
+        query = query.start_at(start)
+    upper = min(filter(None, (cursor, end and end + "\uf8ff")), default=None)
+    if upper:
+        query = query.end_at(upper)
+    if limit:
+        # One extra row tells us whether there is another page, one more
+        # covers the cursor row itself
+        query = query.limit_to_last(limit + (2 if cursor else 1))
+    try:
+        return list((query.get() or {}).items())
+    except Exception as e:
+        log.warning("item index query failed, filtering locally", extra={"fields": {"path": path, "error": str(e)}})
+        return list((read_path(path) or {}).items())
+
+def iter_item_index(group_id, page_size=PAGE_SIZE_DEFAULT):
+    """Every (itemId, sort key) row of a group's index, oldest first, a page at a time"""
+    path = f"groups/{group_id}/groupItemIndex"
+    after = None
+    while True:
+        query = db.reference(path).order_by_value()
+        if after is not None:
+            # start_at is inclusive: one extra row covers the last one sent
+            query = query.start_at(after)
+        try:
+            rows = sorted((query.limit_to_first(page_size + (after is not None)).get() or {}).items(),
+                          key=lambda row: row[1])
+        except Exception as e:
+            if after is not None:
+                raise
+            log.warning("item index query failed, reading it whole", extra={"fields": {"path": path, "error": str(e)}})
+            yield from sorted((db.reference(path).get() or {}).items(), key=lambda row: row[1])
+            return
+        if after is not None:
+            rows = [row for row in rows if row[1] > after]
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1][1]
+
+def group_view(group):
+    """A stored group as the API returns it, with the groupItems list and
+    dense groupGraph clients expect, whichever format it is stored in"""
+    group = dict(group, groupItems=group_item_ids(group))
+    group.pop("groupItemIndex", None)
+    if "groupGraphPacked" in group:
+        group["groupGraph"] = group_graph(group, dense=True)
+        del group["groupGraphPacked"]
+    return group
+
+def stage_new_item(group_id, group_data, ledger, item, updates):
+    """Add a new item to an in-memory group and queue its paths in updates"""
+    ledger.apply_item(item["itemPayer"][0], item["itemSpliter"], item["itemSpliterValue"])
+    key = item_sort_key(item)
+    group_data.setdefault("groupItemIndex", {})[item["itemId"]] = key
+    updates[f"items/{item['itemId']}"] = item
+    updates[f"groups/{group_id}/groupItemIndex/{item['itemId']}"] = key
+
+def stage_new_member(group_id, group, member_id, updates):
+    """Add a member to an in-memory group and queue its paths in updates.
+
+    Returns False if the user was a member already; any graph cells they
+    were missing are filled in either way.
+    """
+    prefix = f"groups/{group_id}"
+    # The member's side of the link goes out in the same write
+    updates[f"users/{member_id}/groupIds/{group_id}"] = True
+
+    # Ensure groupMembers exists
+    group.setdefault("groupMembers", [])
+
+    # Add member if not already inside
+    added = member_id not in group["groupMembers"]
+    if added:
+        group["groupMembers"].append(member_id)
+        updates[f"{prefix}/groupMembers/{len(group['groupMembers']) - 1}"] = member_id
+        updates[f"userBalances/{member_id}/{group_id}"] = (group.get("groupBalances") or {}).get(member_id, 0)
+
+    if is_packed(group):
+        # Packed graphs are sparse: a new member has no cells to fill in
+        if "groupGraph" in group:
+            group["groupGraphPacked"] = pack_graph(group.pop("groupGraph"), group["groupMembers"])
+            updates[f"{prefix}/groupGraphPacked"] = group["groupGraphPacked"]
+            updates[f"{prefix}/groupGraph"] = None
+        return added
+
+    # Ensure groupGraph exists
+    group.setdefault("groupGraph", {})
+    group["groupGraph"].setdefault(member_id, {})
+
+    # Build graph, writing only the cells that are missing
+    for gm in group["groupMembers"]:
+        if gm == member_id:
+            continue
+        group["groupGraph"].setdefault(gm, {})
+        for a, b in ((gm, member_id), (member_id, gm)):
+            if b not in group["groupGraph"][a]:
+                group["groupGraph"][a][b] = 0
+                updates[f"{prefix}/groupGraph/{a}/{b}"] = 0
+    return added
+
+def commit_group_updates(group_id, group_data, updates):
+    """Write a group mutation as one atomic multi-path update at the root.
+
+    updates holds only the paths the mutation changed; the cached copy of
+    the group is replaced with group_data and every other path is dropped.
+    """
+    if updates:
+        db.reference().update(updates)
+    group_path = f"groups/{group_id}"
+    invalidate_paths(*(p for p in updates if p != group_path and not p.startswith(group_path + "/")))
+    refresh_path(group_path, group_data)
+
+# -----------------------------
+# 🔥 CHANGE LOG
+# -----------------------------
+# Every saved group mutation bumps groups/<gid>/groupRev and, in the same
+# write, records what it touched under changeLog/<gid>/<rev_key(rev)>:
+# the ids of the items (with "added", "updated" or "deleted"), users,
+# members added, balances and graph cells, not their values.
+# GET /sync reads the log to send clients only what changed. Each write
+# also drops the entry CHANGELOG_KEEP revisions back, so a group keeps at
+# most that many; a client further behind gets the whole group again.
+# Deleting a group deletes its log.
+CHANGELOG_KEEP = int(os.environ.get("CHANGELOG_KEEP", 500))
+
+def rev_key(rev):
+    """Log key of a revision; the prefix keeps keys sorted as strings and out of list shape"""
+    return f"r{rev:012d}"
+
+def known_item_ids(group_data):
+    """Ids of the items a stored group holds, before a mutation changes it"""
+    if not group_data:
+        return set()
+    return set(group_data.get("groupItemIndex") or {}) | set(group_data.get("groupItems") or [])
+
+def change_entry(group_id, updates, known_items=()):
+    """What a group mutation's updates touched, as {kind: {id: value}} plus flags.
+
+    known_items are the group's item ids before the mutation, which tell
+    an added item from an updated one.
+    """
+    group_path = f"groups/{group_id}"
+    entry = {}
+
+    def touched(kind, key, value=True):
+        entry.setdefault(kind, {})[key] = value
+
+    for path, value in updates.items():
+        parts = path.split("/")
+        if parts[0] == "items" and len(parts) == 2:
+            op = "deleted" if value is None else "updated" if parts[1] in known_items else "added"
+            touched("items", parts[1], op)
+        elif parts[0] == "users" and len(parts) > 1:
+            touched("users", parts[1])
+        elif path == group_path:
+            entry["group"] = True
+        elif path.startswith(group_path + "/"):
+            field = parts[2:]
+            if field[0] == "groupItemIndex" and len(field) > 1:
+                entry.setdefault("items", {}).setdefault(field[1], "updated")
+            elif field[0] == "groupBalances" and len(field) > 1:
+                touched("balances", field[1])
+            elif field[0] == "groupGraph" and len(field) > 2:
+                touched("cells", f"{field[1]}|{field[2]}")
+            elif field[0] in ("groupGraph", "groupGraphPacked", "groupBalances"):
+                entry["graph"] = True
+            elif field[0] != "groupRev":
+                entry["group"] = True
+                if field[0] == "groupMembers" and isinstance(value, str):
+                    touched("users", value)
+                    touched("members", value)
+    return entry
+
+def stamp_revision(group_id, group_data, updates, known_items=()):
+    """Add the next revision and its log entry to a group mutation's updates.
+
+    Returns (rev, entry), or None when nothing was logged.
+    """
+    if not updates or group_data is None:
+        return None
+    if not group_data:
+        # The group was deleted: its log goes with it
+        updates[f"changeLog/{group_id}"] = None
+        return None
+    entry = change_entry(group_id, updates, known_items)
+    if not entry:
+        return None  # nothing clients can see, e.g. only userBalances rewritten
+    entry["at"] = int(time.time() * 1000)
+    rev = (group_data.get("groupRev") or 0) + 1
+    group_data["groupRev"] = rev
+    group_path = f"groups/{group_id}"
+    if group_path not in updates:
+        updates[f"{group_path}/groupRev"] = rev
+    updates[f"changeLog/{group_id}/{rev_key(rev)}"] = entry
+    if rev > CHANGELOG_KEEP:
+        updates[f"changeLog/{group_id}/{rev_key(rev - CHANGELOG_KEEP)}"] = None
+    return rev, entry
+
+# -----------------------------
+# 🔥 GROUP WRITE SERIALIZER
+# -----------------------------
+# Every mutation of a group goes through submit_group_mutation. Mutations
+# of one group run one batch at a time, in order; mutations that queue up
+# while a batch is being written are applied together and saved with a
+# single write. Different groups are handled in parallel by
+# GROUP_WRITE_WORKERS threads.
+#
+# GROUP_WRITE_MODE=local serializes inside this process only. Use
+# "transaction" when several processes write the same groups: the group
+# is then saved with an RTDB transaction that retries on conflict. That
+# transaction sends the whole groups/<gid> node (graph and item index
+# included) on every batch instead of the changed paths, and logs the
+# revision in a second write, so serve.py runs one worker unless told
+# otherwise.
+GROUP_WRITE_MODE = os.environ.get("GROUP_WRITE_MODE", "local")
+GROUP_WRITE_WORKERS = int(os.environ.get("GROUP_WRITE_WORKERS", 8))
+group_write_pool = ThreadPoolExecutor(max_workers=GROUP_WRITE_WORKERS, thread_name_prefix="group-write")
+_group_queues = {}
+_group_queues_lock = threading.Lock()
+group_write_stats = {"mutations": 0, "writes": 0}
+
+def submit_group_mutation(group_id, mutation):
+    """Apply mutation(group_data, updates) to a group and wait for it to be saved.
+
+    group_data is the group as stored (None if it does not exist) and may
+    be changed in place; updates collects the root-level paths to write.
+    A mutation signals failure by raising before it changes anything, so
+    the other mutations in its batch are unaffected. Returns the value
+    the mutation returned once the batch holding it has been written.
+    """
+    future = Future()
+    with _group_queues_lock:
+        group_write_stats["mutations"] += 1
+        queue = _group_queues.get(group_id)
+        if queue is None:
+            _group_queues[group_id] = [(mutation, future)]
+            # The batch's backend calls are charged to the request that started it
+            group_write_pool.submit(bind_context(_drain_group), group_id)
+        else:
+            queue.append((mutation, future))
+    return future.result()
+
+def _drain_group(group_id):
+    while True:
+        with _group_queues_lock:
+            batch = _group_queues[group_id]
+            if not batch:
+                del _group_queues[group_id]
+                return
+            _group_queues[group_id] = []
+        try:
+            if GROUP_WRITE_MODE == "transaction":
+                _write_batch_transaction(group_id, batch)
+            else:
+                _write_batch_local(group_id, batch)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+def _apply_batch(group_data, batch, updates):
+    """Run a batch of mutations against one copy of the group"""
+    outcomes = []
+    for mutation, future in batch:
+        try:
+            outcomes.append((future, True, mutation(group_data, updates)))
+        except Exception as e:
+            outcomes.append((future, False, e))
+    return outcomes
+
+def _resolve(outcomes):
+    for future, ok, value in outcomes:
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+def _write_batch_local(group_id, batch):
+    group_data = db.reference(f"groups/{group_id}").get()
+    updates = {}
+    existed, known = bool(group_data), known_item_ids(group_data)
+    outcomes = _apply_batch(group_data, batch, updates)
+    change = stamp_revision(group_id, group_data, updates, known)
+    if updates:
+        commit_group_updates(group_id, group_data, updates)
+        with _group_queues_lock:
+            group_write_stats["writes"] += 1
+    _resolve(outcomes)
+    publish_group_change(group_id, existed, group_data, updates, change)
+
+def _write_batch_transaction(group_id, batch):
+    group_path = f"groups/{group_id}"
+    attempt = {}
+
+    def transaction_update(current):
+        # May run several times; only the last attempt's results are kept
+        group_data = copy.deepcopy(current)
+        updates = {}
+        attempt["existed"], known = bool(group_data), known_item_ids(group_data)
+        attempt["outcomes"] = _apply_batch(group_data, batch, updates)
+        # The revision is counted inside the transaction, so it stays
+        # sequential across processes
+        attempt["change"] = stamp_revision(group_id, group_data, updates, known)
+        attempt["updates"] = updates
+        attempt["group"] = group_data
+        return group_data
+
+    db.reference(group_path).transaction(transaction_update)
+    others = {p: v for p, v in attempt["updates"].items()
+              if p != group_path and not p.startswith(group_path + "/")}
+    if others:
+        db.reference().update(others)
+    invalidate_paths(*others)
+    refresh_path(group_path, attempt["group"])
+    with _group_queues_lock:
+        group_write_stats["writes"] += 1
+    _resolve(attempt["outcomes"])
+    publish_group_change(group_id, attempt["existed"], attempt["group"], attempt["updates"], attempt["change"])
+
 
 @app.route("/items", methods=["GET"])
 def get_items():
     try:
-        items = db.reference("items").get() or {}
-        result = [{**v, "itemId": k} for k, v in items.items()]
-        return safe_json_response("success", "Items fetched", wrap_data("items", result))
+        return list_collection("items", "itemId", "items", "Items fetched")
     except Exception:
         return safe_json_response("error", "Failed to fetch items", traceback.format_exc(), 500)
 
@@ -235,30 +1373,45 @@ def delete_item():
             return safe_json_response("error", "Item not found", code=404)
 
         groupId = item.get("itemGroupId")
-        if groupId:
-            group_ref = db.reference(f"groups/{groupId}")
-            group = group_ref.get() or {}
-
-            # Only update groupGraph if it exists
-            if "groupGraph" in group:
-                payerId = item["itemPayer"][0]  # assuming first payer
-                spliterList = item.get("itemSpliter", [])
-                spliterValue = item.get("itemSpliterValue", [])
-
-                for i in range(len(spliterList)):
-                    receiverId = spliterList[i]
-                    giveAmt = spliterValue[i]
-                    updateGraph(group,receiverId,payerId,giveAmt)
-                    
-            # Remove item from group's item list
-            if "groupItems" in group and itemId in group["groupItems"]:
-                group["groupItems"].remove(itemId)
-
-            # Save updated group
-            group_ref.set(group)
-
-        # Delete item from items collection
-        item_ref.delete()
+        if not groupId:
+            item_ref.delete()
+            invalidate_paths(f"items/{itemId}")
+            return safe_json_response("success", "Item deleted")
+        # An item the ledger cannot reverse is left in place, balances intact
+        error = ledger_item_error(item)
+        if error:
+            return safe_json_response("error", f"Item cannot be deleted: {error}; fix it with /items/update-item first", code=400)
+
+        def remove_item(group, updates):
+            index = (group or {}).get("groupItemIndex") or {}
+            groupItems = (group or {}).get("groupItems") or []
+            # Not listed any more: a concurrent delete already reversed it
+            if itemId not in index and itemId not in groupItems:
+                updates[f"items/{itemId}"] = None
+                return
+
+            # Only update balances if the group tracks them. The reversal
+            # can raise, so it runs before anything is staged
+            if "groupGraph" in group or "groupGraphPacked" in group or "groupBalances" in group:
+                ledger = Ledger.from_group(group)
+                ledger.apply_item(item["itemPayer"][0], item.get("itemSpliter", []),
+                                  item.get("itemSpliterValue", []), sign=-1)
+                apply_ledger(groupId, group, ledger, updates)
+
+            if itemId in index:
+                del index[itemId]
+                updates[f"groups/{groupId}/groupItemIndex/{itemId}"] = None
+            else:
+                # Legacy list: entries after the item shift down
+                position = groupItems.index(itemId)
+                groupItems.remove(itemId)
+                for i in range(position, len(groupItems)):
+                    updates[f"groups/{groupId}/groupItems/{i}"] = groupItems[i]
+                updates[f"groups/{groupId}/groupItems/{len(groupItems)}"] = None
+            updates[f"items/{itemId}"] = None
+
+        # Save the changed group paths and delete the item together
+        submit_group_mutation(groupId, remove_item)
 
         return safe_json_response("success", "Item deleted")
 
@@ -271,86 +1424,86 @@ def delete_item():
 @app.route("/items/create",methods=["POST"])
 def create_item():
     data = request.get_json()
-    doc_ref = db.reference("items")
     item_dict = dict(data)
-    if('itemName' in item_dict and
-       'itemDateUpdate' in item_dict and
-       'itemTimeUpdate' in item_dict and
-       'itemTotalAmount' in item_dict and
-       'itemPayer' in item_dict and
-       'itemSpliter' in item_dict and
-       'itemSpliterValue' in item_dict and
-       'itemGroupId' in item_dict):
-        new_doc_ref = doc_ref.push()
-        data["itemId"] = new_doc_ref.key
-        
-        
-        
+    if all(key in item_dict for key in ITEM_REQUIRED_FIELDS):
+        error = item_error(data)
+        if error:
+            return error,400
+        data["itemId"] = new_push_id()
         group_id = data["itemGroupId"]
-        group_ref = db.reference("groups").child(group_id)
-        group_data = group_ref.get()
-        if(group_data is not None):    
-            if('groupItems' not in group_data):
-                group_data['groupItems'] = []
-            group_data["groupItems"].append(data["itemId"])
-            
-            
+
+        def add_item(group_data, updates):
+            if not group_data:
+                return False
             # balance group graph
-            payerId = data["itemPayer"][0]
-            spliterList = data['itemSpliter']
-            splitervalue = data['itemSpliterValue']
-            totalamount = data['itemTotalAmount']
-            
-            for i in range(0,len(spliterList)):
-                giveToM = data['itemSpliter'][i]
-                giveAmt = float(data['itemSpliterValue'][i])
-                updateGraph(group_data,payerId,giveToM,giveAmt)
-                '''
-                if(giveToM == payerId):
-                    continue
-                
-                
-                giveAmt = giveAmt + group_data['groupGraph'][payerId][giveToM]
-                group_data['groupGraph'][payerId][giveToM] = 0
-                
-                if(giveAmt==0): continue
-                for gM in group_data['groupMembers']:
-                    if(giveAmt>0):
-                        if(gM!=giveToM):
-                            extrapayamt = group_data['groupGraph'][giveToM][gM]
-                            furamt = min(giveAmt,extrapayamt)
-                            if(gM == payerId):
-                                group_data['groupGraph'][giveToM][gM]-=furamt
-                            else:
-                                group_data['groupGraph'][giveToM][gM]-=furamt
-                                group_data['groupGraph'][payerId][gM]+=furamt
-                                
-                            giveAmt-=furamt
-                        
-                
-                for gM in group_data['groupMembers']:
-                    if(giveAmt!=0):
-                        if(gM!=payerId):
-
-                            dueamt = group_data['groupGraph'][gM][payerId]
-                            furamt = min(dueamt,giveAmt)
-                            if(giveToM ==  gM):
-                                group_data['groupGraph'][gM][payerId]-=furamt
-                            else:
-                                group_data['groupGraph'][gM][payerId]-=furamt
-                                group_data['groupGraph'][gM][giveToM]+=furamt
-                    
-                            giveAmt-=furamt
-                if(giveAmt>0):
-                    group_data['groupGraph'][payerId][giveToM]+=giveAmt
-                '''  
-        
-        group_ref.set(group_data)
-        new_doc_ref.set(data)
+            ledger = Ledger.from_group(group_data)
+            stage_new_item(group_id, group_data, ledger, data, updates)
+            apply_ledger(group_id, group_data, ledger, updates)
+            return True
+
+        # Item, its index entry and the changed balances in one write
+        if not submit_group_mutation(group_id, add_item):
+            db.reference(f"items/{data['itemId']}").set(data)
+        refresh_path(f"items/{data['itemId']}", data)
         return "item created",201
     else:
         return "item key wrong",404
     
+@app.route("/items/batch", methods=["POST"])
+def create_items_batch():
+    """Create many items with one read and one multi-path write per group.
+
+    Body: {"items": [...]} (or a bare list). Items are applied to their
+    group in the order given; the response has one result per item.
+    """
+    try:
+        data = get_json_data()
+        items = data.get("items") if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return safe_json_response("error", "items must be a non-empty list", code=400)
+
+        results = [None] * len(items)
+        by_group = {}
+        for index, item in enumerate(items):
+            error = item_error(item)
+            if error:
+                results[index] = {"index": index, "status": "error", "message": error}
+            else:
+                by_group.setdefault(item["itemGroupId"], []).append(index)
+
+        def commit_group(group_id):
+            indexes = by_group[group_id]
+
+            def add_items(group_data, updates):
+                if not group_data:
+                    return None
+                ledger = Ledger.from_group(group_data)
+                staged = []
+                for i in indexes:
+                    item = dict(items[i], itemId=new_push_id())
+                    stage_new_item(group_id, group_data, ledger, item, updates)
+                    staged.append((i, item))
+                apply_ledger(group_id, group_data, ledger, updates)
+                return staged
+
+            try:
+                staged = submit_group_mutation(group_id, add_items)
+            except Exception as e:
+                return [{"index": i, "status": "error", "message": f"Write failed: {e}"} for i in indexes]
+            if staged is None:
+                return [{"index": i, "status": "error", "message": "Group not found"} for i in indexes]
+            refresh_paths({f"items/{item['itemId']}": item for _, item in staged})
+            return [{"index": i, "status": "success", "itemId": item["itemId"]} for i, item in staged]
+
+        for group_results in fan_out(commit_group, by_group):
+            for result in group_results:
+                results[result["index"]] = result
+
+        created = sum(1 for r in results if r["status"] == "success")
+        return safe_json_response("success", f"{created} of {len(items)} items created", {"results": results})
+    except Exception:
+        return safe_json_response("error", "Failed to create items", traceback.format_exc(), 500)
+
 # @app.route("/items/create", methods=["POST"])
 # def create_item():
 #     try:
@@ -405,10 +1558,26 @@ def update_item():
         if not item:
             return safe_json_response("error", "Item not found", code=404)
 
+        old_key = item_sort_key(dict(item, itemId=itemId))
         for k, v in data.items():
             if k != "itemId":
                 item[k] = v
-        item_ref.update(item)
+
+        key = item_sort_key(dict(item, itemId=itemId))
+        group_id = item.get("itemGroupId")
+        if group_id:
+            # Saved through the group so the change gets a revision
+            def save_item(group, updates):
+                updates[f"items/{itemId}"] = item
+                # A new date or time moves the item in its group's index
+                index = (group or {}).get("groupItemIndex") or {}
+                if key != old_key and itemId in index:
+                    index[itemId] = key
+                    updates[f"groups/{group_id}/groupItemIndex/{itemId}"] = key
+            submit_group_mutation(group_id, save_item)
+        else:
+            item_ref.update(item)
+        refresh_path(f"items/{itemId}", item)
         return safe_json_response("success", "Item updated", {"item": item})
     except Exception:
         return safe_json_response("error", "Failed to update item", traceback.format_exc(), 500)
@@ -421,13 +1590,7 @@ def update_item():
 @app.route("/groups", methods=["GET"])
 def get_groups():
     try:
-        groups = db.reference("groups").get() or {}
-        result = []
-        for k, v in groups.items():
-            group = v.copy()
-            group["groupId"] = k
-            result.append(group)
-        return safe_json_response("success", "Groups fetched", wrap_data("groups", result))
+        return list_collection("groups", "groupId", "groups", "Groups fetched", view=group_view)
     except Exception:
         return safe_json_response("error", "Failed to fetch groups", traceback.format_exc(), 500)
 
@@ -439,19 +1602,22 @@ def create_group():
         if not members or not isinstance(members, list):
             return safe_json_response("error", "groupMembers must be a non-empty list", 400)
 
-        group_ref = db.reference("groups").push()
-        data["groupId"] = group_ref.key
-        group_ref.set(data)
+        data["groupId"] = new_push_id()
 
-        # Update user references
-        for userId in members:
-            user_ref = db.reference(f"users/{userId}")
-            user = user_ref.get()
-            if user:
-                user.setdefault("groupIds", [])
-                safe_append(user["groupIds"], data["groupId"])
-                user_ref.update({"groupIds": user["groupIds"]})
+        # Only existing users are linked; names are usually cached already
+        names = lookup_user_names(members)
+        linked = [userId for userId in dict.fromkeys(members) if names.get(userId) is not None]
 
+        # The group and every member's groupIds in one atomic write
+        updates = {f"groups/{data['groupId']}": data}
+        for userId in linked:
+            updates[f"users/{userId}/groupIds/{data['groupId']}"] = True
+            updates[f"userBalances/{userId}/{data['groupId']}"] = 0
+        stamp_revision(data["groupId"], data, updates)
+        db.reference().update(updates)
+
+        refresh_path(f"groups/{data['groupId']}", data)
+        invalidate_paths(*(f"users/{userId}" for userId in linked))
         return safe_json_response("success", "Group created", {"group": data}, 201)
     except Exception:
         return safe_json_response("error", "Failed to create group", traceback.format_exc(), 500)
@@ -460,31 +1626,138 @@ def create_group():
 def get_group_by_id():
     data = get_json_data()
     groupId = data.get("groupId") or data.get("value")
-    group = db.reference(f"groups/{groupId}").get()
-    print(group)
+    group = read_path(f"groups/{groupId}")
     if not group:
         return safe_json_response("error", "Group not found", code=404)
     group["groupId"] = groupId
-    print(group)
-    return safe_json_response("success", "Group fetched", {"group": group})
+    return safe_json_response("success", "Group fetched", {"group": group_view(group)})
 
 
 @app.route("/groups/membersDetail",methods=["POST"])
 def get_group_members_detail():
     try:
         group_id = request.get_json()
-        users = []
-        users_data = db.reference('users').get()
-        for user_id in db.reference(f"groups").get()[group_id]['groupMembers']:
-            users.append(users_data[user_id])
+        group = read_path(f"groups/{group_id}")
+        if not group:
+            return f"Group member detail Error : group {group_id} not found",404
+        # One read per member, concurrently, instead of the whole users tree
+        members = group.get("groupMembers") or []
+        users = [user for user in fetch_many(f"users/{uid}" for uid in members) if user]
         return jsonify(users),200
     except Exception as e:
         return f"Group member detail Error : {e}",404
     
+@app.route("/groups/<groupId>/settlements", methods=["GET"])
+def get_group_settlements(groupId):
+    try:
+        group = read_path(f"groups/{groupId}")
+        if not group:
+            return safe_json_response("error", "Group not found", code=404)
+        settlements = [
+            {"from": debtor, "to": creditor, "amount": amount}
+            for debtor, creditor, amount in Ledger.from_group(group).settlements()
+        ]
+        return safe_json_response("success", "Settlements computed", wrap_data("settlements", settlements))
+    except Exception:
+        return safe_json_response("error", "Failed to compute settlements", traceback.format_exc(), 500)
+
+EXPORT_CSV_FIELDS = (
+    "itemId", "itemName", "itemDateUpdate", "itemTimeUpdate", "itemTotalAmount",
+    "itemPayer", "itemSpliter", "itemSpliterValue",
+)
+
+def export_csv_row(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+def export_csv_item(item):
+    values = []
+    for key in EXPORT_CSV_FIELDS:
+        value = item.get(key, "")
+        values.append(";".join(map(str, value)) if isinstance(value, list) else value)
+    return export_csv_row(values)
+
+@app.route("/groups/<groupId>/export", methods=["GET"])
+def export_group(groupId):
+    """A group's items, oldest first, then every member's balance.
+
+    ?format=ndjson (default) sends one {"type": "item"} object per line
+    followed by {"type": "balance"} lines. ?format=csv sends the items
+    table, a blank line, then a userId,name,balance table; list fields
+    are joined with ";". Items are read and sent a page at a time, so
+    memory does not grow with the group and the first bytes go out after
+    one page. Balances are read after the last item.
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        return safe_json_response("error", "format must be csv or ndjson", code=400)
+    page_size = max(1, min(request.args.get("pageSize", PAGE_SIZE_DEFAULT, type=int), PAGE_SIZE_MAX))
+    try:
+        legacy = read_path(f"groups/{groupId}/groupItems") or []
+        if not legacy and not db.reference(f"groups/{groupId}").get(shallow=True):
+            return safe_json_response("error", "Group not found", code=404)
+    except Exception:
+        return safe_json_response("error", "Failed to export group", traceback.format_exc(), 500)
+
+    def item_pages():
+        # Legacy list entries first, then the index by date, as group_item_ids orders them
+        page = []
+        for item_id in legacy:
+            if item_id:
+                page.append(item_id)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        listed = set(legacy)
+        for item_id, _ in iter_item_index(groupId, page_size):
+            if item_id not in listed:
+                page.append(item_id)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def generate():
+        if fmt == "csv":
+            yield export_csv_row(EXPORT_CSV_FIELDS)
+        for page in item_pages():
+            # Read past the cache so an export does not evict the hot entries
+            chunk = []
+            for item_id, item in zip(page, read_fresh(f"items/{i}" for i in page)):
+                if not item:
+                    continue
+                item = dict(item, itemId=item_id)
+                if fmt == "csv":
+                    chunk.append(export_csv_item(item))
+                else:
+                    chunk.append(json.dumps({"type": "item", **item}) + "\n")
+            yield "".join(chunk)
+
+        # Only the ledger fields: the whole group would drag the item index in
+        fields = ("groupMembers", "groupBalances", "groupGraphPacked", "groupGraph")
+        group = {key: value for key, value in zip(fields, read_fresh(f"groups/{groupId}/{f}" for f in fields))
+                 if value is not None}
+        balances = Ledger.from_group(group).balances() if group else {}
+        names = get_user_names(balances)
+        if fmt == "csv":
+            yield "\n" + export_csv_row(("userId", "name", "balance")) + "".join(
+                export_csv_row((uid, names[uid], amount)) for uid, amount in balances.items())
+        else:
+            yield "".join(json.dumps({"type": "balance", "userId": uid, "name": names[uid], "balance": amount}) + "\n"
+                          for uid, amount in balances.items())
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(generate(), mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="group-{groupId}.{fmt}"',
+        "X-Accel-Buffering": "no",
+    })
+
 @app.route("/groups/members/<groupId>", methods=["GET"])
 def get_group_members(groupId):
     try:
-        group = db.reference(f"groups/{groupId}").get()
+        group = read_path(f"groups/{groupId}")
         if not group:
             return safe_json_response("error", "Group not found", code=404)
         members = group.get("groupMembers") or []
@@ -499,51 +1772,42 @@ def get_group_expense_detail():
         # Read raw body
         group_id = request.get_data(as_text=True).strip()
 
-        print("🔥 Raw incoming:", group_id)
-
         # Remove extra quotes:  '"abc123"' → abc123
         group_id = group_id.strip('"')
 
-        print("✅ Clean groupId:", group_id)
-
-        # Fetch group info
-        group_ref = db.reference("groups").child(group_id)
-        group_data = group_ref.get()
-
-        if group_data is None or "groupGraph" not in group_data:
-            return jsonify({"expenseDetail": []}), 200
-
-        graph = group_data["groupGraph"]
-
-        # -------------------------
-        #  FETCH ALL USERS NAMES
-        # -------------------------
-        users_ref = db.reference("users")
-        users = users_ref.get() or {}  # all users
-
-        def get_name(uid):
-            return users.get(uid, {}).get("name", uid)  # fallback to UID if missing
-
-        expense_lines = []
-
-        # -------------------------
-        # BUILD RESULT
-        # -------------------------
-        for payer_id, receivers in graph.items():
-            payer_name = get_name(payer_id)
-
-            for receiver_id, amount in receivers.items():
-                if amount > 0:
-                    receiver_name = get_name(receiver_id)
-
-                    expense_lines.append(
-                        f"{payer_name} get back from {receiver_name}: ₹{amount}"
-                    )
-
+        def build():
+            # Fetch group info
+            group_data = read_path(f"groups/{group_id}")
+
+            graph = group_graph(group_data) if group_data else None
+            if not graph:
+                return []
+
+            # -------------------------
+            #  FETCH NAMES OF THE MEMBERS WE SHOW
+            # -------------------------
+            owed = [
+                (payer_id, receiver_id, amount)
+                for payer_id, receivers in graph.items()
+                for receiver_id, amount in receivers.items()
+                if amount > 0
+            ]
+            names = get_user_names({uid for payer_id, receiver_id, _ in owed for uid in (payer_id, receiver_id)})
+
+            # -------------------------
+            # BUILD RESULT
+            # -------------------------
+            expense_lines = [
+                f"{names[payer_id]} get back from {names[receiver_id]}: ₹{amount}"
+                for payer_id, receiver_id, amount in owed
+            ]
+            return expense_lines
+
+        expense_lines = single_flight(("groups/expenseDetail", group_id, cache_generation()), build)
         return jsonify({"expenseDetail": expense_lines}), 200
 
     except Exception as e:
-        print("❌ ERROR:", e)
+        log.exception("expense detail failed")
         return jsonify({"error": str(e)}), 500
 
     
@@ -562,80 +1826,88 @@ def get_current_user_expense_detail():
             return jsonify({"error": "groupId and currentUserId required"}), 400
 
         # Fetch group data
-        group_ref = db.reference("groups").child(group_id)
-        group_data = group_ref.get()
+        group_data = read_path(f"groups/{group_id}")
 
-        if group_data is None or "groupGraph" not in group_data:
+        graph = group_graph(group_data) if group_data else None
+        if not graph:
             return jsonify({"expenseDetail": []}), 200
 
-        graph = group_data["groupGraph"]
-
         # -------------------------
-        # FETCH ALL USERS
+        # Balances involving the current user
         # -------------------------
-        users_data = db.reference("users").get() or []
-
-        # Safe helper to get user name from UID
-        def get_name(uid):
-            if isinstance(users_data, dict):
-                return users_data.get(uid, {}).get("name", uid)
-            elif isinstance(users_data, list):
-                # if users_data is a list, search for matching uid
-                for user in users_data:
-                    if isinstance(user, dict) and user.get("userId") == uid:
-                        return user.get("name", uid)
-                return uid
-            return uid
+        gets_back = []
+        if current_user_id in graph:
+            gets_back = [(uid, amount) for uid, amount in graph[current_user_id].items() if amount > 0]
+        owes = [
+            (payer_id, receivers[current_user_id])
+            for payer_id, receivers in graph.items()
+            if payer_id != current_user_id
+            and current_user_id in receivers and receivers[current_user_id] > 0
+        ]
+        names = get_user_names({uid for uid, _ in gets_back + owes})
 
         expense_lines = []
 
         # -------------------------
         # Expenses current user owes
         # -------------------------
-        if current_user_id in graph:
-            for receiver_id, amount in graph[current_user_id].items():
-                if amount > 0:
-                    payer_name = "You"
-                    receiver_name = get_name(receiver_id)
-                    expense_lines.append(f"{payer_name} get back from {receiver_name}: ₹{amount}")
+        for receiver_id, amount in gets_back:
+            expense_lines.append(f"You get back from {names[receiver_id]}: ₹{amount}")
 
         # -------------------------
         # Expenses others owe current user
         # -------------------------
-        for payer_id, receivers in graph.items():
-            if payer_id == current_user_id:
-                continue
-            if current_user_id in receivers and receivers[current_user_id] > 0:
-                payer_name = get_name(payer_id)
-                amount = receivers[current_user_id]
-                expense_lines.append(f"You owes {payer_name}: ₹{amount}")
+        for payer_id, amount in owes:
+            expense_lines.append(f"You owes {names[payer_id]}: ₹{amount}")
 
         return jsonify({"expenseDetail": expense_lines}), 200
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("current user expense detail failed")
         return jsonify({"error": str(e)}), 500
 
     
     
 @app.route("/groups/items",methods=["POST"])
 def get_group_items():
-    start_time = time.time()
+    """Items of a group, oldest first.
+
+    ?from=&to= (YYYY-MM-DD, inclusive) narrow the dates. ?limit=N returns
+    the newest N in range, and an X-Next-Cursor header to send back as
+    ?cursor= for the next, older page.
+    """
     try:
-        data = request.get_json()
         group_id = request.get_json()
-        group_data = db.reference(f"groups").get()[group_id]
-        if('groupItems' not in group_data):
-            return jsonify([]),200
-        else:
-            items = []
-            for item_id in group_data['groupItems']:
-                items.append(db.reference("items").get()[item_id])
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            print("Time taken:", elapsed_time, "seconds")
-            return jsonify(items),200
+        start = request.args.get("from")
+        end = request.args.get("to")
+        cursor = request.args.get("cursor")
+        limit = request.args.get("limit", type=int)
+        if limit is not None:
+            limit = max(1, min(limit, PAGE_SIZE_MAX))
+
+        def load():
+            legacy = read_path(f"groups/{group_id}/groupItems")
+            if legacy:
+                # Not migrated yet: the listed items' dates place them
+                index = read_path(f"groups/{group_id}/groupItemIndex") or {}
+                listed = fetch_items(i for i in legacy if i not in index)
+                rows = list(index.items()) + [(item["itemId"], item_sort_key(item)) for item in listed]
+            else:
+                rows = query_item_index(group_id, start, end, limit, cursor)
+                if not rows and not db.reference(f"groups/{group_id}").get(shallow=True):
+                    return None
+            rows, next_cursor = select_item_keys(rows, start, end, limit, cursor)
+            return fetch_items(item_id for item_id, _ in rows), next_cursor
+
+        # Members polling the same group share one set of reads
+        result = single_flight(("groups/items", group_id, start, end, limit, cursor, cache_generation()), load)
+        if result is None:
+            return f"Group Item List Error : group {group_id} not found",404
+        items, next_cursor = result
+        response = jsonify(items)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response,200
         
     except Exception as e:
         return f"Group Item List Error : {e}",404
@@ -665,65 +1937,65 @@ def add_member_to_group():
         data = request.get_json()
         group_id = data['groupId']
 
-        # Convert email to Firebase-safe key
-        member_email = (
-            data['memberEmail']
-            .replace('.', '_dot_')
-            .replace('@', '_at_')
-        )
-
-        # Fetch userId of member
-        user_email_ref = db.reference('usersAsEmailKey').get()
-        if member_email not in user_email_ref:
+        # Fetch userId of member: one key, or none if the email is unknown
+        member_id = lookup_user_ids_by_email([data['memberEmail']])[data['memberEmail']]
+        if member_id is None:
             return {"message": "User not found"}, 404
-
-        member_id = user_email_ref[member_email]['userId']
         data['memberId'] = member_id
 
-        # ----- Fetch group -----
-        group_ref = db.reference("groups").child(group_id)
-        group = group_ref.get()
+        # ----- Update group -----
+        def add_member(group, updates):
+            if not group:
+                return False
+            stage_new_member(group_id, group, member_id, updates)
+            return True
 
-        if group is None:
+        if not submit_group_mutation(group_id, add_member):
             return {"message": "Group not found"}, 404
 
-        # Ensure groupMembers exists
-        group.setdefault("groupMembers", [])
-
-        # Add member if not already inside
-        if member_id not in group["groupMembers"]:
-            group["groupMembers"].append(member_id)
-
-        # Ensure groupGraph exists
-        group.setdefault("groupGraph", {})
-        group["groupGraph"].setdefault(member_id, {})
-
-        # Build graph
-        for gm in group["groupMembers"]:
-            if gm == member_id:
-                continue
-            group["groupGraph"].setdefault(gm, {})
-            group["groupGraph"][gm][member_id] = 0
-            group["groupGraph"][member_id][gm] = 0
-
-        # Save updated group
-        group_ref.set(group)
-
-        # ----- Update user -----
-        user_ref = db.reference("users").child(member_id)
-        user_data = user_ref.get()
-
-        if user_data is not None:
-            user_data.setdefault("groupIds", [])
-            if group_id not in user_data["groupIds"]:
-                user_data["groupIds"].append(group_id)
-                user_ref.set(user_data)
-
         return {"message": "Member added"}, 200
 
     except Exception as e:
         return {"error": f"Member add error: {e}"}, 500
 
+@app.route("/groups/addMembers", methods=["PUT"])
+def add_members_to_group():
+    """Add several members by email with one lookup batch and one group write.
+
+    Body: {"groupId": ..., "memberEmails": [...]}. The response has one
+    result per email: "added", "already a member" or "user not found".
+    """
+    try:
+        data = get_json_data()
+        group_id = data.get("groupId")
+        emails = data.get("memberEmails")
+        if not group_id:
+            return safe_json_response("error", "groupId missing", code=400)
+        if not isinstance(emails, list) or not emails or not all(isinstance(e, str) for e in emails):
+            return safe_json_response("error", "memberEmails must be a non-empty list of emails", code=400)
+
+        emails = list(dict.fromkeys(emails))
+        member_ids = lookup_user_ids_by_email(emails)
+
+        def add_members(group, updates):
+            if not group:
+                return None
+            return {email: stage_new_member(group_id, group, member_ids[email], updates)
+                    for email in emails if member_ids[email] is not None}
+
+        added = submit_group_mutation(group_id, add_members)
+        if added is None:
+            return safe_json_response("error", "Group not found", code=404)
+
+        results = []
+        for email in emails:
+            status = "user not found" if email not in added else "added" if added[email] else "already a member"
+            results.append({"email": email, "userId": member_ids[email], "status": status})
+        count = sum(1 for r in results if r["status"] == "added")
+        return safe_json_response("success", f"{count} of {len(emails)} members added", {"results": results})
+    except Exception:
+        return safe_json_response("error", "Failed to add members", traceback.format_exc(), 500)
+
 # @app.route("/groups/addMember", methods=["PUT"])
 # def add_member():
 #     try:
@@ -764,24 +2036,411 @@ def delete_group():
         if not groupId:
             return safe_json_response("error", "groupId missing", 400)
 
-        group_ref = db.reference(f"groups/{groupId}")
-        group = group_ref.get()
+        group = read_path(f"groups/{groupId}")
         if not group:
             return safe_json_response("error", "Group not found", 404)
 
-        # Remove references from users
-        for userId in group.get("groupMembers", []):
-            user_ref = db.reference(f"users/{userId}")
-            user = user_ref.get()
-            if user and "groupIds" in user and groupId in user["groupIds"]:
-                user["groupIds"].remove(groupId)
-                user_ref.update({"groupIds": user["groupIds"]})
-
-        group_ref.delete()
+        # Members still holding groupIds as a list need their entry cleared by index
+        legacy = {}
+        if LEGACY_GROUP_IDS:
+            members = group.get("groupMembers") or []
+            for userId, group_ids in zip(members, fetch_many(f"users/{userId}/groupIds" for userId in members)):
+                legacy[userId] = legacy_group_id_paths(group_ids, groupId)
+
+        def remove_group(group, updates):
+            if not group:
+                return False
+            prefix = f"groups/{groupId}"
+            # The whole group goes, so drop anything earlier mutations staged under it
+            for path in [p for p in updates if p.startswith(prefix + "/")]:
+                del updates[path]
+            updates[prefix] = None
+            for itemId in group_item_ids(group):
+                updates[f"items/{itemId}"] = None
+            for userId in group.get("groupMembers") or []:
+                updates[f"users/{userId}/groupIds/{groupId}"] = None
+                updates[f"userBalances/{userId}/{groupId}"] = None
+                for path in legacy.get(userId, []):
+                    updates[f"users/{userId}/groupIds/{path}"] = None
+            group.clear()
+            return True
+
+        # Group, its items and every member's link in one write, queued
+        # behind any pending item writes to the same group
+        if not submit_group_mutation(groupId, remove_group):
+            return safe_json_response("error", "Group not found", 404)
         return safe_json_response("success", "Group deleted")
     except Exception:
         return safe_json_response("error", "Failed to delete group", traceback.format_exc(), 500)
 
+# -----------------------------
+# 🔥 SYNC
+# -----------------------------
+# GET /sync?userId=&since= returns what changed, in the groups a user
+# belongs to, since the "since" token of that user's previous sync. The
+# token carries the revision reached in each group and is opaque to
+# clients. Reads here bypass the cache, so a revision is never paired
+# with older values from another process.
+def encode_sync_token(revs):
+    raw = json.dumps(revs, separators=(",", ":"), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_sync_token(token):
+    """{groupId: rev} from a token; ValueError if it is not one we issued"""
+    if not token:
+        return {}
+    try:
+        revs = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise ValueError("malformed since token")
+    if not isinstance(revs, dict) or not all(isinstance(r, int) for r in revs.values()):
+        raise ValueError("malformed since token")
+    return revs
+
+def read_fresh(paths):
+    """fetch_many without the cache"""
+    return fan_out(lambda path: db.reference(path).get(), paths)
+
+def group_changes(group_id, since):
+    """A group's changes after revision since (None: all of it).
+
+    Returns (changes, user ids they mention), or (None, ()) when the group
+    no longer exists. changes is None as well when nothing changed.
+    """
+    rev = db.reference(f"groups/{group_id}/groupRev").get() or 0
+    if since == rev:
+        return {"groupId": group_id, "rev": rev, "changed": False}, ()
+    group = db.reference(f"groups/{group_id}").get()
+    if not group:
+        return None, ()
+    # The group may have moved on since groupRev was read; its own revision
+    # is the one matching the values read
+    rev = group.get("groupRev") or 0
+    entries = None
+    if since is not None and since < rev:
+        log_rows = db.reference(f"changeLog/{group_id}").order_by_key() \
+            .start_at(rev_key(since + 1)).end_at(rev_key(rev)).get() or {}
+        # Every revision in between must be logged. A missing first entry
+        # means the log was compacted past since; a gap elsewhere means an
+        # entry was never written, or is still being written by another
+        # process. Either way the full group is the safe answer
+        if len(log_rows) == rev - since and all(rev_key(r) in log_rows for r in range(since + 1, rev + 1)):
+            entries = [log_rows[rev_key(r)] for r in range(since + 1, rev + 1)]
+
+    graph = group_graph(group, dense=True) or {}
+    balances = group.get("groupBalances") or {}
+    changes = {"groupId": group_id, "rev": rev, "changed": True, "full": entries is None}
+    if entries is None:
+        changes["group"] = group_view(dict(group, groupId=group_id))
+        item_ids = group_item_ids(group)
+        changes["balances"] = balances
+        changes["graph"] = graph
+        users = set(group.get("groupMembers") or [])
+    else:
+        merged = {}
+        for entry in entries:
+            for kind in ("items", "users", "balances", "cells"):
+                merged.setdefault(kind, set()).update(entry.get(kind) or {})
+            for flag in ("group", "graph"):
+                merged[flag] = merged.get(flag) or entry.get(flag, False)
+        if merged["group"]:
+            changes["group"] = {k: v for k, v in group.items() if k not in (
+                "groupItems", "groupItemIndex", "groupBalances", "groupGraph", "groupGraphPacked")}
+            changes["group"]["groupId"] = group_id
+        item_ids = sorted(merged["items"])
+        changes["balances"] = {uid: balances.get(uid) for uid in merged["balances"]}
+        if merged["graph"]:
+            changes["graph"] = graph
+        else:
+            changes["graph"] = {}
+            for cell in merged["cells"]:
+                a, b = cell.split("|", 1)
+                changes["graph"].setdefault(a, {})[b] = graph.get(a, {}).get(b)
+        users = merged["users"]
+
+    changes["items"], changes["deletedItems"] = [], []
+    for item_id, item in zip(item_ids, read_fresh(f"items/{i}" for i in item_ids)):
+        if item:
+            changes["items"].append(dict(item, itemId=item_id))
+        else:
+            changes["deletedItems"].append(item_id)
+    return changes, users
+
+@app.route("/sync", methods=["GET"])
+def sync():
+    """Changes a user can see since their last sync.
+
+    ?userId= is the caller; ?since= the "since" token of the previous
+    response, or nothing to get everything. Each changed group comes with
+    its changed items (deletedItems for the ones removed), balances and
+    graph cells; "full": true means the group is sent whole, because it is
+    new to the caller or its change log no longer reaches back to the
+    token. users holds the profiles those changes mention.
+    """
+    try:
+        user_id = request.args.get("userId")
+        if not user_id:
+            return safe_json_response("error", "userId missing", code=400)
+        try:
+            since = decode_sync_token(request.args.get("since"))
+        except ValueError as e:
+            return safe_json_response("error", str(e), code=400)
+
+        user = db.reference(f"users/{user_id}").get()
+        if not user:
+            return safe_json_response("error", "User not found", code=404)
+        group_ids = group_id_list(user.get("groupIds"))
+
+        results = fan_out(lambda group_id: group_changes(group_id, since.get(group_id)), group_ids)
+        revs, groups, user_ids = {}, [], set()
+        for group_id, (changes, users) in zip(group_ids, results):
+            if changes is None:
+                continue
+            revs[group_id] = changes["rev"]
+            if changes.pop("changed"):
+                groups.append(changes)
+                user_ids.update(users)
+        deleted_groups = [group_id for group_id in since if group_id not in revs]
+
+        user_ids = sorted(user_ids)
+        users, deleted_users = [], []
+        for uid, profile in zip(user_ids, read_fresh(f"users/{uid}" for uid in user_ids)):
+            if profile:
+                users.append(user_view(dict(profile, userId=uid)))
+            else:
+                deleted_users.append(uid)
+
+        return safe_json_response("success", "Changes fetched", {
+            "since": encode_sync_token(revs),
+            "groups": groups,
+            "deletedGroups": deleted_groups,
+            "users": users,
+            "deletedUsers": deleted_users,
+        })
+    except Exception:
+        return safe_json_response("error", "Failed to sync", traceback.format_exc(), 500)
+
+# -----------------------------
+# 🔥 LIVE EVENTS
+# -----------------------------
+# GET /groups/<groupId>/events streams a group's changes as server-sent
+# events: item-added, item-updated, item-deleted, member-added,
+# balance-changed and group-deleted, each with the group revision as its
+# id. EVENTS_SOURCE=local publishes straight from this process's group
+# writes. "rtdb" (firebase backend only) listens to changeLog/<gid> once
+# per watched group instead, so writes made by other processes are seen
+# too. Served by the app, which is sync WSGI, every open stream holds a
+# server thread until the client goes, so at most EVENTS_MAX_STREAMS are
+# served that way per process (256 by default, sized by serve.py
+# --event-streams) and the next one gets a 503 with Retry-After. With
+# EVENTS_BIND=host:port each worker also serves the same URL from one
+# asyncio thread (event_server), where an idle stream costs a socket and
+# its queue; that listener takes EVENTS_ASYNC_MAX_STREAMS streams per
+# process (10000 by default) and is where a proxy should send
+# /groups/<groupId>/events. A client that falls EVENTS_QUEUE events
+# behind, or reconnects with a Last-Event-ID older than the group, is
+# sent "resync" and should call GET /sync.
+EVENTS_SOURCE = os.environ.get("EVENTS_SOURCE", "local")
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", 256))
+EVENTS_BIND = os.environ.get("EVENTS_BIND", "")
+EVENTS_ASYNC_MAX_STREAMS = int(os.environ.get("EVENTS_ASYNC_MAX_STREAMS", 10000))
+EVENTS_QUEUE = int(os.environ.get("EVENTS_QUEUE", 100))
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get("EVENTS_HEARTBEAT_SECONDS", 15))
+if EVENTS_SOURCE == "rtdb" and STORAGE_BACKEND != "firebase":
+    log.warning("EVENTS_SOURCE=rtdb needs the firebase backend, publishing locally",
+                extra={"fields": {"backend": STORAGE_BACKEND}})
+    EVENTS_SOURCE = "local"
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+def change_events(group_id, rev, entry, items, balances):
+    """(name, data, id) events for one change-log entry.
+
+    items maps the entry's item ids to their saved values and balances
+    holds the group's groupBalances after the change.
+    """
+    events = []
+    for item_id, op in sorted((entry.get("items") or {}).items()):
+        if op == "deleted":
+            events.append(("item-deleted", {"itemId": item_id}))
+        elif items.get(item_id):
+            name = "item-added" if op == "added" else "item-updated"
+            events.append((name, {"item": dict(items[item_id], itemId=item_id)}))
+    for uid in sorted(entry.get("members") or {}):
+        events.append(("member-added", {"userId": uid}))
+    changed = entry.get("balances") or {}
+    if changed or entry.get("graph"):
+        uids = changed if changed else balances
+        events.append(("balance-changed", {"balances": {uid: balances.get(uid) for uid in uids}}))
+    return [(name, dict(data, groupId=group_id, rev=rev), rev) for name, data in events]
+
+def publish_group_change(group_id, existed, group_data, updates, change):
+    """Hand a saved group mutation to the group's streams, for EVENTS_SOURCE=local"""
+    if EVENTS_SOURCE != "local" or not event_hub.has_subscribers(group_id):
+        return
+    if existed and group_data is not None and not group_data:
+        event_hub.publish(group_id, [("group-deleted", {"groupId": group_id}, None)])
+    elif change is not None:
+        rev, entry = change
+        items = {item_id: updates.get(f"items/{item_id}") for item_id in entry.get("items") or {}}
+        event_hub.publish(group_id, change_events(group_id, rev, entry, items, group_data.get("groupBalances") or {}))
+
+def _start_listener(group_id):
+    if EVENTS_SOURCE != "rtdb":
+        return
+    primed = []
+
+    def on_change(event):
+        try:
+            if event.event_type == "put" and event.path == "/":
+                # The current log, sent on (re)connect; None once it is deleted
+                if event.data is None and primed:
+                    event_hub.publish(group_id, [("group-deleted", {"groupId": group_id}, None)])
+                primed.append(True)
+                return
+            entries = {event.path.strip("/"): event.data} if event.event_type == "put" else event.data
+            for key, entry in sorted((entries or {}).items()):
+                if not entry:
+                    continue  # an entry trimmed off the end
+                live = [i for i, op in (entry.get("items") or {}).items() if op != "deleted"]
+                items = dict(zip(live, read_fresh(f"items/{i}" for i in live)))
+                balances = {}
+                if entry.get("balances") or entry.get("graph"):
+                    balances = db.reference(f"groups/{group_id}/groupBalances").get() or {}
+                event_hub.publish(group_id, change_events(group_id, int(key[1:]), entry, items, balances))
+        except Exception:
+            log.exception("event listener failed", extra={"fields": {"groupId": group_id}})
+
+    registration = db.reference(f"changeLog/{group_id}").listen(on_change)
+    with _listeners_lock:
+        _listeners[group_id] = registration
+    # The last stream may have gone while the listener was starting
+    if not event_hub.has_subscribers(group_id):
+        _stop_listener(group_id)
+
+def _stop_listener(group_id):
+    with _listeners_lock:
+        registration = _listeners.pop(group_id, None)
+    if registration is not None:
+        registration.close()
+
+event_hub = EventHub(max_queue=EVENTS_QUEUE, on_first=_start_listener, on_last=_stop_listener)
+
+def event_stream_start(groupId, last_id):
+    """First chunks of a group's event stream, or None if the group does not
+    exist. Called after subscribing, so no change falls between the two."""
+    group = db.reference(f"groups/{groupId}").get(shallow=True)
+    if not group:
+        return None
+    chunks = ["retry: 3000\n\n"]
+    rev = group.get("groupRev") or 0
+    if last_id is not None and str(rev) != last_id:
+        chunks.append(format_sse("resync", {"groupId": groupId, "rev": rev}, rev))
+    return chunks
+
+def resync_event(groupId):
+    return format_sse("resync", {"groupId": groupId})
+
+event_server = EventStreamServer(
+    event_hub, event_stream_start, resync_event, re.compile(r"/groups/([^/]+)/events$"),
+    limit=EVENTS_ASYNC_MAX_STREAMS, heartbeat=EVENTS_HEARTBEAT_SECONDS, end_event="group-deleted")
+
+@app.route("/groups/<groupId>/events", methods=["GET"])
+def get_group_events(groupId):
+    try:
+        if not db.reference(f"groups/{groupId}").get(shallow=True):
+            return safe_json_response("error", "Group not found", code=404)
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+        sub = event_hub.subscribe(groupId, limit=EVENTS_MAX_STREAMS)
+        if sub is None:
+            body, code = safe_json_response("error", "Too many event streams", code=503)
+            return body, code, {"Retry-After": "5"}
+    except Exception:
+        return safe_json_response("error", "Failed to open event stream", traceback.format_exc(), 500)
+
+    def stream():
+        try:
+            chunks = event_stream_start(groupId, last_id)
+            if chunks is None:
+                yield format_sse("group-deleted", {"groupId": groupId})
+                return
+            yield from chunks
+            while True:
+                if sub.overflowed:
+                    sub.drain()
+                    yield resync_event(groupId)
+                    continue
+                try:
+                    name, data, event_id = sub.queue.get(timeout=EVENTS_HEARTBEAT_SECONDS)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(name, data, event_id)
+                if name == "group-deleted":
+                    return
+        finally:
+            event_hub.unsubscribe(sub)
+
+    response = Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # A client gone before the first chunk never runs the generator's finally
+    response.call_on_close(lambda: event_hub.unsubscribe(sub))
+    return response
+
+# -----------------------------
+# 🔥 WORKER LIFECYCLE
+# -----------------------------
+# serve.py imports this module once in the master process and forks the
+# workers from it. Threads, the SQLite connection and the firebase_admin
+# HTTP session do not survive a fork, so every worker rebuilds them in
+# init_worker and opens its backend connection before taking requests.
+# Firebase connections are then kept warm by reading an empty path every
+# STORAGE_KEEPALIVE_SECONDS (0 turns that off).
+STORAGE_KEEPALIVE_SECONDS = float(os.environ.get("STORAGE_KEEPALIVE_SECONDS", 60))
+KEEPALIVE_PATH = "_keepalive"
+_keepalive_stop = threading.Event()
+
+def init_worker():
+    global fetch_pool, group_write_pool, hash_pool, _keepalive_stop, _cache_indexed
+    setup_logging(LOG_LEVEL, parse_rates(LOG_SAMPLE))
+    init_storage(fresh=True)
+    fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="rtdb-fetch")
+    group_write_pool = ThreadPoolExecutor(max_workers=GROUP_WRITE_WORKERS, thread_name_prefix="group-write")
+    hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+    with cache_lock:
+        path_cache.clear()
+        _cache_index.clear()
+        _cache_indexed = 0
+
+    # Opens the connection (and fetches the access token) before the first request
+    db.reference(KEEPALIVE_PATH).get()
+    if EVENTS_BIND:
+        # Every worker binds the same port and the kernel spreads connections
+        host, _, port = EVENTS_BIND.rpartition(":")
+        event_server.start(host or "0.0.0.0", int(port), reuse_port=True)
+    _keepalive_stop = threading.Event()
+    if STORAGE_BACKEND == "firebase" and STORAGE_KEEPALIVE_SECONDS > 0:
+        threading.Thread(target=_keep_warm, args=(_keepalive_stop,), name="storage-keepalive", daemon=True).start()
+    log.info("worker ready", extra={"fields": {"pid": os.getpid(), "backend": STORAGE_BACKEND}})
+
+def _keep_warm(stop):
+    while not stop.wait(STORAGE_KEEPALIVE_SECONDS):
+        try:
+            db.reference(KEEPALIVE_PATH).get()
+        except Exception as e:
+            log.warning("storage keepalive failed", extra={"fields": {"error": str(e)}})
+
+def shutdown_worker():
+    """Finish queued group writes and flush the log before the worker exits"""
+    _keepalive_stop.set()
+    event_server.stop()
+    group_write_pool.shutdown(wait=True)
+    fetch_pool.shutdown(wait=True)
+    hash_pool.shutdown(wait=True)
+    log.info("worker stopped", extra={"fields": {"pid": os.getpid()}})
+    stop_logging()
+
 # -----------------------------
 # 🔥 SERVER RUN
 # -----------------------------
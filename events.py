@@ -0,0 +1,309 @@
+"""In-process publish/subscribe for server-sent event streams.
+
+Each subscriber owns a small bounded queue; publishing to a key touches
+only that key's subscribers and never blocks. A subscriber that falls
+max_queue events behind is marked overflowed and stops receiving until
+it has caught up some other way (the stream tells its client to resync).
+on_first and on_last are called when a key gains its first subscriber
+and loses its last one, e.g. to open and close a backend listener.
+
+EventStreamServer serves a hub's streams from one asyncio thread, so an
+idle stream holds a socket and a queue instead of a server thread.
+"""
+import asyncio
+import functools
+import json
+import logging
+import queue
+import threading
+from collections import Counter
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote
+
+log = logging.getLogger("apirepo.events")
+
+
+class Subscription:
+    __slots__ = ("key", "queue", "overflowed", "kind", "notify")
+
+    def __init__(self, key, max_queue, kind=None, notify=None):
+        self.key = key
+        self.queue = queue.Queue(max_queue)
+        self.overflowed = False
+        self.kind = kind
+        self.notify = notify
+
+    def drain(self):
+        """Drop everything queued and clear the overflow mark"""
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.overflowed = False
+
+
+class EventHub:
+    def __init__(self, max_queue=100, on_first=None, on_last=None):
+        self.max_queue = max_queue
+        self.on_first = on_first
+        self.on_last = on_last
+        self._subscribers = {}
+        self._open = Counter()
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, limit=None, kind=None, notify=None):
+        """A new subscription to key, or None if limit subscriptions of this
+        kind are already open. The count is checked and taken under the
+        hub's lock, so concurrent subscribers cannot overshoot it.
+
+        notify() is called from the publishing thread after events are
+        queued for the subscription, and must not block.
+        """
+        sub = Subscription(key, self.max_queue, kind, notify)
+        with self._lock:
+            if limit is not None and self._open[kind] >= limit:
+                return None
+            self._open[kind] += 1
+            subs = self._subscribers.setdefault(key, set())
+            first = not subs
+            subs.add(sub)
+        if first and self.on_first is not None:
+            self.on_first(key)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.key)
+            if subs is None or sub not in subs:
+                return
+            subs.discard(sub)
+            self._open[sub.kind] -= 1
+            last = not subs
+            if last:
+                del self._subscribers[sub.key]
+        if last and self.on_last is not None:
+            self.on_last(sub.key)
+
+    def publish(self, key, events):
+        """Queue (name, data) events for every subscriber of key"""
+        with self._lock:
+            subs = list(self._subscribers.get(key, ()))
+        for sub in subs:
+            if sub.overflowed:
+                continue
+            for event in events:
+                try:
+                    sub.queue.put_nowait(event)
+                except queue.Full:
+                    sub.overflowed = True
+                    break
+            if sub.notify is not None:
+                sub.notify()
+
+    def has_subscribers(self, key):
+        with self._lock:
+            return key in self._subscribers
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._subscribers),
+                    "subscribers": sum(len(s) for s in self._subscribers.values())}
+
+
+class EventStreamServer:
+    """Event streams served from one asyncio thread.
+
+    Speaks just enough HTTP/1.1 to answer GET requests whose path matches
+    the compiled pattern path (group 1 is the hub key) with a
+    chunked text/event-stream body. open_stream(key, last_id)
+    runs on an executor thread once the stream has subscribed, and returns
+    the chunks to send first, or None when key does not exist (404).
+    Queued events are then written as
+    they arrive, a comment goes out after heartbeat idle seconds, a
+    subscription that overflowed is drained and sent resync(key), and the
+    stream ends after an event named end_event. At most limit streams are
+    open at once; the next client gets a 503 with Retry-After.
+    """
+
+    HEADER_TIMEOUT = 10
+
+    def __init__(self, hub, open_stream, resync, path, limit, heartbeat=15, end_event=None):
+        self.hub = hub
+        self.open_stream = open_stream
+        self.path = path
+        self.limit = limit
+        self.heartbeat = heartbeat
+        self.resync = resync
+        self.end_event = end_event
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._streams = set()
+
+    def start(self, host, port, reuse_port=False):
+        """Listen on host:port from a new daemon thread; returns once bound.
+
+        reuse_port lets every forked worker bind the same port.
+        """
+        ready = threading.Event()
+        failed = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._server = self._loop.run_until_complete(asyncio.start_server(
+                    self._handle, host, port, reuse_port=reuse_port or None))
+            except Exception as e:
+                failed.append(e)
+                ready.set()
+                return
+            ready.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="event-streams", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if failed:
+            raise failed[0]
+
+    def stop(self):
+        """Close the listener and every open stream"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _close(self):
+        self._server.close()
+        for task in list(self._streams):
+            task.cancel()
+        await asyncio.gather(*self._streams, return_exceptions=True)
+
+    def stats(self):
+        return {"streams": len(self._streams)}
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._streams.add(task)
+        loop = asyncio.get_running_loop()
+        sub = None
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.HEADER_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, _, target = request_line.partition(" ")
+            target = target.rpartition(" ")[0]
+            path, _, query = target.partition("?")
+            match = self.path.match(path)
+            if not match:
+                await self._reply(writer, 404, "Not found")
+                return
+            if method != "GET":
+                await self._reply(writer, 405, "Method not allowed", ["Allow: GET"])
+                return
+            headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            last_id = headers.get("last-event-id") or (parse_qs(query).get("lastEventId") or [None])[0]
+            key = unquote(match.group(1))
+
+            wake = asyncio.Event()
+            # subscribe may start a backend listener (on_first), so it runs off the loop
+            sub = await loop.run_in_executor(None, functools.partial(
+                self.hub.subscribe, key, limit=self.limit, kind=self,
+                notify=lambda: loop.call_soon_threadsafe(wake.set)))
+            if sub is None:
+                await self._reply(writer, 503, "Too many event streams", ["Retry-After: 5"])
+                return
+            # Read after subscribing, so no change falls between the two
+            preamble = await loop.run_in_executor(None, self.open_stream, key, last_id)
+            if preamble is None:
+                await self._reply(writer, 404, "Not found")
+                return
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/event-stream; charset=utf-8\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"X-Accel-Buffering: no\r\n"
+                         b"Transfer-Encoding: chunked\r\n"
+                         b"Connection: close\r\n\r\n")
+            self._write(writer, "".join(preamble))
+            await writer.drain()
+            await self._pump(sub, wake, reader, writer)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        except Exception:
+            log.exception("event stream failed")
+        finally:
+            self._streams.discard(task)
+            if sub is not None:
+                await loop.run_in_executor(None, self.hub.unsubscribe, sub)
+            writer.close()
+
+    async def _pump(self, sub, wake, reader, writer):
+        # Clients send nothing after the request, so any read completing means they left
+        gone = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                wake.clear()
+                chunks, done = self._take(sub)
+                if chunks:
+                    self._write(writer, "".join(chunks))
+                    if done:
+                        writer.write(b"0\r\n\r\n")
+                    await asyncio.wait_for(writer.drain(), 2 * self.heartbeat)
+                    if done:
+                        return
+                    continue
+                woken = asyncio.ensure_future(wake.wait())
+                await asyncio.wait({gone, woken}, timeout=self.heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if gone.done():
+                    return
+                if not wake.is_set():
+                    self._write(writer, ": keepalive\n\n")
+                    await asyncio.wait_for(writer.drain(), 2 * self.heartbeat)
+        finally:
+            gone.cancel()
+
+    def _take(self, sub):
+        """(chunks, ended) for everything queued on sub, without blocking"""
+        if sub.overflowed:
+            sub.drain()
+            return [self.resync(sub.key)], False
+        chunks = []
+        while True:
+            try:
+                name, data, event_id = sub.queue.get_nowait()
+            except queue.Empty:
+                return chunks, False
+            chunks.append(format_sse(name, data, event_id))
+            if name == self.end_event:
+                return chunks, True
+
+    @staticmethod
+    def _write(writer, text):
+        data = text.encode()
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    @staticmethod
+    async def _reply(writer, code, message, headers=()):
+        body = json.dumps({"status": "error", "message": message, "data": {}}).encode()
+        head = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: close", *headers]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+
+def format_sse(name, data, event_id=None):
+    """One server-sent event in wire format"""
+    lines = [f"event: {name}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append("data: " + json.dumps(data, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,260 @@
+"""Group balance engines.
+
+updateGraph is the original pairwise walk over the nested groupGraph
+dict. Ledger keeps one net balance per member instead and derives the
+"who pays whom" graph from it on demand, so applying an item touches
+only the members in its split.
+"""
+import base64
+import heapq
+
+import numpy as np
+
+# groupGraphPacked layout: the member index plus one little-endian record
+# per nonzero cell, base64 encoded so it fits in a single RTDB string.
+PACKED_VERSION = 1
+PACKED_CELL = np.dtype([("row", "<u4"), ("col", "<u4"), ("paise", "<i8")])
+
+
+def updateGraph(group_data,payerId,giveToM,giveAmt,changed=None):
+    """Move giveAmt owed by giveToM to payerId through the group's debt graph.
+
+    When a set is passed as changed, every (row, column) cell of groupGraph
+    this call modified is added to it so the caller can write just those.
+    """
+    graph = group_data['groupGraph']
+
+    def add(a, b, amt):
+        if amt:
+            graph[a][b] += amt
+            if changed is not None:
+                changed.add((a, b))
+
+    if(giveToM == payerId):
+        return
+    giveAmt = float(giveAmt) + graph[payerId][giveToM]
+    add(payerId, giveToM, -graph[payerId][giveToM])
+    if(giveAmt==0): return
+    for gM in group_data['groupMembers']:
+        if(giveAmt>0):
+            if(gM!=giveToM):
+                extrapayamt = graph[giveToM][gM]
+                furamt = min(giveAmt,extrapayamt)
+                if(gM == payerId):
+                    add(giveToM, gM, -furamt)
+                else:
+                    add(giveToM, gM, -furamt)
+                    add(payerId, gM, furamt)
+
+                giveAmt-=furamt
+
+    for gM in group_data['groupMembers']:
+        if(giveAmt!=0):
+            if(gM!=payerId):
+
+                dueamt = graph[gM][payerId]
+                furamt = min(dueamt,giveAmt)
+                if(giveToM ==  gM):
+                    add(gM, payerId, -furamt)
+                else:
+                    add(gM, payerId, -furamt)
+                    add(gM, giveToM, furamt)
+
+                giveAmt-=furamt
+    if(giveAmt>0):
+        add(payerId, giveToM, giveAmt)
+
+
+def to_paise(amount):
+    return int(round(float(amount) * 100))
+
+
+def to_rupees(paise):
+    return int(paise) / 100
+
+
+def pack_cells(members, cells):
+    """Pack {(a, b): paise} into the groupGraphPacked dict.
+
+    Only members that appear in a nonzero cell go into the member index;
+    members is just the preferred order.
+    """
+    used = {uid for cell, paise in cells.items() if paise for uid in cell}
+    members = [m for m in dict.fromkeys(list(members) + sorted(used)) if m in used]
+    index = {m: i for i, m in enumerate(members)}
+    records = np.array(
+        sorted((index[a], index[b], paise) for (a, b), paise in cells.items() if paise),
+        dtype=PACKED_CELL,
+    )
+    return {
+        "version": PACKED_VERSION,
+        "members": members,
+        "cells": base64.b64encode(records.tobytes()).decode("ascii"),
+    }
+
+
+def pack_graph(graph, members=()):
+    """Encode a groupGraph dict as groupGraphPacked, keeping only nonzero cells"""
+    cells = {
+        (a, b): to_paise(amount)
+        for a, row in (graph or {}).items()
+        for b, amount in (row or {}).items()
+        if amount
+    }
+    return pack_cells(list(members) + list(graph or {}), cells)
+
+
+def unpack_cells(packed):
+    """{(a, b): paise} of a groupGraphPacked dict"""
+    members = packed.get("members") or []
+    records = np.frombuffer(base64.b64decode(packed.get("cells") or ""), dtype=PACKED_CELL)
+    return {
+        (members[row], members[col]): int(paise)
+        for row, col, paise in zip(records["row"].tolist(), records["col"].tolist(), records["paise"].tolist())
+    }
+
+
+def unpack_graph(packed, members=(), dense=False):
+    """Decode groupGraphPacked back to the groupGraph dict shape.
+
+    dense=True fills every ordered pair of distinct members with 0, as
+    add_member_to_group does for dict groups; otherwise only nonzero
+    cells are returned.
+    """
+    members = list(dict.fromkeys(list(members) + list(packed.get("members") or [])))
+    graph = {a: ({b: 0 for b in members if b != a} if dense else {}) for a in members}
+    for (a, b), paise in unpack_cells(packed).items():
+        graph.setdefault(a, {})[b] = to_rupees(paise)
+    return graph
+
+
+class Ledger:
+    """Net balances of one group's members, held in integer paise.
+
+    net[i] > 0 means member i gets that much back overall, net[i] < 0 means
+    they owe it. The pairwise groupGraph is a view computed from these.
+    """
+
+    def __init__(self, members, balances=None):
+        self.members = []
+        self.index = {}
+        self.net = np.zeros(0, dtype=np.int64)
+        self.touched = set()
+        self.add_members(members)
+        for uid, amount in (balances or {}).items():
+            self.net[self._idx(uid)] = to_paise(amount)
+
+    @classmethod
+    def from_graph(cls, members, graph):
+        """Net balances implied by a groupGraph (graph[a][b]: b owes a)"""
+        ledger = cls(members)
+        for a, row in (graph or {}).items():
+            for b, amount in (row or {}).items():
+                if amount:
+                    paise = to_paise(amount)
+                    ledger.net[ledger._idx(a)] += paise
+                    ledger.net[ledger._idx(b)] -= paise
+        return ledger
+
+    @classmethod
+    def from_group(cls, group):
+        """Ledger of a stored group, deriving balances from groupGraph if needed"""
+        members = group.get("groupMembers") or []
+        if "groupBalances" in group:
+            return cls(members, group["groupBalances"])
+        # Legacy group: every balance is new to the stored data
+        if "groupGraphPacked" in group:
+            graph = unpack_graph(group["groupGraphPacked"])
+        else:
+            graph = group.get("groupGraph")
+        ledger = cls.from_graph(members, graph)
+        ledger.touched = set(range(len(ledger.members)))
+        return ledger
+
+    def add_members(self, members):
+        new = [m for m in dict.fromkeys(members) if m not in self.index]
+        for m in new:
+            self.index[m] = len(self.members)
+            self.members.append(m)
+        if new:
+            self.net = np.concatenate([self.net, np.zeros(len(new), dtype=np.int64)])
+
+    def _idx(self, uid):
+        if uid not in self.index:
+            self.add_members([uid])
+        return self.index[uid]
+
+    def apply_item(self, payerId, spliters, values, sign=1):
+        """Apply one item's splits in a single vectorized step.
+
+        The payer is credited with every share and each splitter debited
+        with theirs; sign=-1 reverses a previously applied item.
+        """
+        if not len(spliters):
+            return
+        idx = np.fromiter((self._idx(m) for m in spliters), dtype=np.int64, count=len(spliters))
+        amounts = np.rint(np.asarray(values, dtype=np.float64) * 100).astype(np.int64) * sign
+        payer = self._idx(payerId)
+        np.subtract.at(self.net, idx, amounts)
+        self.net[payer] += amounts.sum()
+        self.touched.update(idx.tolist())
+        self.touched.add(payer)
+
+    def balances(self):
+        return {m: to_rupees(self.net[i]) for i, m in enumerate(self.members)}
+
+    def changed_balances(self):
+        """Balances of the members touched since the ledger was loaded"""
+        return {self.members[i]: to_rupees(self.net[i]) for i in sorted(self.touched)}
+
+    def settlements(self):
+        """Minimum-transactions settlement as (debtorId, creditorId, amount) tuples.
+
+        Greedy: repeatedly settle the largest debtor against the largest
+        creditor. Ties go by member order so the result is stable.
+        """
+        creditors = [(-int(v), i) for i, v in enumerate(self.net) if v > 0]
+        debtors = [(int(v), i) for i, v in enumerate(self.net) if v < 0]
+        heapq.heapify(creditors)
+        heapq.heapify(debtors)
+        result = []
+        while creditors and debtors:
+            credit, c = heapq.heappop(creditors)
+            debt, d = heapq.heappop(debtors)
+            paid = min(-credit, -debt)
+            result.append((self.members[d], self.members[c], to_rupees(paid)))
+            if -credit > paid:
+                heapq.heappush(creditors, (credit + paid, c))
+            if -debt > paid:
+                heapq.heappush(debtors, (debt + paid, d))
+        return result
+
+    def settlement_cells(self):
+        """Nonzero groupGraph cells of the settlement: {(creditor, debtor): amount}"""
+        return {(c, d): amount for d, c, amount in self.settlements()}
+
+    def packed_graph(self):
+        """Settlement view encoded as groupGraphPacked"""
+        return pack_cells(self.members, {
+            cell: to_paise(amount) for cell, amount in self.settlement_cells().items()
+        })
+
+    def graph_view(self):
+        """Full groupGraph-shaped dict, the compatibility view of updateGraph results"""
+        graph = {a: {b: 0 for b in self.members if b != a} for a in self.members}
+        for (c, d), amount in self.settlement_cells().items():
+            graph[c][d] = amount
+        return graph
+
+    def graph_changes(self, old_graph):
+        """Cells where the settlement view differs from a stored groupGraph"""
+        new = self.settlement_cells()
+        changes = {}
+        for a, row in (old_graph or {}).items():
+            for b, amount in (row or {}).items():
+                if amount and (a, b) not in new:
+                    changes[(a, b)] = 0
+        for (a, b), amount in new.items():
+            if ((old_graph or {}).get(a) or {}).get(b) != amount:
+                changes[(a, b)] = amount
+        return changes
@@ -0,0 +1,354 @@
+"""Maintenance commands, run against the backend configured by the usual env.
+
+    python manage.py migrate-group-ids [--batch 500] [--dry-run]
+    python manage.py migrate-item-index [--dry-run]
+    python manage.py compact-changelog [--keep 500] [--dry-run]
+    python manage.py rebuild-user-balances [--dry-run]
+    python manage.py check-balances [--workers 4] [--tolerance 0.01] [--fix]
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+
+def migrate_group_ids(api, args):
+    """Rewrite list-shaped users/<uid>/groupIds as {groupId: true} maps.
+
+    Users are read page by page and the rewrites saved in multi-path
+    updates of --batch users. Run it while nothing else writes memberships:
+    a group joined between the read and the write of a user is lost.
+    """
+    updates = {}
+    scanned = changed = 0
+
+    def flush():
+        if updates and not args.dry_run:
+            api.db.reference().update(updates)
+            api.invalidate_paths(*updates)
+        updates.clear()
+
+    for uid, user in api.iter_children("users", args.page_size):
+        scanned += 1
+        stored = (user or {}).get("groupIds")
+        if stored is None or (isinstance(stored, dict) and all(v is True for v in stored.values())):
+            continue
+        updates[f"users/{uid}/groupIds"] = {group_id: True for group_id in api.group_id_list(stored)} or None
+        changed += 1
+        if len(updates) >= args.batch:
+            flush()
+        if scanned % 10000 == 0:
+            print(f"{scanned} users scanned, {changed} rewritten")
+    flush()
+    print(f"{scanned} users scanned, {changed} rewritten{' (dry run)' if args.dry_run else ''}")
+
+
+def migrate_item_index(api, args):
+    """Fold each group's groupItems list into its groupItemIndex.
+
+    Each group is rewritten through the group write serializer, so item
+    writes made by this process wait for it. Run it with
+    GROUP_WRITE_MODE=transaction while the API is serving.
+    """
+    scanned = migrated = 0
+    for group_id, group in api.iter_children("groups", args.page_size):
+        scanned += 1
+        if not (group or {}).get("groupItems"):
+            continue
+        keys = {item["itemId"]: api.item_sort_key(item) for item in api.fetch_items(group["groupItems"])}
+
+        def fold(group_data, updates, group_id=group_id, keys=keys):
+            if not group_data or not group_data.get("groupItems"):
+                return False
+            index = group_data.setdefault("groupItemIndex", {})
+            for item_id in group_data.pop("groupItems"):
+                # Items that no longer exist are dropped with the list
+                if item_id in keys and item_id not in index:
+                    index[item_id] = keys[item_id]
+                    updates[f"groups/{group_id}/groupItemIndex/{item_id}"] = keys[item_id]
+            updates[f"groups/{group_id}/groupItems"] = None
+            return True
+
+        if args.dry_run or api.submit_group_mutation(group_id, fold):
+            migrated += 1
+        if scanned % 1000 == 0:
+            print(f"{scanned} groups scanned, {migrated} migrated")
+    print(f"{scanned} groups scanned, {migrated} migrated{' (dry run)' if args.dry_run else ''}")
+
+
+def compact_changelog(api, args):
+    """Trim every group's change log to its last --keep entries.
+
+    Writes trim the log one entry at a time, so this is only needed after
+    lowering CHANGELOG_KEEP. Logs of groups that no longer exist are
+    deleted. Clients behind the trimmed entries get those groups whole.
+    """
+    updates = {}
+    scanned = trimmed = 0
+
+    def flush():
+        if updates and not args.dry_run:
+            api.db.reference().update(updates)
+        updates.clear()
+
+    for group_id, entries in api.iter_children("changeLog", args.page_size):
+        scanned += 1
+        if not api.db.reference(f"groups/{group_id}").get(shallow=True):
+            updates[f"changeLog/{group_id}"] = None
+            trimmed += 1
+        else:
+            keys = sorted(entries or {})
+            drop = keys[:max(0, len(keys) - args.keep)]
+            for key in drop:
+                updates[f"changeLog/{group_id}/{key}"] = None
+            trimmed += bool(drop)
+        if len(updates) >= args.batch:
+            flush()
+    flush()
+    print(f"{scanned} logs scanned, {trimmed} trimmed{' (dry run)' if args.dry_run else ''}")
+
+
+def rebuild_user_balances(api, args):
+    """Recompute userBalances/<uid>/<gid> from every group's balances.
+
+    A group's balances are taken from groupBalances, or derived from
+    groupGraph for groups written before it existed. Each group is
+    written through the group write serializer so live item writes are
+    not overwritten with older amounts. Entries for groups that no longer
+    exist, or that the user has left, are removed afterwards.
+    """
+    from ledger import Ledger
+
+    scanned = 0
+    members = {}
+    for group_id, group in api.iter_children("groups", args.page_size):
+        scanned += 1
+
+        def rebuild(group_data, updates, group_id=group_id):
+            if not group_data:
+                return None
+            balances = Ledger.from_group(group_data).balances()
+            for uid in group_data.get("groupMembers") or []:
+                updates[f"userBalances/{uid}/{group_id}"] = balances.get(uid, 0)
+            return set(group_data.get("groupMembers") or [])
+
+        if args.dry_run:
+            uids = set((group or {}).get("groupMembers") or [])
+        else:
+            uids = api.submit_group_mutation(group_id, rebuild) or set()
+        for uid in uids:
+            members.setdefault(uid, set()).add(group_id)
+        if scanned % 1000 == 0:
+            print(f"{scanned} groups rebuilt")
+
+    stale = {}
+    for uid, groups in api.iter_children("userBalances", args.page_size):
+        for group_id in groups or {}:
+            if group_id not in members.get(uid, ()):
+                stale[f"userBalances/{uid}/{group_id}"] = None
+    if stale and not args.dry_run:
+        api.db.reference().update(stale)
+        api.invalidate_paths(*stale)
+    print(f"{scanned} groups rebuilt, {len(stale)} stale entries removed{' (dry run)' if args.dry_run else ''}")
+
+
+def replay_group(task):
+    """Replay one group's items and compare the result with its stored balances.
+
+    Runs in a pool process. Returns (group_id, rev, items, drift, expected):
+    drift maps each member off by more than the tolerance to stored minus
+    replayed, and expected (the replayed balances) is only sent back when
+    something drifted.
+    """
+    from ledger import Ledger
+
+    group_id, rev, group, items, tolerance = task
+    replayed = Ledger(group.get("groupMembers") or [])
+    # (sort key, payer, splitters, values): date order
+    for _, payer, spliters, values in sorted(items):
+        replayed.apply_item(payer, spliters, values)
+    expected = replayed.balances()
+
+    stored = [Ledger.from_group(group).balances()]
+    if "groupBalances" in group and ("groupGraph" in group or "groupGraphPacked" in group):
+        # The graph is checked on its own as well, through the balances it implies
+        stored.append(Ledger.from_group({k: v for k, v in group.items() if k != "groupBalances"}).balances())
+    drift = {}
+    for balances in stored:
+        for uid in set(expected) | set(balances):
+            diff = round(balances.get(uid, 0) - expected.get(uid, 0), 2)
+            if abs(diff) > tolerance and abs(diff) > abs(drift.get(uid, 0)):
+                drift[uid] = diff
+    return group_id, rev, len(items), drift, expected if drift else None
+
+
+def check_balances(api, args):
+    """Replay every group's items and report balances that have drifted.
+
+    Groups are read a page at a time and each page's items fetched with
+    one itemGroupId query per group on RTDB (".indexOn": "itemGroupId"
+    on items; without it, and on local stores, one read per item). Replays run on --workers processes
+    with at most two groups per worker queued, so memory stays bounded by
+    the page size. Stored groupBalances, and the balances groupGraph
+    implies, are compared with the replay within --tolerance. Drifted
+    groups are printed as JSON lines. With --fix, the replayed balances
+    are written back --batch groups at a time through the group write
+    serializer, skipping groups written since they were read. The
+    serializer runs in transaction mode here: the API servers are other
+    processes, and a transaction on groups/<gid> retries when one of
+    their writes lands first, so the groupRev check sees it.
+    """
+    from ledger import Ledger
+
+    if args.fix:
+        api.GROUP_WRITE_MODE = "transaction"
+
+    totals = {"groups": 0, "items": 0, "drifted": 0, "fixed": 0, "skipped": 0,
+              "unlisted": 0, "missing": 0, "invalid": 0}
+    started = time.monotonic()
+    fixes = []
+
+    def load(entry):
+        group_id, group = entry
+        listed = api.group_item_ids(group)
+        found = None
+        if api.STORAGE_BACKEND == "firebase":
+            try:
+                found = api.db.reference("items").order_by_child("itemGroupId").equal_to(group_id).get() or {}
+            except Exception:
+                pass
+        if found is None:
+            # Local stores answer the query by scanning every item
+            found = {item["itemId"]: item for item in api.fetch_items(listed)}
+        items = []
+        counts = {"unlisted": len(set(found) - set(listed)), "missing": 0, "invalid": 0}
+        for item_id in listed:
+            item = found.get(item_id)
+            if not item:
+                counts["missing"] += 1
+            elif api.item_error(item):
+                counts["invalid"] += 1
+            else:
+                item = dict(item, itemId=item_id)
+                items.append((api.item_sort_key(item), item["itemPayer"][0],
+                              list(item["itemSpliter"]), [float(v) for v in item["itemSpliterValue"]]))
+        stub = {k: v for k, v in group.items() if k not in ("groupItems", "groupItemIndex")}
+        return (group_id, group.get("groupRev") or 0, stub, items, args.tolerance), counts
+
+    def fix(entry):
+        group_id, rev, expected = entry
+
+        def rewrite(group_data, updates):
+            # Written since it was checked: its replay is out of date
+            if not group_data or (group_data.get("groupRev") or 0) != rev:
+                return False
+            ledger = Ledger(group_data.get("groupMembers") or [], expected)
+            ledger.touched = set(range(len(ledger.members)))
+            api.apply_ledger(group_id, group_data, ledger, updates)
+            return True
+
+        return api.submit_group_mutation(group_id, rewrite)
+
+    def flush_fixes():
+        for ok in api.fan_out(fix, fixes):
+            totals["fixed" if ok else "skipped"] += 1
+        fixes.clear()
+
+    def collect(done):
+        for future in done:
+            group_id, rev, count, drift, expected = future.result()
+            totals["groups"] += 1
+            totals["items"] += count
+            if drift:
+                totals["drifted"] += 1
+                print(json.dumps({"groupId": group_id, "rev": rev, "drift": drift}))
+                if args.fix:
+                    fixes.append((group_id, rev, expected))
+                    if len(fixes) >= args.batch:
+                        flush_fixes()
+            if totals["groups"] % args.progress == 0:
+                elapsed = time.monotonic() - started
+                print(f"{totals['groups']} groups, {totals['items']} items checked, "
+                      f"{totals['drifted']} drifted ({totals['items'] / elapsed:.0f} items/s)", file=sys.stderr)
+
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+        running = set()
+        page = []
+
+        def submit_page():
+            nonlocal running
+            for task, counts in api.fan_out(load, page):
+                for key, n in counts.items():
+                    totals[key] += n
+                if len(running) >= 2 * args.workers:
+                    done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                running.add(pool.submit(replay_group, task))
+            page.clear()
+
+        for group_id, group in api.iter_children("groups", args.page_size):
+            if group:
+                page.append((group_id, group))
+            if len(page) >= args.page_size:
+                submit_page()
+        submit_page()
+        collect(concurrent.futures.wait(running).done)
+    flush_fixes()
+
+    elapsed = time.monotonic() - started
+    summary = ", ".join(f"{n} {key}" for key, n in totals.items() if n or key in ("groups", "items", "drifted"))
+    print(f"{summary} in {elapsed:.1f}s", file=sys.stderr)
+
+
+COMMANDS = {
+    "migrate-group-ids": migrate_group_ids,
+    "migrate-item-index": migrate_item_index,
+    "compact-changelog": compact_changelog,
+    "rebuild-user-balances": rebuild_user_balances,
+    "check-balances": check_balances,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate-group-ids", help=migrate_group_ids.__doc__.splitlines()[0])
+    migrate.add_argument("--batch", type=int, default=500, help="users per multi-path update")
+    migrate.add_argument("--page-size", type=int, default=1000)
+    migrate.add_argument("--dry-run", action="store_true")
+    index = sub.add_parser("migrate-item-index", help=migrate_item_index.__doc__.splitlines()[0])
+    index.add_argument("--page-size", type=int, default=200)
+    index.add_argument("--dry-run", action="store_true")
+    compact = sub.add_parser("compact-changelog", help=compact_changelog.__doc__.splitlines()[0])
+    compact.add_argument("--keep", type=int, default=int(os.environ.get("CHANGELOG_KEEP", 500)))
+    compact.add_argument("--batch", type=int, default=500, help="paths per multi-path update")
+    compact.add_argument("--page-size", type=int, default=50)
+    compact.add_argument("--dry-run", action="store_true")
+    balances = sub.add_parser("rebuild-user-balances", help=rebuild_user_balances.__doc__.splitlines()[0])
+    balances.add_argument("--page-size", type=int, default=200)
+    balances.add_argument("--dry-run", action="store_true")
+    check = sub.add_parser("check-balances", help=check_balances.__doc__.splitlines()[0])
+    check.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="replay processes")
+    check.add_argument("--tolerance", type=float, default=0.01, help="largest difference accepted, in rupees")
+    check.add_argument("--fix", action="store_true", help="write the replayed balances to drifted groups")
+    check.add_argument("--batch", type=int, default=100, help="groups fixed concurrently")
+    check.add_argument("--page-size", type=int, default=100)
+    check.add_argument("--progress", type=int, default=1000, help="report every N groups")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import dummpyApi2 as api
+
+    COMMANDS[args.command](api, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Request and backend metrics in the Prometheus text format.
+
+MetricsRegistry keeps, per (route, method), request counts by status, a
+latency histogram, and the backend reads, writes, bytes and wait time
+reported by storage.InstrumentedDB. The route of the request being
+served travels in a context variable, so backend calls made on pool
+threads are charged to it when the task was submitted through
+bind_context. A streamed response is timed until it is closed, and its
+body runs in the request's context through stream_in_request.
+"""
+import bisect
+import collections
+import contextvars
+import random
+import threading
+import time
+
+# Prometheus client defaults, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+BACKGROUND_ROUTE = ("<background>", "")
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def bind_context(fn):
+    """fn wrapped to run in a copy of the caller's context, for pool threads"""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+
+def stream_in_request(iterable, ctx):
+    """Iterate a streamed response body with ctx as the current request,
+    so the backend calls it makes are charged to its route"""
+    iterator = iter(iterable)
+    try:
+        while True:
+            token = current_request.set(ctx)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                current_request.reset(token)
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            token = current_request.set(ctx)
+            try:
+                close()
+            finally:
+                current_request.reset(token)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, buckets, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteStats:
+    __slots__ = ("statuses", "latency", "reads", "writes", "bytes_in", "bytes_out", "wait")
+
+    def __init__(self, buckets):
+        self.statuses = collections.Counter()
+        self.latency = Histogram(buckets)
+        self.reads = self.writes = 0
+        self.bytes_in = self.bytes_out = 0
+        self.wait = 0.0
+
+
+class RequestContext:
+    """The route being served, plus the backend calls made for it when traced"""
+    __slots__ = ("key", "start", "trace")
+
+    def __init__(self, key, trace):
+        self.key = key
+        self.start = time.perf_counter()
+        self.trace = [] if trace else None
+
+
+class MetricsRegistry:
+    """Thread-safe per-route totals.
+
+    trace_sample is the fraction of requests whose backend calls are kept;
+    a sampled request slower than slow_seconds is stored in traces (the
+    last max_traces of them) and handed to on_slow if one is given.
+    payload_bytes=False says the backend reports no payload sizes, so
+    byte counts are left out of the output instead of showing zeros.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, trace_sample=0.0, slow_seconds=1.0,
+                 max_traces=100, on_slow=None, payload_bytes=True):
+        self.buckets = tuple(buckets)
+        self.payload_bytes = payload_bytes
+        self.trace_sample = trace_sample
+        self.slow_seconds = slow_seconds
+        self.on_slow = on_slow
+        self.traces = collections.deque(maxlen=max_traces)
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def _route(self, key):
+        stats = self._routes.get(key)
+        if stats is None:
+            stats = self._routes[key] = RouteStats(self.buckets)
+        return stats
+
+    def start_request(self, route, method):
+        """Begin timing a request; returns the token for finish_request"""
+        traced = self.trace_sample > 0 and random.random() < self.trace_sample
+        ctx = RequestContext((route, method), traced)
+        return current_request.set(ctx)
+
+    def detach_request(self, token):
+        """End a request's hold on the context without recording it.
+
+        For streamed responses: the returned context is handed to
+        stream_in_request for the body and to finish_detached once the
+        response is closed.
+        """
+        ctx = current_request.get()
+        current_request.reset(token)
+        return ctx
+
+    def finish_request(self, token, status):
+        self.finish_detached(self.detach_request(token), status)
+
+    def finish_detached(self, ctx, status):
+        if ctx is None:
+            return
+        elapsed = time.perf_counter() - ctx.start
+        with self._lock:
+            stats = self._route(ctx.key)
+            stats.statuses[status] += 1
+            stats.latency.observe(self.buckets, elapsed)
+        if ctx.trace is not None and elapsed >= self.slow_seconds:
+            trace = {
+                "route": ctx.key[0],
+                "method": ctx.key[1],
+                "status": status,
+                "ms": round(elapsed * 1000, 2),
+                "calls": list(ctx.trace),
+            }
+            self.traces.append(trace)
+            if self.on_slow is not None:
+                self.on_slow(trace)
+
+    def record_backend(self, kind, seconds, bytes_out, bytes_in, path=None):
+        """storage.InstrumentedDB callback"""
+        ctx = current_request.get()
+        key = ctx.key if ctx is not None else BACKGROUND_ROUTE
+        with self._lock:
+            stats = self._route(key)
+            if kind == "read":
+                stats.reads += 1
+            else:
+                stats.writes += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.wait += seconds
+        if ctx is not None and ctx.trace is not None:
+            call = {"kind": kind, "path": path, "ms": round(seconds * 1000, 3)}
+            if self.payload_bytes:
+                call["bytesIn"] = bytes_in
+                call["bytesOut"] = bytes_out
+            ctx.trace.append(call)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            routes = sorted(
+                (key, stats.statuses.copy(), list(stats.latency.counts), stats.latency.sum,
+                 stats.latency.count, stats.reads, stats.writes, stats.bytes_in,
+                 stats.bytes_out, stats.wait)
+                for key, stats in self._routes.items()
+            )
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        family("api_requests_total", "counter", "Requests served, by route, method and status.")
+        for key, statuses, *_ in routes:
+            for status, count in sorted(statuses.items()):
+                out.append(f"api_requests_total{_labels(key, status=status)} {count}")
+
+        family("api_request_duration_seconds", "histogram", "Request latency, by route and method.")
+        for key, _, counts, total, count, *_ in routes:
+            if not count:
+                continue
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append(f"api_request_duration_seconds_bucket{_labels(key, le=le)} {cumulative}")
+            out.append(f"api_request_duration_seconds_sum{_labels(key)} {total!r}")
+            out.append(f"api_request_duration_seconds_count{_labels(key)} {count}")
+
+        family("api_backend_calls_total", "counter", "Storage backend calls, by route and kind.")
+        for key, *_, reads, writes, _, _, _ in routes:
+            out.append(f"api_backend_calls_total{_labels(key, kind='read')} {reads}")
+            out.append(f"api_backend_calls_total{_labels(key, kind='write')} {writes}")
+
+        if self.payload_bytes:
+            family("api_backend_bytes_total", "counter",
+                   "Storage payload bytes, by route and direction (in = read from the backend).")
+            for key, *_, bytes_in, bytes_out, _ in routes:
+                out.append(f"api_backend_bytes_total{_labels(key, direction='in')} {bytes_in}")
+                out.append(f"api_backend_bytes_total{_labels(key, direction='out')} {bytes_out}")
+
+        family("api_backend_wait_seconds_total", "counter", "Time spent waiting on the storage backend.")
+        for key, *_, wait in routes:
+            out.append(f"api_backend_wait_seconds_total{_labels(key)} {wait!r}")
+
+        return "\n".join(out) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(key, **extra):
+    route, method = key
+    pairs = [("route", route), ("method", method)] + list(extra.items())
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
@@ -0,0 +1,124 @@
+"""Production server: gunicorn with threaded workers and the app preloaded.
+
+    python serve.py [--workers 1] [--threads 32] [--bind 0.0.0.0:7000]
+                    [--events-bind 0.0.0.0:7001] [--event-streams 256]
+
+The app module is imported once in the master and forked into the
+workers; each worker then rebuilds its own storage connection, thread
+pools and log writer (dummpyApi2.init_worker). On SIGTERM, workers stop
+accepting connections and are given --graceful-timeout seconds to finish
+in-flight requests and queued group writes.
+
+The default is one worker with --threads request threads. Handlers
+spend most of their time waiting on the backend, and a single process
+keeps GROUP_WRITE_MODE=local: group writes are serialized in memory and
+send only the paths they change.
+
+More workers (--workers or WEB_WORKERS) are opt-in, and each one has its
+own read cache, which may lag writes made by other workers by up to
+CACHE_TTL_SECONDS. Group writes then default to
+GROUP_WRITE_MODE=transaction so they stay serialized across processes.
+That transaction uploads the whole groups/<gid> node, with its graph and
+item index, on every batch. Its change-log entry is a second write,
+which /sync checks for gaps before trusting it. Live events come from
+RTDB listeners (EVENTS_SOURCE=rtdb) so every worker's streams see every
+write. The memory backend cannot be shared, so it always runs a single
+worker.
+
+Event streams (GET /groups/<groupId>/events) are served by each worker
+from one asyncio thread on --events-bind (0.0.0.0:<port + 1> by
+default; every worker binds it with SO_REUSEPORT). There an idle stream
+costs a socket and a small queue, not a thread, and a worker holds up to
+EVENTS_ASYNC_MAX_STREAMS of them (10000 by default). Route that path to
+--events-bind at the proxy. The same URL on --bind still works, but
+there a stream holds a worker thread for as long as the client stays
+connected, so each worker gets --event-streams threads on top of
+--threads for them and refuses streams beyond that.
+
+python dummpyApi2.py still starts the single-process development server.
+"""
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication
+
+
+def post_fork(server, worker):
+    import dummpyApi2
+
+    dummpyApi2.init_worker()
+
+
+def worker_exit(server, worker):
+    import dummpyApi2
+
+    dummpyApi2.shutdown_worker()
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import dummpyApi2
+
+        return dummpyApi2.app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    port = int(os.environ.get("PORT", 7000))
+    parser.add_argument("--bind", default=f"0.0.0.0:{port}")
+    parser.add_argument("--events-bind", default=os.environ.get("WEB_EVENTS_BIND", f"0.0.0.0:{port + 1}"),
+                        help="address of the asyncio event stream listener ('' turns it off)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_WORKERS", 1)),
+                        help="worker processes; more than one switches group writes to transactions")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("WEB_THREADS", 32)))
+    parser.add_argument("--event-streams", type=int, default=int(os.environ.get("WEB_EVENT_STREAMS", 256)),
+                        help="extra threads per worker reserved for event streams served on --bind")
+    parser.add_argument("--timeout", type=int, default=int(os.environ.get("WEB_TIMEOUT", 60)),
+                        help="seconds a worker may stay silent before it is restarted")
+    parser.add_argument("--graceful-timeout", type=int,
+                        default=int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30)))
+    parser.add_argument("--keepalive", type=int, default=int(os.environ.get("WEB_KEEPALIVE", 5)))
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("WEB_MAX_REQUESTS", 0)),
+                        help="restart a worker after this many requests (0: never)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workers = args.workers
+    if os.environ.get("STORAGE_BACKEND") == "memory":
+        workers = 1
+    if workers > 1:
+        os.environ.setdefault("GROUP_WRITE_MODE", "transaction")
+        if os.environ.get("STORAGE_BACKEND", "firebase") == "firebase":
+            os.environ.setdefault("EVENTS_SOURCE", "rtdb")
+    os.environ.setdefault("EVENTS_MAX_STREAMS", str(args.event_streams))
+    os.environ.setdefault("EVENTS_BIND", args.events_bind)
+
+    Server({
+        "bind": args.bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": args.threads + args.event_streams,
+        "preload_app": True,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "keepalive": args.keepalive,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        "accesslog": None,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
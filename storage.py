@@ -0,0 +1,748 @@
+"""Storage backends behind the db.reference(...) calls in dummpyApi2.
+
+open_backend("firebase") returns firebase_admin's own db and auth
+modules. "sqlite" and "memory" return local stand-ins that implement the
+same surface the handlers use:
+
+    ref = db.reference("groups/abc")
+    ref.get() / ref.set(v) / ref.update({...}) / ref.push(v) / ref.delete()
+    ref.child("x") / ref.transaction(fn)
+    ref.order_by_key().start_at(k).limit_to_first(n).get()
+
+Values follow Realtime Database rules: None or empty containers delete a
+node, lists are stored as maps with integer keys and come back as lists
+when they are mostly contiguous, and multi-path updates are atomic.
+"""
+import copy
+import hashlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_lock = threading.Lock()
+_last_push = [0, []]
+
+
+def new_push_id():
+    """Chronologically ordered key in the same format as db.reference().push().
+
+    Generated locally so batch writes do not need a round trip per key.
+    """
+    with _push_lock:
+        now = int(time.time() * 1000)
+        if now == _last_push[0]:
+            rand = _last_push[1]
+            i = 11
+            while rand[i] == 63:
+                rand[i] = 0
+                i -= 1
+            rand[i] += 1
+        else:
+            _last_push[0] = now
+            _last_push[1] = rand = [random.randrange(64) for _ in range(12)]
+        stamp = []
+        for _ in range(8):
+            stamp.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(stamp)) + "".join(PUSH_CHARS[r] for r in rand)
+
+
+# -----------------------------
+# 🔥 VALUE HELPERS
+# -----------------------------
+def split_path(path):
+    return [p for p in (path or "").split("/") if p]
+
+
+def to_tree(value):
+    """Normalize a value the way RTDB stores it: lists become int-keyed maps,
+    None and empty containers disappear"""
+    if isinstance(value, (list, tuple)):
+        value = {str(i): v for i, v in enumerate(value)}
+    if isinstance(value, dict):
+        tree = {}
+        for k, v in value.items():
+            v = to_tree(v)
+            if v is not None:
+                tree[str(k)] = v
+        return tree or None
+    return value
+
+
+def from_tree(node):
+    """Inverse of to_tree, turning mostly-contiguous int-keyed maps back into lists"""
+    if not isinstance(node, dict):
+        return node
+    value = {k: from_tree(v) for k, v in node.items()}
+    if value and all(k.isdigit() and (k == "0" or not k.startswith("0")) for k in value):
+        size = max(int(k) for k in value) + 1
+        if size <= 2 * len(value):
+            return [value.get(str(i)) for i in range(size)]
+    return value
+
+
+def _sort_value(value):
+    """RTDB ordering of child values: null, false, true, numbers, strings, objects"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+class QueryOptions:
+    def __init__(self, order="key", child=None):
+        self.order = order
+        self.child = child
+        self.start = None
+        self.end = None
+        self.first = None
+        self.last = None
+
+    def sort_key(self, key, node):
+        if self.order == "key":
+            return key
+        if self.order == "value":
+            return _sort_value(node)
+        value = node
+        for part in split_path(self.child):
+            value = value.get(part) if isinstance(value, dict) else None
+        return _sort_value(value)
+
+    def bound(self, value):
+        return value if self.order == "key" else _sort_value(value)
+
+    def select(self, children):
+        """Order, filter and limit (key, node) pairs"""
+        rows = sorted(children, key=lambda kv: (self.sort_key(*kv), kv[0]))
+        if self.start is not None:
+            start = self.bound(self.start)
+            rows = [kv for kv in rows if self.sort_key(*kv) >= start]
+        if self.end is not None:
+            end = self.bound(self.end)
+            rows = [kv for kv in rows if self.sort_key(*kv) <= end]
+        if self.first is not None:
+            rows = rows[:self.first]
+        if self.last is not None:
+            rows = rows[-self.last:] if self.last else []
+        return rows
+
+
+# -----------------------------
+# 🔥 REFERENCE / QUERY
+# -----------------------------
+class Reference:
+    """db.reference(path) for the local backends"""
+
+    def __init__(self, store, path=None):
+        self._store = store
+        self._parts = split_path(path)
+        self.path = "/" + "/".join(self._parts)
+        self.key = self._parts[-1] if self._parts else None
+
+    @property
+    def parent(self):
+        if not self._parts:
+            return None
+        return Reference(self._store, "/".join(self._parts[:-1]))
+
+    def child(self, path):
+        return Reference(self._store, "/".join(self._parts + split_path(path)))
+
+    def get(self, etag=False, shallow=False):
+        value = self._store.get_node(self._parts)
+        if shallow and isinstance(value, dict):
+            value = {k: (True if isinstance(v, dict) else v) for k, v in value.items()}
+        value = from_tree(value)
+        return (value, None) if etag else value
+
+    def set(self, value):
+        self._store.set_nodes([(self._parts, to_tree(value))])
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        if None in value.keys():
+            raise ValueError("Dictionary must not contain None keys.")
+        self._store.set_nodes([(self._parts + split_path(k), to_tree(v)) for k, v in value.items()])
+
+    def push(self, value=""):
+        ref = self.child(new_push_id())
+        ref.set(value)
+        return ref
+
+    def delete(self):
+        self._store.set_nodes([(self._parts, None)])
+
+    def transaction(self, transaction_update):
+        return from_tree(self._store.transaction(
+            self._parts, lambda node: to_tree(transaction_update(from_tree(node)))))
+
+    def order_by_key(self):
+        return Query(self, QueryOptions("key"))
+
+    def order_by_value(self):
+        return Query(self, QueryOptions("value"))
+
+    def order_by_child(self, path):
+        return Query(self, QueryOptions("child", path))
+
+
+class Query:
+    def __init__(self, ref, options):
+        self._ref = ref
+        self._options = options
+
+    def start_at(self, start):
+        self._options.start = start
+        return self
+
+    def end_at(self, end):
+        self._options.end = end
+        return self
+
+    def equal_to(self, value):
+        self._options.start = self._options.end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._options.first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._options.last = limit
+        return self
+
+    def get(self):
+        rows = self._ref._store.query_children(self._ref._parts, self._options)
+        return OrderedDict((k, from_tree(v)) for k, v in rows)
+
+
+# -----------------------------
+# 🔥 IN-MEMORY BACKEND
+# -----------------------------
+class MemoryStore:
+    """Whole database as one nested dict guarded by a lock"""
+
+    def __init__(self):
+        self._root = {}
+        self._lock = threading.RLock()
+
+    def reference(self, path=None):
+        return Reference(self, path)
+
+    def _get(self, parts):
+        node = self._root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _set(self, parts, value):
+        if not parts:
+            self._root = value if isinstance(value, dict) else {}
+            return
+        node, trail = self._root, []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[part] = {}
+            trail.append((node, part))
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+            # Drop parents that became empty, as RTDB does
+            for parent, part in reversed(trail):
+                if parent[part]:
+                    break
+                del parent[part]
+        else:
+            node[parts[-1]] = value
+
+    def get_node(self, parts):
+        with self._lock:
+            return copy.deepcopy(self._get(parts))
+
+    def set_nodes(self, writes):
+        # Values arrive through to_tree, which always builds new containers
+        with self._lock:
+            for parts, value in writes:
+                self._set(parts, value)
+
+    def transaction(self, parts, fn):
+        with self._lock:
+            value = fn(self._get(parts))
+            self._set(parts, value)
+            return value
+
+    def query_children(self, parts, options):
+        with self._lock:
+            node = self._get(parts)
+            if not isinstance(node, dict):
+                return []
+            return [(k, copy.deepcopy(v)) for k, v in options.select(node.items())]
+
+
+# -----------------------------
+# 🔥 SQLITE BACKEND
+# -----------------------------
+# One row per leaf value, keyed by its path with SEP between segments.
+# SEP sorts before every character allowed in an RTDB key, so the rows of
+# a subtree form one contiguous primary-key range and appear in key order.
+SEP = "\x01"
+SEP_END = "\x02"
+
+
+class SQLiteStore:
+    """Leaf-per-row SQLite database; a subtree read is one index range scan"""
+
+    def __init__(self, filename=":memory:"):
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        if filename != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+
+    def reference(self, path=None):
+        return Reference(self, path)
+
+    @staticmethod
+    def _key(parts):
+        return SEP.join(parts)
+
+    def _rows(self, parts):
+        key = self._key(parts)
+        if not parts:
+            return self._conn.execute("SELECT path, value FROM nodes ORDER BY path")
+        return self._conn.execute(
+            "SELECT path, value FROM nodes WHERE path = ? OR (path >= ? AND path < ?) ORDER BY path",
+            (key, key + SEP, key + SEP_END))
+
+    def _get(self, parts):
+        depth = len(parts)
+        tree = None
+        for path, value in self._rows(parts):
+            rel = path.split(SEP)[depth:] if path else []
+            if not rel:
+                return json.loads(value)
+            if tree is None:
+                tree = {}
+            node = tree
+            for part in rel[:-1]:
+                node = node.setdefault(part, {})
+            node[rel[-1]] = json.loads(value)
+        return tree
+
+    def _leaves(self, parts, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                yield from self._leaves(parts + [k], v)
+        else:
+            yield self._key(parts), json.dumps(value)
+
+    def _set(self, parts, value):
+        key = self._key(parts)
+        if parts:
+            # A scalar at any ancestor is replaced by the new subtree
+            ancestors = [self._key(parts[:i]) for i in range(1, len(parts))]
+            if ancestors:
+                self._conn.execute(
+                    f"DELETE FROM nodes WHERE path IN ({','.join('?' * len(ancestors))})", ancestors)
+            self._conn.execute(
+                "DELETE FROM nodes WHERE path = ? OR (path >= ? AND path < ?)", (key, key + SEP, key + SEP_END))
+        else:
+            self._conn.execute("DELETE FROM nodes")
+        if value is not None:
+            self._conn.executemany("INSERT INTO nodes (path, value) VALUES (?, ?)", self._leaves(parts, value))
+
+    def get_node(self, parts):
+        with self._lock:
+            return self._get(parts)
+
+    def set_nodes(self, writes):
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so a multi-path update
+            # is atomic across processes sharing the file too
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for parts, value in writes:
+                    self._set(parts, value)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def transaction(self, parts, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = fn(self._get(parts))
+                self._set(parts, value)
+                self._conn.execute("COMMIT")
+                return value
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def query_children(self, parts, options):
+        with self._lock:
+            if options.order == "key" and options.last is None:
+                return self._first_children_by_key(parts, options)
+            node = self._get(parts)
+        if not isinstance(node, dict):
+            return []
+        return options.select(node.items())
+
+    def _first_children_by_key(self, parts, options):
+        """Key-ordered children read lazily from the index, stopping at the limit"""
+        base = self._key(parts) + SEP if parts else ""
+        depth = len(parts)
+        low = base + (options.start or "")
+        rows = self._conn.execute(
+            "SELECT path, value FROM nodes WHERE path >= ? AND path < ? ORDER BY path",
+            (low, base[:-1] + SEP_END if parts else "\U0010ffff"))
+        children = []
+        for child, group in itertools.groupby(rows, key=lambda row: row[0].split(SEP)[depth]):
+            if options.end is not None and child > options.end:
+                break
+            if options.first is not None and len(children) >= options.first:
+                break
+            node = {}
+            for path, value in group:
+                rel = path.split(SEP)[depth + 1:]
+                if not rel:
+                    node = json.loads(value)
+                    break
+                target = node
+                for part in rel[:-1]:
+                    target = target.setdefault(part, {})
+                target[rel[-1]] = json.loads(value)
+            children.append((child, node))
+        return children
+
+
+# -----------------------------
+# 🔥 LOCAL AUTH
+# -----------------------------
+class EmailAlreadyExistsError(Exception):
+    pass
+
+
+class UserNotFoundError(Exception):
+    pass
+
+
+class LocalUserRecord:
+    def __init__(self, uid, email, display_name):
+        self.uid = uid
+        self.email = email
+        self.display_name = display_name
+
+
+class LocalImportUserRecord:
+    def __init__(self, uid, email=None, display_name=None, password_hash=None, password_salt=None, **_):
+        self.uid = uid
+        self.email = email
+        self.display_name = display_name
+        self.password_hash = password_hash
+        self.password_salt = password_salt
+
+
+class LocalUserImportHash:
+    def __init__(self, name, rounds=None):
+        self.name = name
+        self.rounds = rounds
+
+    @classmethod
+    def pbkdf2_sha256(cls, rounds):
+        return cls("PBKDF2_SHA256", rounds)
+
+
+class LocalErrorInfo:
+    def __init__(self, index, reason):
+        self.index = index
+        self.reason = reason
+
+
+class LocalUserImportResult:
+    def __init__(self, total, errors):
+        self.errors = errors
+        self.failure_count = len(errors)
+        self.success_count = total - len(errors)
+
+
+class LocalAuth:
+    """The part of firebase_admin.auth the handlers use, kept under _auth/ in the store"""
+
+    EmailAlreadyExistsError = EmailAlreadyExistsError
+    UserNotFoundError = UserNotFoundError
+    ImportUserRecord = LocalImportUserRecord
+    UserImportHash = LocalUserImportHash
+    MAX_IMPORT_USERS = 1000
+
+    def __init__(self, store):
+        self._store = store
+
+    @staticmethod
+    def _email_key(email):
+        return hashlib.sha1(email.lower().encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _hash_password(password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), 1000).hex()
+
+    def create_user(self, email=None, password=None, display_name=None, uid=None):
+        uid = uid or new_push_id()[-12:] + os.urandom(8).hex()
+        claimed = {}
+
+        def claim(current):
+            if current:
+                claimed["taken"] = True
+                return current
+            return uid
+
+        self._store.reference(f"_auth/emails/{self._email_key(email)}").transaction(claim)
+        if claimed.get("taken"):
+            raise EmailAlreadyExistsError(f"The user with the provided email already exists ({email}).")
+        salt = os.urandom(8).hex()
+        self._store.reference(f"_auth/users/{uid}").set({
+            "email": email,
+            "displayName": display_name,
+            "salt": salt,
+            "passwordHash": self._hash_password(password or "", salt),
+        })
+        return LocalUserRecord(uid, email, display_name)
+
+    def import_users(self, users, hash_alg=None):
+        """Create or overwrite accounts in one batch, like auth.import_users.
+
+        Emails held by another uid are reported in the result's errors by
+        index; the other records are written in one update.
+        """
+        if len(users) > self.MAX_IMPORT_USERS:
+            raise ValueError(f"Users list must not have more than {self.MAX_IMPORT_USERS} elements.")
+        errors = []
+        updates = {}
+        for index, user in enumerate(users):
+            if user.email:
+                claimed = {}
+
+                def claim(current, uid=user.uid):
+                    if current and current != uid:
+                        claimed["taken"] = True
+                        return current
+                    return uid
+
+                self._store.reference(f"_auth/emails/{self._email_key(user.email)}").transaction(claim)
+                if claimed.get("taken"):
+                    errors.append(LocalErrorInfo(index, "email already exists"))
+                    continue
+            updates[f"_auth/users/{user.uid}"] = {
+                "email": user.email,
+                "displayName": user.display_name,
+                "salt": user.password_salt.decode("utf-8") if user.password_salt else None,
+                "passwordHash": user.password_hash.hex() if user.password_hash else None,
+                "hashRounds": hash_alg.rounds if hash_alg is not None else None,
+            }
+        if updates:
+            self._store.reference().update(updates)
+        return LocalUserImportResult(len(users), errors)
+
+    def get_user_by_email(self, email):
+        uid = self._store.reference(f"_auth/emails/{self._email_key(email or '')}").get()
+        if not uid:
+            raise UserNotFoundError(f"No user record found for the provided email: {email}.")
+        user = self._store.reference(f"_auth/users/{uid}").get() or {}
+        return LocalUserRecord(uid, user.get("email"), user.get("displayName"))
+
+
+# -----------------------------
+# 🔥 BACKEND SELECTION
+# -----------------------------
+def open_backend(name, credentials_path=None, database_url=None, sqlite_path=None, fresh=False):
+    """(db, auth) for a backend name: "firebase", "sqlite" or "memory".
+
+    fresh=True drops an already initialized firebase_admin app first, so a
+    forked process gets its own credentials and HTTP session.
+    """
+    if name == "firebase":
+        import firebase_admin
+        from firebase_admin import auth, credentials, db
+
+        if fresh and firebase_admin._apps:
+            firebase_admin.delete_app(firebase_admin.get_app())
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(
+                credentials.Certificate(credentials_path),
+                {"databaseURL": database_url},
+            )
+        return db, auth
+    if name == "sqlite":
+        store = SQLiteStore(sqlite_path or ":memory:")
+    elif name == "memory":
+        store = MemoryStore()
+    else:
+        raise ValueError(f"Unknown storage backend: {name}")
+    return store, LocalAuth(store)
+
+
+# -----------------------------
+# 🔥 INSTRUMENTATION
+# -----------------------------
+def payload_size(value):
+    """Approximate wire size of a value in bytes (its compact JSON)"""
+    if value is None:
+        return 0
+    return len(json.dumps(value, separators=(",", ":"), default=str))
+
+
+class BackendStats:
+    """Thread-safe totals of backend calls, fed by InstrumentedDB"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.reads = self.writes = 0
+            self.bytes_in = self.bytes_out = 0
+            self.seconds = 0.0
+
+    def record(self, kind, seconds, bytes_out, bytes_in, path=None):
+        with self._lock:
+            if kind == "read":
+                self.reads += 1
+            else:
+                self.writes += 1
+            self.bytes_out += bytes_out
+            self.bytes_in += bytes_in
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "reads": self.reads,
+                "writes": self.writes,
+                "bytesIn": self.bytes_in,
+                "bytesOut": self.bytes_out,
+                "seconds": self.seconds,
+            }
+
+
+class InstrumentedDB:
+    """Wraps firebase_admin.db or a local store and reports every backend call.
+
+    record(kind, seconds, bytes_out, bytes_in, path) is called once per get,
+    set, update, push, delete, transaction or query, with kind "read" or
+    "write". sizes=False skips measuring payloads (bytes are reported as 0),
+    which saves re-encoding large values.
+    """
+
+    def __init__(self, db, record, sizes=True):
+        self._db = db
+        self._record = record
+        self._sizes = sizes
+
+    def reference(self, path="/", **kwargs):
+        # firebase_admin.db.reference rejects path=None, so keep its default
+        return InstrumentedReference(self._db.reference(path, **kwargs), self._record, self._sizes)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class _Instrumented:
+    def __init__(self, target, record, sizes=True, path=None):
+        self._target = target
+        self._record = record
+        self._sizes = sizes
+        self._path = path if path is not None else getattr(target, "path", None)
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def _wrap(self, cls, target):
+        return cls(target, self._record, self._sizes, getattr(target, "path", self._path))
+
+    def _timed(self, kind, fn, sent=None):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if self._sizes:
+            received = payload_size(result) if kind == "read" else 0
+            self._record(kind, elapsed, payload_size(sent), received, self._path)
+        else:
+            self._record(kind, elapsed, 0, 0, self._path)
+        return result
+
+
+class InstrumentedReference(_Instrumented):
+    def child(self, path):
+        return self._wrap(InstrumentedReference, self._target.child(path))
+
+    def get(self, *args, **kwargs):
+        return self._timed("read", lambda: self._target.get(*args, **kwargs))
+
+    def set(self, value):
+        return self._timed("write", lambda: self._target.set(value), value)
+
+    def update(self, value):
+        return self._timed("write", lambda: self._target.update(value), value)
+
+    def push(self, *args, **kwargs):
+        ref = self._timed("write", lambda: self._target.push(*args, **kwargs), args[0] if args else None)
+        return self._wrap(InstrumentedReference, ref)
+
+    def delete(self):
+        return self._timed("write", self._target.delete)
+
+    def transaction(self, transaction_update):
+        return self._timed("write", lambda: self._target.transaction(transaction_update))
+
+    def order_by_key(self):
+        return self._wrap(InstrumentedQuery, self._target.order_by_key())
+
+    def order_by_value(self):
+        return self._wrap(InstrumentedQuery, self._target.order_by_value())
+
+    def order_by_child(self, path):
+        return self._wrap(InstrumentedQuery, self._target.order_by_child(path))
+
+
+class InstrumentedQuery(_Instrumented):
+    def _chain(self, name, *args):
+        return self._wrap(InstrumentedQuery, getattr(self._target, name)(*args))
+
+    def start_at(self, start):
+        return self._chain("start_at", start)
+
+    def end_at(self, end):
+        return self._chain("end_at", end)
+
+    def equal_to(self, value):
+        return self._chain("equal_to", value)
+
+    def limit_to_first(self, limit):
+        return self._chain("limit_to_first", limit)
+
+    def limit_to_last(self, limit):
+        return self._chain("limit_to_last", limit)
+
+    def get(self):
+        return self._timed("read", self._target.get)
@@ -0,0 +1,246 @@
+"""API tests against the in-memory storage backend.
+
+    python -m unittest test_api
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import types
+import unittest
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import dummpyApi2 as api
+import manage
+from ledger import Ledger, pack_graph, to_paise
+
+
+class GroupListingTest(unittest.TestCase):
+    def setUp(self):
+        api.db.reference().set(None)
+        api.invalidate_paths("")
+        self.client = api.app.test_client()
+
+    def test_packed_group_is_listed_like_get_group(self):
+        members = ["a", "b", "c"]
+        graph = {"a": {"b": 5.5, "c": 0}, "b": {"a": 0, "c": 0}, "c": {"a": 0, "b": 0}}
+        api.db.reference("groups/g1").set({
+            "groupName": "trip",
+            "groupMembers": members,
+            "groupBalances": {"a": 5.5, "b": -5.5, "c": 0},
+            "groupGraphPacked": pack_graph(graph, members),
+        })
+
+        listed = self.client.get("/groups").get_json()["data"]["groups"]
+        fetched = self.client.post("/groups/getGroup", json={"groupId": "g1"}).get_json()["data"]["group"]
+
+        self.assertEqual(len(listed), 1)
+        self.assertNotIn("groupGraphPacked", listed[0])
+        self.assertEqual(listed[0]["groupGraph"], graph)
+        self.assertEqual(listed[0]["groupGraph"], fetched["groupGraph"])
+
+
+class ListCollectionTest(unittest.TestCase):
+    def setUp(self):
+        api.db.reference().set(None)
+        api.invalidate_paths("")
+        self.client = api.app.test_client()
+        self.keys = [f"i{n}" for n in range(7)]
+        api.db.reference("items").set({key: {"itemName": key} for key in self.keys})
+
+    def test_stream_continues_from_cursor(self):
+        page = self.client.get("/items?limit=3").get_json()["data"]
+        self.assertEqual([item["itemId"] for item in page["items"]], self.keys[:3])
+
+        response = self.client.get(f"/items?stream=ndjson&cursor={page['next']}")
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["itemId"] for row in rows], self.keys[3:])
+
+        response = self.client.get(f"/items?stream=json&limit=2&cursor={page['next']}")
+        items = json.loads(response.get_data(as_text=True))["data"]["items"]
+        self.assertEqual([item["itemId"] for item in items], self.keys[3:])
+
+    def test_stream_without_cursor_sends_everything(self):
+        response = self.client.get("/items?stream=ndjson&limit=2")
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), len(self.keys))
+
+
+class GroupWriteSerializerTest(unittest.TestCase):
+    members = ["a", "b", "c", "d"]
+
+    def setUp(self):
+        api.db.reference().set(None)
+        api.invalidate_paths("")
+        self.mode = api.GROUP_WRITE_MODE
+        api.db.reference("groups/g1").set({"groupName": "trip", "groupMembers": self.members})
+
+    def tearDown(self):
+        api.GROUP_WRITE_MODE = self.mode
+
+    def item(self, rng):
+        spliters = rng.sample(self.members, rng.randint(1, len(self.members)))
+        values = [round(rng.uniform(0.01, 500), 2) for _ in spliters]
+        return {"itemName": "x", "itemDateUpdate": "2024-01-01", "itemTimeUpdate": "10:00",
+                "itemTotalAmount": round(sum(values), 2), "itemPayer": [rng.choice(self.members)],
+                "itemSpliter": spliters, "itemSpliterValue": values, "itemGroupId": "g1"}
+
+    def run_concurrently(self, mode):
+        api.GROUP_WRITE_MODE = mode
+        rng = random.Random(mode)
+        client = api.app.test_client()
+        for _ in range(20):
+            self.assertEqual(client.post("/items/create", json=self.item(rng)).status_code, 201)
+        existing = list(api.db.reference("items").get())
+        # Every existing item is deleted twice, racing 40 creates
+        jobs = [("create", self.item(rng)) for _ in range(40)] + [("delete", i) for i in existing * 2]
+        rng.shuffle(jobs)
+        failures = []
+
+        def worker(batch):
+            client = api.app.test_client()
+            for kind, arg in batch:
+                if kind == "create":
+                    code = client.post("/items/create", json=arg).status_code
+                else:
+                    code = client.delete(f"/items?itemId={arg}").status_code
+                if code not in (200, 201, 404):
+                    failures.append((kind, code))
+
+        threads = [threading.Thread(target=worker, args=(jobs[i::8],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+        items = api.db.reference("items").get() or {}
+        group = api.db.reference("groups/g1").get()
+        self.assertEqual(len(items), 40)
+        self.assertEqual(set(group["groupItemIndex"]), set(items))
+        replay = Ledger(self.members)
+        for item in items.values():
+            replay.apply_item(item["itemPayer"][0], item["itemSpliter"], item["itemSpliterValue"])
+        stored = {uid: to_paise(amount) for uid, amount in group["groupBalances"].items()}
+        self.assertEqual(stored, {uid: to_paise(amount) for uid, amount in replay.balances().items()})
+        # One revision per written batch, and batches may hold several mutations
+        self.assertLessEqual(group["groupRev"], 20 + 40 + len(existing))
+
+    def test_local_mode(self):
+        self.run_concurrently("local")
+
+    def test_transaction_mode(self):
+        self.run_concurrently("transaction")
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        api.db.reference().set(None)
+        api.invalidate_paths("")
+        self.client = api.app.test_client()
+        self.uids = []
+        for i in range(3):
+            response = self.client.post("/users/create", json={
+                "name": f"u{i}", "email": f"u{i}@x.com", "password": "secret1"})
+            self.uids.append(response.get_json()["data"]["userId"])
+        response = self.client.post("/groups/create", json={"groupName": "trip", "groupMembers": self.uids[:2]})
+        self.gid = response.get_json()["data"]["group"]["groupId"]
+        self.add_item(10)
+
+    def add_item(self, amount):
+        self.assertEqual(self.client.post("/items/create", json={
+            "itemName": "x", "itemDateUpdate": "2024-01-01", "itemTimeUpdate": "10:00",
+            "itemTotalAmount": 2 * amount, "itemPayer": [self.uids[0]], "itemSpliter": self.uids[:2],
+            "itemSpliterValue": [amount, amount], "itemGroupId": self.gid}).status_code, 201)
+
+    def item_ids(self):
+        return list(api.db.reference("items").order_by_key().get())
+
+    def sync(self, since=None):
+        query = {"userId": self.uids[1]}
+        if since is not None:
+            query["since"] = since
+        response = self.client.get("/sync", query_string=query)
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+        return response.get_json()["data"]
+
+    def changes(self, since):
+        data = self.sync(since)
+        self.assertEqual(len(data["groups"]), 1)
+        return data["groups"][0]
+
+    def test_first_sync_is_full(self):
+        group = self.changes(None)
+        self.assertTrue(group["full"])
+        self.assertEqual(group["group"]["groupMembers"], self.uids[:2])
+        self.assertEqual(len(group["items"]), 1)
+
+    def test_nothing_changed(self):
+        token = self.sync()["since"]
+        data = self.sync(token)
+        self.assertEqual(data["groups"], [])
+        self.assertEqual(data["since"], token)
+
+    def test_delta_lists_only_what_changed(self):
+        first = self.changes(None)
+        token = self.sync()["since"]
+        self.add_item(5)
+        old_id, new_id = self.item_ids()
+        self.client.put("/items/update-item", json={"itemId": new_id, "itemName": "renamed"})
+        self.client.delete(f"/items?itemId={old_id}")
+
+        group = self.changes(token)
+        self.assertFalse(group["full"])
+        self.assertNotIn("group", group)
+        self.assertEqual([(i["itemId"], i["itemName"]) for i in group["items"]], [(new_id, "renamed")])
+        self.assertEqual(group["deletedItems"], [old_id])
+        self.assertEqual(group["rev"], first["rev"] + 3)
+        stored = api.db.reference(f"groups/{self.gid}/groupBalances").get()
+        self.assertEqual(group["balances"], {uid: stored[uid] for uid in self.uids[:2]})
+        self.assertEqual(group["balances"][self.uids[1]], -5)
+
+    def test_member_change_sends_group_and_profile(self):
+        token = self.sync()["since"]
+        self.client.put("/groups/addMember", json={"groupId": self.gid, "memberEmail": "u2@x.com"})
+        data = self.sync(token)
+        group = data["groups"][0]
+        self.assertFalse(group["full"])
+        self.assertEqual(group["group"]["groupMembers"], self.uids)
+        self.assertIn(self.uids[2], [user["userId"] for user in data["users"]])
+
+    def test_compacted_log_sends_the_group_whole(self):
+        token = self.sync()["since"]
+        for amount in (1, 2, 3, 4):
+            self.add_item(amount)
+        args = types.SimpleNamespace(keep=2, batch=500, page_size=50, dry_run=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manage.compact_changelog(api, args)
+        self.assertEqual(len(api.db.reference(f"changeLog/{self.gid}").get()), 2)
+
+        group = self.changes(token)
+        self.assertTrue(group["full"])
+        self.assertEqual(len(group["items"]), 5)
+        self.assertEqual(group["group"]["groupId"], self.gid)
+
+    def test_gap_in_log_sends_the_group_whole(self):
+        token = self.sync()["since"]
+        for amount in (1, 2, 3):
+            self.add_item(amount)
+        rev = api.db.reference(f"groups/{self.gid}/groupRev").get()
+        api.db.reference(f"changeLog/{self.gid}/{api.rev_key(rev - 1)}").delete()
+
+        group = self.changes(token)
+        self.assertTrue(group["full"])
+        self.assertEqual(len(group["items"]), 4)
+
+        # A token past the gap is served from the log again
+        self.add_item(6)
+        group = self.changes(api.encode_sync_token({self.gid: rev}))
+        self.assertFalse(group["full"])
+        self.assertEqual(len(group["items"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""Ledger against the original updateGraph walk.
+
+    python -m unittest test_ledger
+"""
+import random
+import unittest
+
+from ledger import Ledger, pack_graph, to_paise, unpack_graph, updateGraph
+
+
+def dense_group(members):
+    """A group as add_member_to_group builds it: every ordered pair at 0"""
+    return {
+        "groupMembers": list(members),
+        "groupGraph": {a: {b: 0 for b in members if b != a} for a in members},
+    }
+
+
+def random_items(rng, members, count):
+    items = []
+    for _ in range(count):
+        spliters = rng.sample(members, rng.randint(1, len(members)))
+        values = [round(rng.uniform(0.01, 999.99), 2) for _ in spliters]
+        items.append((rng.choice(members), spliters, values))
+    return items
+
+
+def apply_with_update_graph(group, item, reverse=False):
+    """Item create (or delete, reverse=True) as the handlers did before Ledger"""
+    payer, spliters, values = item
+    for spliter, value in zip(spliters, values):
+        if reverse:
+            updateGraph(group, spliter, payer, value)
+        else:
+            updateGraph(group, payer, spliter, float(value))
+
+
+def paise_balances(ledger):
+    return {m: to_paise(v) for m, v in ledger.balances().items()}
+
+
+class LedgerMatchesUpdateGraphTest(unittest.TestCase):
+    members = ["a", "b", "c", "d", "e", "f"]
+
+    def check_same_balances(self, group, ledger):
+        walked = Ledger.from_graph(self.members, group["groupGraph"])
+        self.assertEqual(paise_balances(walked), paise_balances(ledger))
+
+    def test_created_items(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            group, ledger = dense_group(self.members), Ledger(self.members)
+            for item in random_items(rng, self.members, 60):
+                apply_with_update_graph(group, item)
+                ledger.apply_item(*item)
+            self.check_same_balances(group, ledger)
+
+    def test_deleted_items(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            items = random_items(rng, self.members, 40)
+            group, ledger = dense_group(self.members), Ledger(self.members)
+            for item in items:
+                apply_with_update_graph(group, item)
+                ledger.apply_item(*item)
+            deleted = rng.sample(range(len(items)), 15)
+            for i in deleted:
+                apply_with_update_graph(group, items[i], reverse=True)
+                ledger.apply_item(*items[i], sign=-1)
+            self.check_same_balances(group, ledger)
+
+            # The same as never having added them
+            kept = Ledger(self.members)
+            for i, item in enumerate(items):
+                if i not in deleted:
+                    kept.apply_item(*item)
+            self.assertEqual(paise_balances(kept), paise_balances(ledger))
+
+    def test_deleting_everything_settles_to_zero(self):
+        rng = random.Random(7)
+        items = random_items(rng, self.members, 30)
+        ledger = Ledger(self.members)
+        for item in items:
+            ledger.apply_item(*item)
+        for item in reversed(items):
+            ledger.apply_item(*item, sign=-1)
+        self.assertEqual(set(ledger.balances().values()), {0})
+        self.assertEqual(ledger.settlements(), [])
+
+    def test_amounts_round_to_paise(self):
+        ledger = Ledger(["a", "b", "c"])
+        ledger.apply_item("a", ["b", "c"], [0.1, 0.2])
+        ledger.apply_item("a", ["b"], [33.333])
+        self.assertEqual(ledger.balances(), {"a": 33.63, "b": -33.43, "c": -0.2})
+
+
+class GraphViewTest(unittest.TestCase):
+    members = ["a", "b", "c", "d", "e"]
+
+    def ledger(self, seed):
+        ledger = Ledger(self.members)
+        for item in random_items(random.Random(seed), self.members, 50):
+            ledger.apply_item(*item)
+        return ledger
+
+    def test_graph_view_has_update_graph_shape(self):
+        view = self.ledger(1).graph_view()
+        group = dense_group(self.members)
+        self.assertEqual({a: set(row) for a, row in view.items()},
+                         {a: set(row) for a, row in group["groupGraph"].items()})
+        for row in view.values():
+            for amount in row.values():
+                self.assertGreaterEqual(amount, 0)
+                self.assertEqual(to_paise(amount), round(amount * 100, 6))
+
+    def test_graph_view_implies_the_same_balances(self):
+        for seed in range(20):
+            ledger = self.ledger(seed)
+            implied = Ledger.from_graph(self.members, ledger.graph_view())
+            self.assertEqual(paise_balances(implied), paise_balances(ledger))
+
+    def test_settlements_clear_every_balance(self):
+        for seed in range(20):
+            ledger = self.ledger(seed)
+            settlements = ledger.settlements()
+            self.assertLessEqual(len(settlements), len(self.members) - 1)
+            net = {m: to_paise(v) for m, v in ledger.balances().items()}
+            for debtor, creditor, amount in settlements:
+                self.assertGreater(amount, 0)
+                net[debtor] += to_paise(amount)
+                net[creditor] -= to_paise(amount)
+            self.assertEqual(set(net.values()), {0})
+
+    def test_packed_graph_round_trips(self):
+        ledger = self.ledger(3)
+        view = ledger.graph_view()
+        self.assertEqual(unpack_graph(ledger.packed_graph(), self.members, dense=True), view)
+        self.assertEqual(unpack_graph(pack_graph(view, self.members), self.members, dense=True), view)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Tests for the local storage backends and the instrumentation wrapper.
+
+    python -m unittest test_storage
+"""
+import os
+import tempfile
+import threading
+import unittest
+
+from storage import InstrumentedDB, MemoryStore, SQLiteStore
+
+
+class StrictDB:
+    """Stands in for firebase_admin.db, whose reference() requires a str path"""
+
+    def __init__(self):
+        self.store = MemoryStore()
+        self.paths = []
+
+    def reference(self, path="/", app=None, url=None):
+        if not isinstance(path, str):
+            raise ValueError(f'Invalid path: "{path}". Path must be a string.')
+        self.paths.append(path)
+        return self.store.reference(path)
+
+
+class StoreSemantics:
+    """Realtime Database behaviour both local stores must reproduce"""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.ref = self.store.reference
+
+    def test_set_and_get(self):
+        self.ref("a/b").set({"c": 1, "d": "x"})
+        self.assertEqual(self.ref("a").get(), {"b": {"c": 1, "d": "x"}})
+        self.assertEqual(self.ref("a/b/c").get(), 1)
+        self.assertIsNone(self.ref("missing").get())
+        self.ref("a/b/c").set({"deeper": True})
+        self.assertEqual(self.ref("a/b").get(), {"c": {"deeper": True}, "d": "x"})
+
+    def test_lists_come_back_as_lists(self):
+        self.ref("l").set(["x", "y", "z"])
+        self.assertEqual(self.ref("l").get(), ["x", "y", "z"])
+        self.assertEqual(self.ref("l/1").get(), "y")
+        self.ref("sparse").set({"0": "a", "7": "b"})
+        self.assertEqual(self.ref("sparse").get(), {"0": "a", "7": "b"})
+
+    def test_multi_path_update(self):
+        self.ref("groups/g1").set({"name": "trip", "rev": 1})
+        self.ref().update({
+            "groups/g1/rev": 2,
+            "groups/g1/items/i1": True,
+            "items/i1": {"amount": 5},
+            "users/u1/groupIds/g1": True,
+        })
+        self.assertEqual(self.ref("groups/g1").get(), {"name": "trip", "rev": 2, "items": {"i1": True}})
+        self.assertEqual(self.ref("items/i1/amount").get(), 5)
+        self.assertEqual(self.ref("users/u1/groupIds").get(), {"g1": True})
+        # An update replaces each path it names and leaves siblings alone
+        self.ref("groups/g1").update({"items": {"i2": True}})
+        self.assertEqual(self.ref("groups/g1").get(), {"name": "trip", "rev": 2, "items": {"i2": True}})
+
+    def test_update_rejects_empty_values(self):
+        with self.assertRaises(ValueError):
+            self.ref().update({})
+
+    def test_none_deletes_and_prunes_empty_parents(self):
+        self.ref().update({"a/b/c": 1, "a/x": 2})
+        self.ref().update({"a/b/c": None})
+        self.assertEqual(self.ref("a").get(), {"x": 2})
+        self.ref("a/x").set(None)
+        self.assertIsNone(self.ref("a").get())
+        self.ref("e").set({"empty": {}})
+        self.assertIsNone(self.ref("e").get())
+        self.ref().update({"gone/leaf": None})
+        self.assertIsNone(self.ref("gone").get())
+
+    def test_delete(self):
+        self.ref("a").set({"b": 1, "c": 2})
+        self.ref("a/b").delete()
+        self.assertEqual(self.ref("a").get(), {"c": 2})
+
+    def test_shallow_get(self):
+        self.ref("g").set({"rev": 3, "items": {"i1": True}})
+        self.assertEqual(self.ref("g").get(shallow=True), {"rev": 3, "items": True})
+
+    def test_order_by_key_with_limits(self):
+        self.ref("k").set({key: {"n": i} for i, key in enumerate(["d", "a", "c", "b", "e"])})
+        self.assertEqual(list(self.ref("k").order_by_key().limit_to_first(2).get()), ["a", "b"])
+        self.assertEqual(list(self.ref("k").order_by_key().start_at("b").limit_to_first(2).get()), ["b", "c"])
+        self.assertEqual(list(self.ref("k").order_by_key().end_at("c").get()), ["a", "b", "c"])
+        self.assertEqual(list(self.ref("k").order_by_key().limit_to_last(2).get()), ["d", "e"])
+        self.assertEqual(self.ref("k").order_by_key().start_at("e").get(), {"e": {"n": 4}})
+
+    def test_order_by_child(self):
+        self.ref("items").set({
+            "i1": {"group": "g2", "at": 3},
+            "i2": {"group": "g1", "at": 1},
+            "i3": {"group": "g1", "at": 2},
+            "i4": {"at": 0},
+        })
+        by_group = self.ref("items").order_by_child("group")
+        self.assertEqual(list(by_group.equal_to("g1").get()), ["i2", "i3"])
+        # Children without the field sort first, as null
+        self.assertEqual(list(self.ref("items").order_by_child("group").limit_to_first(1).get()), ["i4"])
+        self.assertEqual(list(self.ref("items").order_by_child("at").limit_to_last(2).get()), ["i3", "i1"])
+        self.assertEqual(list(self.ref("items").order_by_child("at").start_at(1).end_at(2).get()), ["i2", "i3"])
+
+    def test_order_by_value(self):
+        self.ref("index").set({"x": "2024-03", "y": "2024-01", "z": "2024-02"})
+        self.assertEqual(list(self.ref("index").order_by_value().get()), ["y", "z", "x"])
+        self.assertEqual(list(self.ref("index").order_by_value().start_at("2024-02").get()), ["z", "x"])
+
+    def test_transaction(self):
+        self.ref("n").set(1)
+        self.assertEqual(self.ref("n").transaction(lambda current: (current or 0) + 1), 2)
+        self.assertEqual(self.ref("new").transaction(lambda current: {"seen": current is None}), {"seen": True})
+        self.ref("n").transaction(lambda current: None)
+        self.assertIsNone(self.ref("n").get())
+
+    def test_failed_transaction_writes_nothing(self):
+        self.ref("n").set(5)
+
+        def fail(current):
+            raise ValueError("abort")
+
+        with self.assertRaises(ValueError):
+            self.ref("n").transaction(fail)
+        self.assertEqual(self.ref("n").get(), 5)
+
+    def test_concurrent_transactions_lose_no_update(self):
+        # RTDB retries a transaction whose node changed under it; the local
+        # stores must end up in the same place
+        def bump():
+            for _ in range(50):
+                self.ref("counter").transaction(lambda current: (current or 0) + 1)
+
+        threads = [threading.Thread(target=bump) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.ref("counter").get(), 400)
+
+    def test_push_keys_sort_in_creation_order(self):
+        keys = [self.ref("log").push({"i": i}).key for i in range(50)]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(list(self.ref("log").order_by_key().get()), keys)
+
+
+class MemoryStoreTest(StoreSemantics, unittest.TestCase):
+    def make_store(self):
+        return MemoryStore()
+
+
+class SQLiteStoreTest(StoreSemantics, unittest.TestCase):
+    def make_store(self):
+        return SQLiteStore()
+
+
+class SQLiteFileStoreTest(StoreSemantics, unittest.TestCase):
+    def make_store(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return SQLiteStore(os.path.join(directory.name, "test.sqlite3"))
+
+    def test_update_is_visible_to_another_connection(self):
+        self.ref().update({"a/b": 1, "c": 2})
+        other = SQLiteStore(self.store._conn.execute("PRAGMA database_list").fetchone()[2])
+        self.assertEqual(other.reference().get(), {"a": {"b": 1}, "c": 2})
+
+
+class InstrumentedDBTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.backend = StrictDB()
+        self.db = InstrumentedDB(self.backend, lambda *args: self.calls.append(args))
+
+    def test_root_reference_passes_a_string_path(self):
+        self.db.reference().update({"a/b": 1, "c": 2})
+        self.assertEqual(self.backend.paths, ["/"])
+        self.assertEqual(self.db.reference("a").get(), {"b": 1})
+        self.assertEqual([call[0] for call in self.calls], ["write", "read"])
+
+    def test_keyword_arguments_reach_the_backend(self):
+        self.db.reference("x", url=None).set(1)
+        self.assertEqual(self.backend.paths, ["x"])
+
+
+if __name__ == "__main__":
+    unittest.main()